@@ -0,0 +1,614 @@
+#!/usr/bin/env python
+
+"""
+This script measures how the signup server performs so that changes to it can
+be compared between commits. It doesn't require any dependencies outside of
+the standard library.
+
+It has two modes:
+
+* ``micro`` times individual pieces of the server (form parsing, rate
+  limiting, inserting members...) in a tight loop.
+* ``load`` fires a mix of ``/join`` and ``/check`` requests at the server
+  from many threads and reports throughput, latency percentiles and how the
+  requests fared. The server is either started in this process or one that's
+  already running (such as ``test-deploy.py``) is used.
+
+Both can print their results as JSON, which is the format to keep around for
+comparisons. You can see how to use the script by typing
+``python benchmark.py -h`` into your shell of choice.
+
+When the application is run in this process it is pointed at a throwaway
+configuration and database in a temporary directory, so it is safe to run
+anywhere.
+
+"""
+
+# We set up a configuration file before importing the application (which
+# loads its configuration as soon as it is imported), so make sure nobody
+# imports us expecting otherwise.
+if __name__ != "__main__":
+    raise ImportError("This script should not be imported.")
+
+# stdlib
+import argparse
+import cgi
+import collections
+import datetime
+import httplib
+import io
+import itertools
+import json
+import os
+import random
+import shutil
+import SocketServer
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import urllib
+import urlparse
+import wsgiref.simple_server
+import wsgiref.util
+
+TEMP_DIR = tempfile.mkdtemp(prefix = "rock-benchmark-")
+"""Holds the configuration file and database used while benchmarking."""
+
+CONFIG = {
+    "db_file": os.path.join(TEMP_DIR, "database"),
+    "max_joins_per_minute": "1000000000",
+    "max_checks_per_minute": "1000000000"
+}
+"""
+The configuration the application is run with. The limits are high enough to
+never get in the way unless they're overridden with ``--config``.
+
+"""
+
+# This will hold the signup_server package once load_application() has
+# imported it.
+wsgi_app = None
+
+def load_application(overrides):
+    """
+    Writes our configuration file, with the given options overriding our
+    defaults, and imports and initializes the application.
+
+    """
+
+    config = dict(CONFIG)
+    config.update(overrides)
+
+    config_path = os.path.join(TEMP_DIR, "config.ini")
+    with open(config_path, "w") as f:
+        f.write("[rock]\n")
+        for k, v in sorted(config.items()):
+            f.write("{} = {}\n".format(k, v))
+
+    os.environ["ROCK_CONFIG"] = config_path
+
+    global wsgi_app
+    import signup_server
+    wsgi_app = signup_server
+
+    # The application says which configuration file it's loading, which
+    # belongs with our other chatter on standard error rather than in the
+    # results (it would break --json).
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        wsgi_app.main.create_app()
+    finally:
+        sys.stdout = stdout
+
+JOIN_BODY = urllib.urlencode([
+    ("email", "someone@example.com"),
+    ("name", "S\xc3\xb8me One"),
+    ("shirt-size", "Medium"),
+    ("payment-type", "cash")
+])
+"""A body like the one join.htm sends."""
+
+LARGE_BODY = urllib.urlencode([
+    ("field{}".format(i), "value with spaces & symbols " * 10)
+        for i in range(15)
+])
+"""A body about as large as our limits allow."""
+
+# Microbenchmarks
+
+def make_environ(body):
+    return {
+        "REQUEST_METHOD": "POST",
+        "CONTENT_TYPE": "application/x-www-form-urlencoded",
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.input": io.BytesIO(body)
+    }
+
+def parse_with_field_storage(environ):
+    """The way main.app parsed form data before the forms module existed."""
+
+    form_data_storage = cgi.FieldStorage(
+        fp = environ["wsgi.input"],
+        environ = environ,
+        keep_blank_values = True
+    )
+
+    form_data = {}
+    for i in form_data_storage.keys():
+        key = i.decode("utf_8")
+        value = form_data_storage[i].value.decode("utf_8")
+        form_data[key] = value
+
+    return form_data
+
+def parse_with_forms(environ):
+    return wsgi_app.forms.parse_urlencoded(environ, max_body_size = 16384,
+        max_fields = 20)
+
+def time_function(function, make_argument, number, repeat):
+    """
+    Calls ``function(make_argument())`` ``number`` times, ``repeat`` times
+    over, and returns the best time per call in seconds. Only the calls to
+    ``function`` are timed.
+
+    """
+
+    best = None
+    for _ in range(repeat):
+        arguments = [make_argument() for _ in range(number)]
+
+        start = time.time()
+        for i in arguments:
+            function(i)
+        elapsed = (time.time() - start) / number
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+def bench_forms(number, repeat):
+    results = {}
+    parsers = [("field_storage", parse_with_field_storage),
+        ("forms", parse_with_forms)]
+    for body_name, body in [("join", JOIN_BODY), ("large", LARGE_BODY)]:
+        for parser_name, parser in parsers:
+            # Make sure both parsers agree before timing them
+            assert parser(make_environ(body)) == parse_with_forms(
+                make_environ(body))
+
+            name = "parse_{}_{}".format(body_name, parser_name)
+            results[name] = time_function(parser,
+                lambda: make_environ(body), number, repeat)
+
+    return results
+
+def bench_rate_limiter(number, repeat):
+    db = wsgi_app.main.connection_manager.writer()
+
+    results = {}
+    backends = [
+        ("sqlite", wsgi_app.rate_limiting.SQLiteBackend()),
+        ("shared_memory", wsgi_app.rate_limiting.SharedMemoryBackend(
+            os.path.join(TEMP_DIR, "rate-limiting")))
+    ]
+    for name, backend in backends:
+        results["rate_limiter_{}".format(name)] = time_function(
+            lambda action: backend.try_action(db, action, 1000000000),
+            lambda: "join", number, repeat)
+
+    # The per-client limiter with a full set of keys, half of the lookups
+    # being for clients it has never seen.
+    limiter = wsgi_app.rate_limiting.SlidingWindowLimiter(max_keys = 10000)
+    for i in range(limiter.max_keys):
+        limiter.try_action(("join", "client", i), 1000000000)
+    clients = itertools.count(limiter.max_keys // 2)
+    results["rate_limiter_sliding_window"] = time_function(
+        lambda key: limiter.try_action(key, 1000000000),
+        lambda: ("join", "client", next(clients)), number, repeat)
+
+    return results
+
+def bench_members(number, repeat):
+    db = wsgi_app.main.connection_manager.writer()
+    Member = wsgi_app.database.Member
+
+    # Every insert needs an email that hasn't been used yet
+    emails = ("member{}@example.com".format(i) for i in itertools.count())
+    def make_member():
+        return Member(joined = datetime.datetime.now(), email = next(emails),
+            name = "Some One", shirt_size = "Medium", paid_on = None)
+
+    results = {}
+    results["member_insert"] = time_function(lambda i: i.insert(db),
+        make_member, number, repeat)
+    results["member_get"] = time_function(lambda i: Member.get(db, i),
+        lambda: "member0@example.com", number, repeat)
+
+    return results
+
+MICRO_BENCHMARKS = collections.OrderedDict([
+    ("forms", bench_forms),
+    ("rate_limiter", bench_rate_limiter),
+    ("members", bench_members)
+])
+"""
+Maps the name of each group of microbenchmarks to the function that runs it.
+
+"""
+
+def run_micro(arguments):
+    load_application(arguments.config)
+
+    results = {}
+    for i in arguments.benchmarks or MICRO_BENCHMARKS:
+        results.update(MICRO_BENCHMARKS[i](arguments.number,
+            arguments.repeat))
+
+    if arguments.json:
+        print json.dumps(results, indent = 4, sort_keys = True)
+    else:
+        for name, seconds in sorted(results.items()):
+            print "{:40} {:10.2f} us".format(name, seconds * 1e6)
+
+# Load generation
+
+class ThreadedWSGIServer(SocketServer.ThreadingMixIn,
+        wsgiref.simple_server.WSGIServer):
+    """A wsgiref server that handles each request in its own thread."""
+
+    daemon_threads = True
+
+    # The default backlog of 5 would have connections refused (and retried a
+    # second later) long before the application is the bottleneck.
+    request_queue_size = 128
+
+class QuietHandler(wsgiref.simple_server.WSGIRequestHandler):
+    """A wsgiref request handler that doesn't log every request."""
+
+    def log_message(self, *args):
+        pass
+
+class ErrorCounter(object):
+    """
+    WSGI middleware that counts the exceptions raised by the application it
+    wraps, so that we can tell why requests failed with a 500.
+
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.counts = collections.Counter()
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        try:
+            return self.app(environ, start_response)
+        except Exception as e:
+            if (isinstance(e, sqlite3.OperationalError) and
+                    "database is locked" in str(e)):
+                kind = "database_locked"
+            else:
+                kind = type(e).__name__
+            with self._lock:
+                self.counts[kind] += 1
+            raise
+
+def start_in_process_server():
+    """
+    Serves the application from a background thread on a free port. Returns
+    the server's URL and the ErrorCounter wrapping the application.
+
+    """
+
+    app = ErrorCounter(wsgi_app.main.app)
+    httpd = wsgiref.simple_server.make_server("localhost", 0, app,
+        server_class = ThreadedWSGIServer, handler_class = QuietHandler)
+
+    thread = threading.Thread(target = httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return "http://localhost:{}".format(httpd.server_port), app
+
+def parse_mix(value):
+    """
+    Parses a request mix like ``join=2,duplicate=1,check=7`` into a list of
+    (kind, weight) tuples.
+
+    """
+
+    mix = []
+    for i in value.split(","):
+        kind, _, weight = i.partition("=")
+        if kind not in REQUEST_KINDS:
+            raise argparse.ArgumentTypeError("unknown request kind {}".format(
+                repr(kind)))
+        try:
+            mix.append((kind, float(weight)))
+        except ValueError:
+            raise argparse.ArgumentTypeError("invalid weight {}".format(
+                repr(weight)))
+
+    return mix
+
+REQUEST_KINDS = ("join", "duplicate", "check")
+"""
+The kinds of requests the load generator makes: joins with new emails, joins
+with emails that are already registered and membership checks.
+
+"""
+
+class LoadGenerator(object):
+    """
+    Sends requests to the server from a number of threads and records how
+    each of them went.
+
+    """
+
+    def __init__(self, url, mix, seed_emails):
+        self.url = url
+        parsed_url = urlparse.urlparse(url)
+        self.host = parsed_url.hostname
+        self.port = parsed_url.port or 80
+        self.path_prefix = parsed_url.path.rstrip("/")
+
+        # The Referer must point at our site or the application will refuse
+        # the request.
+        self.referer = url.rstrip("/") + "/join.htm"
+
+        self.kinds = [i[0] for i in mix]
+        total = sum(i[1] for i in mix)
+        self.cumulative_weights = []
+        running_total = 0
+        for _, weight in mix:
+            running_total += weight / total
+            self.cumulative_weights.append(running_total)
+
+        # Emails that are known to be registered, used for duplicates and
+        # checks. New joins add to this.
+        self.registered = list(seed_emails)
+        self._email_counter = itertools.count()
+        self._run_id = "{:x}".format(random.getrandbits(32))
+
+        # Each result is a (kind, status, outcome, latency) tuple
+        self.results = []
+        self._lock = threading.Lock()
+
+    def pick_kind(self, rng):
+        value = rng.random()
+        for kind, weight in zip(self.kinds, self.cumulative_weights):
+            if value <= weight:
+                return kind
+        return self.kinds[-1]
+
+    def make_request(self, kind, rng):
+        if kind == "join":
+            email = "load-{}-{}@example.com".format(self._run_id,
+                next(self._email_counter))
+            return "/join", {"email": email, "name": "Load Test",
+                "shirt-size": "Medium", "payment-type": "cash"}
+        elif kind == "duplicate":
+            email = rng.choice(self.registered)
+            return "/join", {"email": email, "name": "Load Test",
+                "shirt-size": "Medium", "payment-type": "cash"}
+        else:
+            return "/check", {"email": rng.choice(self.registered)}
+
+    def send(self, kind, rng):
+        path, fields = self.make_request(kind, rng)
+        body = urllib.urlencode(fields)
+        headers = {
+            "Content-Type": "application/x-www-form-urlencoded",
+            "Referer": self.referer
+        }
+
+        start = time.time()
+        try:
+            connection = httplib.HTTPConnection(self.host, self.port,
+                timeout = 60)
+            connection.request("POST", self.path_prefix + path, body, headers)
+            response = connection.getresponse()
+            response_body = response.read()
+            status = response.status
+            connection.close()
+        except Exception as e:
+            status = None
+            response_body = str(e)
+        latency = time.time() - start
+
+        outcome = classify(status, response_body)
+        if kind == "join" and outcome == "ok":
+            with self._lock:
+                self.registered.append(fields["email"])
+
+        with self._lock:
+            self.results.append((kind, status, outcome, latency))
+
+    def run(self, total_requests, concurrency, seed):
+        counter = itertools.count()
+
+        def worker(worker_number):
+            # Each thread gets its own random number generator so runs with
+            # the same seed make the same requests.
+            rng = random.Random(seed * 1000 + worker_number)
+            while next(counter) < total_requests:
+                self.send(self.pick_kind(rng), rng)
+
+        threads = [threading.Thread(target = worker, args = (i, ))
+            for i in range(concurrency)]
+
+        start = time.time()
+        for i in threads:
+            i.start()
+        for i in threads:
+            i.join()
+
+        return time.time() - start
+
+def classify(status, body):
+    """Describes how a request fared based on the response."""
+
+    if status is None:
+        return "connection_error"
+    elif status == 200:
+        return "ok"
+    elif status == 429 or "rate limiting" in body:
+        return "rate_limited"
+    elif "already registered" in body:
+        return "duplicate"
+    elif status == 503:
+        return "overloaded"
+    else:
+        return "http_{}".format(status)
+
+def percentile(sorted_values, fraction):
+    """Returns the given percentile using the nearest-rank method."""
+
+    if not sorted_values:
+        return None
+
+    index = int(round(fraction * len(sorted_values) + 0.5)) - 1
+    return sorted_values[max(0, min(index, len(sorted_values) - 1))]
+
+def summarize(results, elapsed):
+    latencies = sorted(i[3] for i in results)
+    summary = {
+        "requests": len(results),
+        "seconds": elapsed,
+        "requests_per_second": len(results) / elapsed if elapsed else None,
+        "latency_p50": percentile(latencies, 0.50),
+        "latency_p95": percentile(latencies, 0.95),
+        "latency_p99": percentile(latencies, 0.99),
+        "latency_max": latencies[-1] if latencies else None,
+        "outcomes": dict(collections.Counter(i[2] for i in results)),
+        "by_kind": {}
+    }
+
+    for kind in REQUEST_KINDS:
+        kind_results = [i for i in results if i[0] == kind]
+        if not kind_results:
+            continue
+
+        kind_latencies = sorted(i[3] for i in kind_results)
+        summary["by_kind"][kind] = {
+            "requests": len(kind_results),
+            "latency_p50": percentile(kind_latencies, 0.50),
+            "latency_p95": percentile(kind_latencies, 0.95),
+            "latency_p99": percentile(kind_latencies, 0.99),
+            "outcomes": dict(collections.Counter(i[2] for i in kind_results))
+        }
+
+    return summary
+
+def run_load(arguments):
+    error_counter = None
+    if arguments.url is None:
+        load_application(arguments.config)
+        url, error_counter = start_in_process_server()
+    else:
+        url = arguments.url
+
+    # Register a few members up front so that there is something for the
+    # duplicate joins and the checks to use.
+    generator = LoadGenerator(url, arguments.mix, [])
+    for _ in range(arguments.seed_members):
+        generator.send("join", random.Random(arguments.seed))
+    generator.results = []
+    if not generator.registered:
+        print "Could not register any members to seed the run with."
+        return 1
+
+    elapsed = generator.run(arguments.requests, arguments.concurrency,
+        arguments.seed)
+
+    summary = summarize(generator.results, elapsed)
+    summary["url"] = url
+    summary["concurrency"] = arguments.concurrency
+    summary["mix"] = dict(arguments.mix)
+    if error_counter is not None:
+        summary["server_exceptions"] = dict(error_counter.counts)
+
+    if arguments.json:
+        print json.dumps(summary, indent = 4, sort_keys = True)
+    else:
+        print ("{requests} requests in {seconds:.2f}s "
+            "({requests_per_second:.1f} requests/s)".format(**summary))
+        print "latency p50 {:.1f}ms, p95 {:.1f}ms, p99 {:.1f}ms".format(
+            summary["latency_p50"] * 1000, summary["latency_p95"] * 1000,
+            summary["latency_p99"] * 1000)
+        for kind, kind_summary in sorted(summary["by_kind"].items()):
+            print "  {:10} {:6} requests, p99 {:.1f}ms, {}".format(kind,
+                kind_summary["requests"], kind_summary["latency_p99"] * 1000,
+                kind_summary["outcomes"])
+        if summary.get("server_exceptions"):
+            print "server exceptions: {}".format(
+                summary["server_exceptions"])
+
+def parse_config_override(value):
+    key, sep, option = value.partition("=")
+    if not sep:
+        raise argparse.ArgumentTypeError("expected KEY=VALUE")
+    return key.strip(), option.strip()
+
+def main():
+    parser = argparse.ArgumentParser(
+        description = "Benchmarks the signup server.")
+    subparsers = parser.add_subparsers()
+
+    micro_parser = subparsers.add_parser("micro",
+        help = "Time individual pieces of the server.")
+    micro_parser.set_defaults(run = run_micro)
+    micro_parser.add_argument("benchmarks", nargs = "*", metavar = "BENCHMARK",
+        help = "The benchmarks to run, any of: {}. Defaults to all of "
+            "them.".format(", ".join(MICRO_BENCHMARKS)))
+    micro_parser.add_argument("--number", type = int, default = 2000,
+        help = "How many calls make up a single timing.")
+    micro_parser.add_argument("--repeat", type = int, default = 5,
+        help = "How many timings to take, the best is reported.")
+
+    load_parser = subparsers.add_parser("load",
+        help = "Send many requests to the server and measure how it copes.")
+    load_parser.set_defaults(run = run_load)
+    load_parser.add_argument("--url",
+        help = "The URL of a running server (such as "
+            "http://localhost:8000). By default the application is served "
+            "from this process.")
+    load_parser.add_argument("--requests", type = int, default = 2000,
+        help = "How many requests to send.")
+    load_parser.add_argument("--concurrency", type = int, default = 16,
+        help = "How many requests to have in flight at once.")
+    load_parser.add_argument("--mix", type = parse_mix,
+        default = parse_mix("join=2,duplicate=1,check=7"),
+        help = "The relative weights of each kind of request (join, "
+            "duplicate and check). Defaults to join=2,duplicate=1,check=7.")
+    load_parser.add_argument("--seed-members", type = int, default = 20,
+        help = "How many members to register before starting.")
+    load_parser.add_argument("--seed", type = int, default = 0,
+        help = "Seeds the random choice of requests.")
+
+    for i in (micro_parser, load_parser):
+        i.add_argument("--config", type = parse_config_override,
+            action = "append", default = [], metavar = "KEY=VALUE",
+            help = "Override an option in the [rock] section of the "
+                "configuration the application is run with. Only used when "
+                "the application is run in this process.")
+        i.add_argument("--json", action = "store_true",
+            help = "Print the results as JSON (times are in seconds).")
+
+    arguments = parser.parse_args()
+    arguments.config = dict(arguments.config)
+
+    for i in getattr(arguments, "benchmarks", []):
+        if i not in MICRO_BENCHMARKS:
+            parser.error("unknown benchmark {}".format(repr(i)))
+
+    return arguments.run(arguments)
+
+try:
+    sys.exit(main())
+finally:
+    shutil.rmtree(TEMP_DIR, ignore_errors = True)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+"""
+This script serves the dynamic (WSGI) portion of the site with the event loop
+server in ``signup_server/event_server.py``, which can hold thousands of idle
+keep-alive connections while only a few threads touch the database. The
+static portion of the site is left to whatever web server sits in front of
+this one.
+
+You can see how to use the script by typing ``python event-server.py -h`` into
+your shell of choice. See the event_* options in the configuration file for
+how to tune it.
+
+"""
+
+# The WSGI application needs to be importable, which it is from the directory
+# this script is in, so make sure we're being run rather than imported.
+if __name__ != "__main__":
+    raise ImportError("This script should not be imported.")
+
+# stdlib
+import logging
+import socket
+import sys
+
+# internal
+import signup_server as wsgi_app
+import signup_server.event_server
+
+DEFAULT_PORT = 8000
+"""The default port to listen on if no port is provided on the command line."""
+
+DEFAULT_ADDRESS = "localhost"
+"""The default address to listen on if no address is provided."""
+
+def main():
+    arguments = sys.argv[1:]
+    if "-h" in arguments or "--help" in arguments:
+        print "Usage: {} [PORT={}] [ADDRESS={}]".format(sys.argv[0],
+            DEFAULT_PORT, DEFAULT_ADDRESS)
+        return 0
+
+    port = int(arguments[0]) if len(arguments) >= 1 else DEFAULT_PORT
+    address = arguments[1] if len(arguments) >= 2 else DEFAULT_ADDRESS
+
+    log_format = ("[%(name)7s:%(lineno)3s - %(funcName)14s] %(levelname)5s "
+        "- %(message)s")
+    logging.basicConfig(level = logging.INFO, format = log_format)
+
+    listening_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listening_socket.bind((address, port))
+    listening_socket.listen(1024)
+    listening_socket.setblocking(0)
+
+    # Set the application up before accepting any connections, and reload
+    # its configuration file whenever we get a SIGHUP.
+    app = wsgi_app.main.create_app()
+    wsgi_app.main.install_reload_signal()
+
+    # Uploads are read by their handlers a piece at a time, so they get their
+    # bodies as they arrive rather than all at once.
+    server = wsgi_app.event_server.create_server(app, listening_socket,
+        wsgi_app.main.config, streamed_paths = [path for path, route in
+            wsgi_app.main.ROUTE_TABLE.items() if route.raw_body])
+
+    print "Serving the application at http://{}:{}".format(address, port)
+    server.serve_forever()
+
+try:
+    sys.exit(main())
+except KeyboardInterrupt:
+    pass
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+"""
+This script sends the emails the application queues in its outbox (join
+confirmations and replies to membership checks). Run one alongside whatever
+serves the site, using the same configuration file. See the smtp_* and mail_*
+options in the configuration file for how to point it at a mail server, and
+``signup_server/mailer.py`` for how delivery works.
+
+You can see how to use the script by typing ``python mail-worker.py -h`` into
+your shell of choice.
+
+"""
+
+# The WSGI application needs to be importable, which it is from the directory
+# this script is in, so make sure we're being run rather than imported.
+if __name__ != "__main__":
+    raise ImportError("This script should not be imported.")
+
+# stdlib
+import logging
+import sys
+
+# internal
+import signup_server as wsgi_app
+
+def main():
+    arguments = sys.argv[1:]
+    if "-h" in arguments or "--help" in arguments:
+        print "Usage: {} [--once]".format(sys.argv[0])
+        print
+        print ("Sends queued emails until interrupted. With --once, exits "
+            "once there are no more emails due.")
+        return 0
+
+    log_format = ("[%(name)7s:%(lineno)3s - %(funcName)14s] %(levelname)5s "
+        "- %(message)s")
+    logging.basicConfig(level = logging.INFO, format = log_format)
+
+    # This loads the same configuration file the application does and makes
+    # sure the outbox table exists.
+    wsgi_app.main.create_app()
+    config = wsgi_app.main.config
+    if "mail_from" not in config:
+        print "The mail_from option must be set to send emails."
+        return 1
+
+    mailer = wsgi_app.mailer.create_mailer(config,
+        wsgi_app.main.connection_manager.writer())
+    mailer.run(poll_interval = float(config.get("mail_poll_interval", "5")),
+        once = "--once" in arguments)
+
+try:
+    sys.exit(main())
+except KeyboardInterrupt:
+    pass
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+"""
+This script does the occasional maintenance the members database needs. It
+uses the same configuration file the application does (see the
+``ROCK_CONFIG`` environmental variable, or pass ``--config``).
+
+You can see the available commands by typing ``python manage.py -h`` into
+your shell of choice.
+
+"""
+
+# The WSGI application needs to be importable, which it is from the directory
+# this script is in, so make sure we're being run rather than imported.
+if __name__ != "__main__":
+    raise ImportError("This script should not be imported.")
+
+# stdlib
+import argparse
+import logging
+import time
+import sys
+
+# internal
+import signup_server as wsgi_app
+
+def print_drift(drift):
+    for name, stored, counted in drift:
+        print "{}: stored {}, counted {}".format(name, stored, counted)
+
+def check_stats(arguments):
+    """
+    Checks the member statistics served at /stats against counts made from
+    scratch.
+
+    """
+
+    drift = wsgi_app.database.MemberStatistic.find_drift(
+        wsgi_app.main.connection_manager.reader())
+    if not drift:
+        print "The member statistics are correct."
+        return 0
+
+    print_drift(drift)
+    print "{} statistics are wrong, run rebuild-stats to fix them.".format(
+        len(drift))
+    return 1
+
+def rebuild_stats(arguments):
+    """
+    Counts the member statistics served at /stats again from scratch,
+    reporting any that were wrong.
+
+    """
+
+    db = wsgi_app.main.connection_manager.writer()
+    print_drift(wsgi_app.database.MemberStatistic.find_drift(db))
+
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        wsgi_app.database.MemberStatistic.recount(db)
+    except:
+        db.execute("ROLLBACK")
+        raise
+    db.execute("COMMIT")
+
+    print "Rebuilt the member statistics."
+    return 0
+
+def convert_timestamps(arguments):
+    """
+    Rewrites members' times that are still stored as text as epoch seconds,
+    a batch at a time while the site keeps running. It's safe to stop this
+    and run it again later.
+
+    """
+
+    db = wsgi_app.main.connection_manager.writer()
+    converted = 0
+    for i in wsgi_app.database.Member.convert_rows(db,
+            batch_size = arguments.batch_size):
+        converted += i
+        if i:
+            print "Converted {} members so far.".format(converted)
+
+        # Give signups a chance to take the write lock between batches
+        time.sleep(arguments.pause)
+
+    print "Converted {} members, every member is up to date.".format(
+        converted)
+    return 0
+
+def import_members(arguments):
+    """
+    Marks the members listed in a CSV file as paid, or adds them, like
+    /admin/import does. It's safe to run this again on the same file.
+
+    """
+
+    if arguments.file == "-":
+        lines = sys.stdin
+    else:
+        lines = open(arguments.file, "rb")
+
+    try:
+        applied, errors = wsgi_app.bulk.apply_csv(
+            wsgi_app.main.connection_manager.writer(), arguments.action,
+            lines, batch_size = arguments.batch_size)
+    except wsgi_app.bulk.BulkError as e:
+        print "Nothing was imported: {}.".format(e)
+        return 1
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+
+    for line, email, message in errors:
+        print "Line {} ({}): {}".format(line, email, message)
+    print "Applied {} rows, {} rows had errors.".format(applied, len(errors))
+    return 1 if errors else 0
+
+COMMANDS = [
+    ("check-stats", check_stats, []),
+    ("rebuild-stats", rebuild_stats, []),
+    ("convert-timestamps", convert_timestamps, [
+        ("--batch-size", dict(type = int, default = 500,
+            help = "how many members to rewrite at a time")),
+        ("--pause", dict(type = float, default = 0.05,
+            help = "how long to wait between batches, in seconds"))
+    ]),
+    ("import-members", import_members, [
+        ("--action", dict(choices = wsgi_app.bulk.ACTIONS, required = True,
+            help = "mark the members paid, or add them")),
+        ("--batch-size", dict(type = int, default = wsgi_app.bulk.BATCH_SIZE,
+            help = "how many rows to apply at a time")),
+        ("file", dict(help = "the CSV file to read, or - for standard input"))
+    ])
+]
+
+def main():
+    parser = argparse.ArgumentParser(
+        description = "Maintains the members database.")
+    parser.add_argument("--config", help = "the configuration file to use")
+    subparsers = parser.add_subparsers(title = "commands")
+    for name, function, options in COMMANDS:
+        subparser = subparsers.add_parser(name,
+            help = function.__doc__.strip().split("\n\n")[0])
+        subparser.set_defaults(function = function)
+        for flag, settings in options:
+            subparser.add_argument(flag, **settings)
+
+    arguments = parser.parse_args()
+
+    log_format = ("[%(name)7s:%(lineno)3s - %(funcName)14s] %(levelname)5s "
+        "- %(message)s")
+    logging.basicConfig(level = logging.WARNING, format = log_format)
+
+    # This loads the configuration and brings the database up to date
+    wsgi_app.main.create_app(arguments.config)
+
+    return arguments.function(arguments)
+
+try:
+    sys.exit(main())
+except KeyboardInterrupt:
+    pass
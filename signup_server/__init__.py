@@ -1,4 +1,15 @@
-import main
 import database
+import rate_limiting
+import connections
+import cache
+import forms
+import metrics
+import mailer
+import bulk
+import admission
+import main
 
-modules = [main, database]
+# These are listed in dependency order so that reloading them in order leaves
+# main using the freshly reloaded versions of the others.
+modules = [database, rate_limiting, connections, cache, forms, metrics,
+    mailer, bulk, admission, main]
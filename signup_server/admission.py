@@ -0,0 +1,150 @@
+"""
+Admission control for the requests that write to the members database.
+
+SQLite lets one connection write at a time, so when signups spike every
+request but one is waiting on the write lock, and a request that waits for
+longer than ``busy_timeout_ms`` fails anyway, having held a thread the whole
+time. ``AdmissionMiddleware`` lets only ``max_active`` such requests into the
+application at once. A few more may wait their turn, for up to ``timeout``
+seconds. Everyone else is turned away right away with a ``503`` and a
+``Retry-After`` header, which costs us next to nothing and tells well behaved
+clients when to come back. Requests that don't write (like ``/metrics``) are
+let straight through.
+
+The limits are per process. Every process serving the site competes for the
+same write lock, so with several processes ``max_active`` should be lower.
+
+"""
+
+# stdlib
+import time
+import sqlite3
+import logging
+import threading
+
+# internal
+import metrics
+
+log = logging.getLogger("rock.admission")
+
+class AdmissionMiddleware(object):
+    """
+    WSGI middleware bounding how many requests for the given routes are
+    handled at once, see the module's documentation.
+
+    """
+
+    def __init__(self, app, routes, error_response, registry,
+            max_active = 4, max_waiting = 16, timeout = 0.5, retry_after = 1):
+        """
+        :param app: The WSGI application to wrap.
+        :param routes: The paths whose requests are limited.
+        :param error_response: Called as ``error_response(code,
+            start_response, message, headers)`` to turn requests away, see
+            ``main.error_response()``.
+        :param registry: The ``metrics.Registry`` to record into.
+        :param max_active: How many limited requests may be handled at once.
+        :param max_waiting: How many more may wait for one of those to
+            finish.
+        :param timeout: How long, in seconds, a request may wait before it's
+            turned away.
+        :param retry_after: How many seconds clients that are turned away are
+            told to wait.
+
+        """
+
+        self.app = app
+        self.routes = frozenset(routes)
+        self.error_response = error_response
+        self.registry = registry
+        self.max_active = max_active
+        self.max_waiting = max_waiting
+        self.timeout = timeout
+        self.retry_after = retry_after
+
+        self.active = 0
+        self.waiting = 0
+        self._condition = threading.Condition(threading.Lock())
+
+        registry.describe("rock_admission_rejected_total", "counter",
+            "Requests turned away with a 503 because too many were waiting "
+            "to write to the database, by why.")
+        registry.describe("rock_admission_wait_seconds", "histogram",
+            "Time requests waited to be let in.")
+        self._wait_histogram = registry.get_histogram(
+            "rock_admission_wait_seconds")
+
+    def __call__(self, environ, start_response):
+        if environ.get("PATH_INFO") not in self.routes:
+            return self.app(environ, start_response)
+
+        start_time = time.time()
+        reason = self._acquire(start_time + self.timeout)
+        if reason is not None:
+            return self._reject(reason, start_response)
+        self._wait_histogram.observe(time.time() - start_time)
+
+        try:
+            result = self.app(environ, start_response)
+        except sqlite3.OperationalError as e:
+            self._release()
+
+            # Even with few requests let in, another process (or a long
+            # import) can hold the write lock for longer than busy_timeout_ms.
+            # That's the same overload as above, not a bug in the request.
+            if "locked" not in str(e) and "busy" not in str(e):
+                raise
+            log.warning("Gave up waiting on the database: %s", e)
+            return self._reject("locked", start_response)
+        except:
+            self._release()
+            raise
+
+        # The request counts until the server is done with the body, which
+        # may not have been produced yet.
+        return metrics.RecordingIterable(result, self._release)
+
+    def _acquire(self, deadline):
+        """
+        Waits until the request may be let in.
+
+        :returns: ``None`` if it was, otherwise why it wasn't.
+
+        """
+
+        with self._condition:
+            if self.active < self.max_active:
+                self.active += 1
+                return None
+
+            if self.waiting >= self.max_waiting:
+                return "queue_full"
+
+            self.waiting += 1
+            try:
+                while self.active >= self.max_active:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return "timeout"
+                    self._condition.wait(remaining)
+
+                self.active += 1
+                return None
+            finally:
+                self.waiting -= 1
+
+    def _release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+    def _reject(self, reason, start_response):
+        self.registry.increment("rock_admission_rejected_total",
+            reason = reason)
+        return self.error_response(503, start_response,
+            "The server is too busy, try again soon.",
+            headers = [("Retry-After", str(self.retry_after))])
+
+    def stats(self):
+        with self._condition:
+            return {"active": self.active, "waiting": self.waiting}
@@ -0,0 +1,201 @@
+"""
+Changes to many members at once, read from a CSV file: marking the members
+who paid their dues in cash at a meeting as paid, and importing the rosters
+of past years.
+
+The CSV file's first line names its columns, which are the same as the ones
+``/admin/members`` exports. The rows are read one at a time and applied a
+batch at a time, each batch in one transaction with a single
+``executemany``, so large files neither take long nor have to fit in memory.
+A row that can't be applied (say, because its email isn't registered) is
+reported and skipped without holding up the rest. Applying the same file
+twice does no harm, so an import that was cut short can simply be run again.
+
+"""
+
+# stdlib
+import csv
+import codecs
+import datetime
+
+# internal
+import database
+
+ACTIONS = ("mark-paid", "add")
+"""
+What can be done with each row. ``mark-paid`` sets when an existing member
+paid, ``add`` adds new members.
+
+"""
+
+COLUMNS = {
+    "mark-paid": (("email", ), ("paid_on", )),
+    "add": (("email", "joined"), ("name", "shirt_size", "paid_on"))
+}
+"""Maps each action to the columns it requires and the optional ones."""
+
+BATCH_SIZE = 500
+"""How many rows are applied in each transaction by default."""
+
+class BulkError(Exception):
+    """Raised when a CSV file can't be applied at all."""
+
+class RowError(ValueError):
+    """Raised when a single row of a CSV file can't be applied."""
+
+def parse_time(value, column):
+    try:
+        return database.EPOCH_SECONDS.from_sql(value)
+    except ValueError:
+        raise RowError("{} must be a date like 2014-09-30 or a time like "
+            "2014-09-30 18:00:00".format(column))
+
+def parse_row(action, row, now):
+    """
+    Turns a row (a dictionary mapping columns to values) into what
+    ``apply_batch()`` needs.
+
+    """
+
+    email = row.get("email", u"").strip()
+    if not email:
+        raise RowError("email is required")
+
+    paid_on = row.get("paid_on", u"").strip()
+    if action == "mark-paid":
+        # Treasurers record payments just after they're made, so the time of
+        # the upload is a fine default.
+        return (email, parse_time(paid_on, "paid_on") if paid_on else now)
+
+    joined = row.get("joined", u"").strip()
+    if not joined:
+        raise RowError("joined is required")
+
+    return database.Member(
+        joined = parse_time(joined, "joined"),
+        email = email,
+        name = row.get("name", u""),
+        shirt_size = row.get("shirt_size", u"") or None,
+        paid_on = parse_time(paid_on, "paid_on") if paid_on else None
+    )
+
+def apply_batch(db, action, batch, errors):
+    """
+    Applies a batch of parsed rows in one transaction.
+
+    :param batch: A list of ``(line number, parsed row)`` tuples.
+    :param errors: The list to add ``(line number, email, message)`` tuples
+        to for rows that couldn't be applied.
+
+    :returns: The number of rows applied.
+
+    """
+
+    if action == "mark-paid":
+        # A treasurer's list may well name someone twice, and the last time
+        # given is the one that's kept.
+        missing = database.Member.update_all(db, ("paid_on", ),
+            [(email, (paid_on, )) for _, (email, paid_on) in batch])
+        for line, (email, _) in batch:
+            if email in missing:
+                errors.append((line, email, "email is not registered"))
+
+        return sum(1 for _, (email, _) in batch if email not in missing)
+
+    lines = dict((id(member), line) for line, member in batch)
+    skipped = database.Member.insert_many(db,
+        [member for _, member in batch])
+    for member, reason in skipped:
+        errors.append((lines[id(member)], member.email, reason))
+
+    return len(batch) - len(skipped)
+
+def apply_csv(db, action, lines, batch_size = BATCH_SIZE):
+    """
+    Applies every row of a CSV file.
+
+    :param db: A writable connection to the members database.
+    :param action: One of ``ACTIONS``.
+    :param lines: An iterable of the file's lines, encoded with UTF-8.
+    :param batch_size: How many rows are applied in each transaction.
+
+    :returns: A tuple of the number of rows that were applied and a list of
+        ``(line number, email, message)`` tuples for the rows that weren't.
+
+    :raises BulkError: If the file is missing a column the action needs,
+        before any rows are applied.
+
+    """
+
+    if action not in ACTIONS:
+        raise BulkError("unknown action {}, expected one of {}".format(
+            repr(action), ", ".join(ACTIONS)))
+    required, optional = COLUMNS[action]
+
+    reader = csv.reader(lines)
+    try:
+        header = [i.strip().lower() for i in next(reader)]
+    except StopIteration:
+        raise BulkError("the file is empty")
+    except csv.Error as e:
+        raise BulkError("the first line isn't valid CSV: {}".format(e))
+
+    # Spreadsheets saving as UTF-8 often start the file with a byte order mark
+    if header and header[0].startswith(codecs.BOM_UTF8):
+        header[0] = header[0][len(codecs.BOM_UTF8):]
+
+    missing = [i for i in required if i not in header]
+    if missing:
+        raise BulkError("the first line must name the columns {} (and may "
+            "name {})".format(", ".join(required), ", ".join(optional)))
+
+    now = datetime.datetime.now()
+    applied = 0
+    errors = []
+    batch = []
+    while True:
+        try:
+            values = next(reader)
+        except StopIteration:
+            break
+        except csv.Error as e:
+            errors.append((reader.line_num, None, "not valid CSV: {}".format(
+                e)))
+            continue
+
+        # Blank lines are fine, spreadsheets like to leave them at the end
+        if not values:
+            continue
+
+        try:
+            if len(values) != len(header):
+                raise RowError("expected {} values, found {}".format(
+                    len(header), len(values)))
+
+            try:
+                values = [i.decode("utf_8") for i in values]
+            except UnicodeDecodeError:
+                raise RowError("the row must be encoded with UTF-8")
+
+            batch.append((reader.line_num,
+                parse_row(action, dict(zip(header, values)), now)))
+        except RowError as e:
+            # The values are still bytes if they weren't valid UTF-8, and the
+            # errors have to be reported as JSON.
+            email = dict(zip(header, values)).get("email")
+            if isinstance(email, str):
+                email = email.decode("utf_8", "replace")
+            errors.append((reader.line_num, email, str(e)))
+
+        if len(batch) >= batch_size:
+            applied += apply_batch(db, action, batch, errors)
+            batch = []
+
+    if batch:
+        applied += apply_batch(db, action, batch, errors)
+
+    # Rows that couldn't be parsed were reported before the rest of their
+    # batch, put them back in order.
+    errors.sort(key = lambda error: error[0])
+
+    return applied, errors
@@ -0,0 +1,234 @@
+"""
+Small in-memory caches used to keep repeated lookups away from the database.
+
+"""
+
+# stdlib
+import math
+import time
+import struct
+import hashlib
+import threading
+import collections
+
+MISSING = object()
+"""Returned by ``LRUCache.get()`` when the key isn't in the cache."""
+
+class LRUCache(object):
+    """
+    A cache that holds at most ``max_size`` entries, each for at most ``ttl``
+    seconds. When the cache is full the least recently used entry is evicted
+    to make room for a new one.
+
+    The cache is safe to share between threads. It is not shared between
+    processes, so entries changed by another process can be stale for up to
+    ``ttl`` seconds.
+
+    """
+
+    VERSION_SLOTS = 256
+    """How many version counters the keys are spread over."""
+
+    def __init__(self, max_size, ttl):
+        """
+        :param max_size: The most entries the cache will hold.
+        :param ttl: How long, in seconds, an entry stays valid after being
+            stored.
+
+        """
+
+        self.max_size = max_size
+        self.ttl = ttl
+
+        # Maps each key to a (expires_at, value) tuple. The least recently
+        # used key is always first.
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        # Bumped whenever a key that hashes to the slot is invalidated, see
+        # version(). A fixed number of slots keeps this from growing with the
+        # number of keys, at the cost of a fill occasionally being skipped
+        # because some other key was invalidated.
+        self._versions = [0] * self.VERSION_SLOTS
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """
+        Returns the value stored for ``key``, or ``MISSING`` if there is no
+        valid entry for it. Note that ``None`` is a perfectly good value to
+        cache.
+
+        """
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return MISSING
+
+            expires_at, value = entry
+            if expires_at <= time.time():
+                self.expirations += 1
+                self.misses += 1
+                return MISSING
+
+            # Putting the entry back moves it to the end, marking it as the
+            # most recently used.
+            self._entries[key] = entry
+            self.hits += 1
+            return value
+
+    def version(self, key):
+        """
+        Returns a number that changes whenever ``key`` is invalidated. Take
+        it before looking up the value to store, and pass it to ``put()``, so
+        that a value read before an invalidation isn't stored after it.
+
+        """
+
+        return self._versions[hash(key) % self.VERSION_SLOTS]
+
+    def put(self, key, value, version = None):
+        """
+        Stores ``value`` for ``key``.
+
+        :param version: What ``version()`` returned before ``value`` was
+            looked up. If ``key`` has been invalidated since, nothing is
+            stored.
+
+        :returns: Whether the value was stored.
+
+        """
+
+        with self._lock:
+            if version is not None and version != self.version(key):
+                return False
+
+            self._entries.pop(key, None)
+            while len(self._entries) >= self.max_size:
+                self._entries.popitem(last = False)
+                self.evictions += 1
+
+            self._entries[key] = (time.time() + self.ttl, value)
+            return True
+
+    def invalidate(self, key):
+        """Forgets anything stored for ``key``."""
+
+        with self._lock:
+            self._versions[hash(key) % self.VERSION_SLOTS] += 1
+            if self._entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def resize(self, max_size, ttl):
+        """
+        Changes the size and TTL of the cache. Entries beyond the new size are
+        evicted, least recently used first. Entries already in the cache keep
+        the expiry time they were stored with.
+
+        """
+
+        with self._lock:
+            self.max_size = max_size
+            self.ttl = ttl
+            while len(self._entries) > max_size:
+                self._entries.popitem(last = False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._versions = [i + 1 for i in self._versions]
+            self._entries.clear()
+
+    def stats(self):
+        """Returns a dictionary with the cache's counters and size."""
+
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations
+            }
+
+class BloomFilter(object):
+    """
+    A compact set that can say for certain that a key is *not* in it, but can
+    only say that a key *might* be in it. In exchange it takes about 10 bits
+    per key (for a 1% chance of being wrong) no matter how long the keys are,
+    and keys can't be removed.
+
+    Adding keys is safe to do from several threads at once.
+
+    See http://en.wikipedia.org/wiki/Bloom_filter for how this works.
+
+    """
+
+    def __init__(self, capacity, error_rate = 0.01):
+        """
+        :param capacity: How many keys the filter is sized for. More keys can
+            be added, but the chance of a wrong "maybe" grows as they are.
+        :param error_rate: The chance that a key that was never added is
+            reported as maybe being in the filter, once ``capacity`` keys have
+            been added.
+
+        """
+
+        capacity = max(capacity, 1)
+        self.capacity = capacity
+        self.error_rate = error_rate
+
+        # The number of bits and of hash functions that give the lowest error
+        # rate for a filter of this capacity.
+        self.bit_count = int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, int(round(
+            float(self.bit_count) / capacity * math.log(2))))
+
+        self._bits = bytearray((self.bit_count + 7) // 8)
+        self._lock = threading.Lock()
+
+        self.count = 0
+
+    def _positions(self, key):
+        if isinstance(key, unicode):
+            key = key.encode("utf_8")
+
+        # Rather than hash_count separate hash functions, we combine two
+        # halves of one hash, which works just as well (see "Less Hashing,
+        # Same Performance" by Kirsch and Mitzenmacher).
+        first, second = struct.unpack("<QQ", hashlib.md5(key).digest())
+        for i in xrange(self.hash_count):
+            yield (first + i * second) % self.bit_count
+
+    def add(self, key):
+        positions = list(self._positions(key))
+        with self._lock:
+            for i in positions:
+                self._bits[i >> 3] |= 1 << (i & 7)
+            self.count += 1
+
+    def __contains__(self, key):
+        """
+        Returns ``False`` if ``key`` was definitely never added, ``True`` if
+        it might have been.
+
+        """
+
+        bits = self._bits
+        for i in self._positions(key):
+            if not bits[i >> 3] & (1 << (i & 7)):
+                return False
+
+        return True
+
+    def stats(self):
+        return {"count": self.count, "capacity": self.capacity,
+            "bits": self.bit_count}
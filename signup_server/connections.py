@@ -0,0 +1,231 @@
+"""
+Hands out SQLite connections to the rest of the application.
+
+A ``sqlite3.Connection`` can only be used by the thread that created it, so
+rather than sharing one connection between everyone we give each thread its
+own. Each thread also gets a separate read-only connection for requests that
+never write. With the database in WAL mode those readers don't wait on (or
+block) whoever is currently writing, so lookups scale with the number of
+threads and processes serving requests.
+
+"""
+
+# stdlib
+import os
+import sqlite3
+import weakref
+import logging
+import threading
+
+log = logging.getLogger("rock.connections")
+
+JOURNAL_MODES = ("DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF")
+"""The values the ``journal_mode`` configuration option can take."""
+
+SYNCHRONOUS_MODES = ("OFF", "NORMAL", "FULL", "EXTRA")
+"""The values the ``synchronous`` configuration option can take."""
+
+class Connection(sqlite3.Connection):
+    """
+    A plain ``sqlite3.Connection``, which can't be weakly referenced unless
+    it's subclassed.
+
+    """
+
+def check_synchronous(synchronous):
+    synchronous = synchronous.upper()
+    if synchronous not in SYNCHRONOUS_MODES:
+        raise ValueError("unknown synchronous mode {}".format(
+            repr(synchronous)))
+
+    return synchronous
+
+class ConnectionManager(object):
+    """
+    Keeps one writable and one read-only connection per thread.
+
+    Connections are created the first time a thread asks for them and live as
+    long as the thread does. If the process forks, the child will not reuse
+    any of its parent's connections (SQLite connections must never cross a
+    fork).
+
+    """
+
+    def __init__(self, db_file, busy_timeout = 5000, synchronous = "NORMAL",
+            journal_mode = "WAL", cached_statements = 128, profiler = None):
+        """
+        :param db_file: The path of the SQLite database.
+        :param busy_timeout: How long, in milliseconds, a connection will
+            wait for another connection's lock to be released before failing
+            with ``database is locked``.
+        :param synchronous: The value of SQLite's ``synchronous`` pragma, see
+            http://www.sqlite.org/pragma.html#pragma_synchronous. ``NORMAL``
+            is safe in WAL mode and only syncs on checkpoints.
+        :param journal_mode: The value of SQLite's ``journal_mode`` pragma.
+            This is a property of the database file rather than of a
+            connection so it is set once, here.
+        :param cached_statements: How many compiled statements each
+            connection keeps. This should be at least the number of distinct
+            statements the application runs (the models compile a fixed set of
+            them, see ``database.BaseModel._compile_statements()``), otherwise
+            hot statements get recompiled on every use.
+        :param profiler: A ``database.StatementProfiler`` to time every
+            statement run through our connections, or ``None``.
+
+        """
+
+        # These end up in PRAGMA statements (which can't take parameters) so
+        # only let through values we know about.
+        synchronous = check_synchronous(synchronous)
+        journal_mode = journal_mode.upper()
+        if journal_mode not in JOURNAL_MODES:
+            raise ValueError("unknown journal mode {}".format(
+                repr(journal_mode)))
+
+        self.db_file = db_file
+        self.busy_timeout = busy_timeout
+        self.synchronous = synchronous
+        self.journal_mode = journal_mode
+        self.cached_statements = cached_statements
+        self.profiler = profiler
+
+        self._local = threading.local()
+
+        # Bumped by reconfigure(). Each thread remembers the generation its
+        # connections were made in and makes new ones when it's out of date.
+        self._generation = 0
+
+        # Every connection we've handed out that's still open, so that close()
+        # can get to them regardless of which thread created them. The
+        # references are weak: when a thread exits its connections are
+        # closed and dropped from here, which matters when every request
+        # gets a thread of its own.
+        self._all_connections = weakref.WeakSet()
+        self._all_connections_lock = threading.Lock()
+
+        # Switching into (or out of) WAL mode needs a connection that isn't in
+        # the middle of a transaction and will stick for every connection
+        # made afterwards.
+        actual_mode = self.writer().execute(
+            "PRAGMA journal_mode = {};".format(journal_mode)).fetchone()[0]
+        if actual_mode.upper() != journal_mode:
+            log.warning("Could not set journal mode to %r, it is %r.",
+                journal_mode, actual_mode)
+
+    def _get_connections(self):
+        # threading.local survives a fork in the thread that called fork(),
+        # so make sure we're not looking at connections from our parent.
+        pid = os.getpid()
+        if getattr(self._local, "pid", None) != pid:
+            self._local.pid = pid
+            self._local.generation = self._generation
+            self._local.connections = {}
+        elif self._local.generation != self._generation:
+            # Our connections were made with settings that have since
+            # changed. We only let go of them rather than closing them: this
+            # thread may still be using one for the request it's handling, and
+            # they'll be closed once nothing refers to them anymore.
+            self._local.generation = self._generation
+            self._local.connections = {}
+
+        return self._local.connections
+
+    def _connect(self, read_only):
+        # We set the isolation_level to None here in order to disable
+        # automatic transactions. See
+        # http://johncs.com/posts/1-sqlite3_transactions.htm for more
+        # information on this behavior.
+        if self.profiler is not None:
+            factory = self.profiler.connection_factory()
+        else:
+            factory = Connection
+        db = sqlite3.connect(self.db_file,
+            timeout = self.busy_timeout / 1000.0,
+            isolation_level = None,
+            cached_statements = self.cached_statements,
+            factory = factory)
+
+        db.execute("PRAGMA synchronous = {};".format(self.synchronous))
+
+        # Without this, a row replaced by INSERT OR REPLACE is deleted without
+        # its delete triggers firing, and database.MemberStatistic would go on
+        # counting the old row.
+        db.execute("PRAGMA recursive_triggers = ON;")
+
+        # Any attempt to write through a read-only connection will fail with
+        # an OperationalError rather than quietly taking the write lock.
+        if read_only:
+            db.execute("PRAGMA query_only = ON;")
+
+        with self._all_connections_lock:
+            self._all_connections.add(db)
+
+        return db
+
+    def _get(self, read_only):
+        connections = self._get_connections()
+        if read_only not in connections:
+            connections[read_only] = self._connect(read_only)
+
+        return connections[read_only]
+
+    def writer(self):
+        """Returns this thread's connection for reading and writing."""
+
+        return self._get(False)
+
+    def reader(self):
+        """Returns this thread's read-only connection."""
+
+        return self._get(True)
+
+    def reconfigure(self, busy_timeout, synchronous, cached_statements):
+        """
+        Changes the settings new connections are made with. Each thread
+        switches over to new connections the next time it asks for one, so
+        no request is interrupted. See ``__init__()`` for the parameters.
+
+        """
+
+        self.busy_timeout = busy_timeout
+        self.synchronous = check_synchronous(synchronous)
+        self.cached_statements = cached_statements
+        self._generation += 1
+
+    def close(self):
+        """
+        Closes every connection this manager has handed out. Only call this
+        once nothing else is using the database.
+
+        """
+
+        with self._all_connections_lock:
+            connections = list(self._all_connections)
+            self._all_connections = weakref.WeakSet()
+
+        for i in connections:
+            try:
+                i.close()
+            except sqlite3.ProgrammingError:
+                # The connection belongs to another thread. It will be closed
+                # when it is garbage collected.
+                pass
+
+        self._local = threading.local()
+
+def create_manager(config, profiler = None):
+    """
+    Creates the connection manager described by the configuration.
+
+    :param config: The dictionary of options from the ``[rock]`` section of
+        the configuration file.
+    :param profiler: Passed along to ``ConnectionManager``.
+
+    """
+
+    return ConnectionManager(config["db_file"],
+        busy_timeout = int(config.get("busy_timeout_ms", "5000")),
+        synchronous = config.get("synchronous", "NORMAL"),
+        journal_mode = config.get("journal_mode", "WAL"),
+        cached_statements = int(config.get("cached_statements", "128")),
+        profiler = profiler)
@@ -1,13 +1,150 @@
 # stdlib
 import collections
-import logging
 import datetime
-import calendar
+import itertools
+import logging
+import re
+import sys
+import sqlite3
+import threading
+import time
 
 log = logging.getLogger("rock.database")
 
-Column = collections.namedtuple("Column", ["name", "affinity", "constraint"])
-"""Definition of a column in a table."""
+Column = collections.namedtuple("Column",
+    ["name", "affinity", "constraint", "index", "adapter"])
+"""
+Definition of a column in a table. If ``index`` is true the column gets an
+index, see ``BaseModel.create_indexes()``. It may also be an SQL expression,
+in which case only the rows it's true for are indexed (a partial index).
+
+If ``adapter`` is given, it converts the column's values between what our
+code works with and what is stored in the database, see ``EpochSeconds``.
+
+"""
+
+# Most columns aren't indexed and store their values as they are
+Column.__new__.__defaults__ = (False, None)
+
+class EpochSeconds(object):
+    """
+    A column adapter that stores ``datetime.datetime`` objects (in local
+    time, like ``datetime.datetime.now()`` returns) as the whole number of
+    seconds since the unix epoch. Fractions of a second are dropped.
+
+    An integer takes up to 8 bytes where sqlite3's own datetime adapter
+    stores 26 characters of text, and integers compare without any parsing.
+    Text written by sqlite3's adapter can still be read, so rows that
+    haven't been rewritten yet (see ``BaseModel.convert_rows()``) work too.
+
+    """
+
+    TEXT_FORMATS = ("%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d")
+    """The forms sqlite3 writes datetimes (and dates) in."""
+
+    def to_sql(self, value):
+        if isinstance(value, datetime.datetime):
+            return int(time.mktime(value.timetuple()))
+
+        return value
+
+    def from_sql(self, value):
+        if value is None or isinstance(value, datetime.datetime):
+            return value
+        if isinstance(value, (int, long, float)):
+            return datetime.datetime.fromtimestamp(value)
+
+        for i in self.TEXT_FORMATS:
+            try:
+                return datetime.datetime.strptime(value, i)
+            except ValueError:
+                pass
+
+        raise ValueError("unknown datetime format {}".format(repr(value)))
+
+    def to_text(self, value):
+        """
+        Returns ``value`` the way sqlite3's adapter would have stored it as
+        text, for comparing with rows that haven't been converted yet.
+        Midnight is written as just the date, which sorts at or before every
+        time (and the bare date) of that day.
+
+        """
+
+        text = value.isoformat(" ")
+        if text.endswith(" 00:00:00"):
+            text = text[:-len(" 00:00:00")]
+
+        return text
+
+EPOCH_SECONDS = EpochSeconds()
+
+MODELS = []
+"""
+Every model class with a ``table_name``, in the order they were defined. This
+is filled in automatically by ``ModelMeta`` and is what
+``initialize_schema()`` works through.
+
+"""
+
+_change_listeners = []
+
+def add_change_listener(listener):
+    """
+    Registers a function to be called as ``listener(model, key)`` whenever a
+    row is added or changed through the models in this module, after the
+    change has been committed. ``model`` is the model class and ``key`` is
+    the row's primary key. This is how in-memory caches of the database are
+    kept up to date.
+
+    """
+
+    if listener not in _change_listeners:
+        _change_listeners.append(listener)
+
+def notify_change(model, key):
+    for i in _change_listeners:
+        i(model, key)
+
+class ModelMeta(type):
+    """
+    The metaclass of ``BaseModel``. It records every model class in
+    ``MODELS`` so that the schema can be set up in one place rather than by
+    every piece of code that touches a table.
+
+    It also gives each model a ``__slots__`` made from its columns, so model
+    objects only have room for their columns' values rather than carrying
+    around a whole ``__dict__``. That adds up when loading every member.
+
+    """
+
+    def __new__(mcs, name, bases, namespace):
+        if "columns" in namespace and "__slots__" not in namespace:
+            column_names = tuple(i.name for i in namespace["columns"])
+
+            # A slot would hide any attribute with the same name, which would
+            # be a very confusing way for a query method to break.
+            for i in column_names:
+                if i in namespace or any(hasattr(j, i) for j in bases):
+                    raise ValueError("column {} of {} clashes with an "
+                        "attribute of the same name".format(repr(i), name))
+
+            namespace["__slots__"] = column_names
+
+        return super(ModelMeta, mcs).__new__(mcs, name, bases, namespace)
+
+    def __init__(cls, name, bases, namespace):
+        super(ModelMeta, cls).__init__(name, bases, namespace)
+
+        # Every model gets its own cache of SQL statements, see
+        # BaseModel._statement().
+        cls._statements = {}
+
+        # BaseModel itself (and any other abstract helper classes) won't have
+        # a table.
+        if cls.table_name is not None:
+            MODELS.append(cls)
+            cls._compile_statements()
 
 class BaseModel(object):
     """
@@ -18,6 +155,11 @@ class BaseModel(object):
 
     """
 
+    __metaclass__ = ModelMeta
+
+    # Subclasses get slots for their columns, see ModelMeta
+    __slots__ = ()
+
     table_name = None
     """
     The name of the table in the sqlite database that contains object of this
@@ -58,7 +200,7 @@ class BaseModel(object):
         super(BaseModel, self).__init__()
 
     @classmethod
-    def create_table(cls, db):
+    def create_table(cls, db, verify = True):
         """
         Creates a table in the database for this model if it does not exist.
         An exception will be raised if the table already esists but does not
@@ -67,18 +209,66 @@ class BaseModel(object):
         Note that this does not check the constraints of the table to verify
         that they match.
 
+        :param verify: If ``False`` an existing table with other columns than
+            we expect is left alone (and isn't indexed) rather than raising an
+            exception, so that ``upgrade_table()`` can deal with it.
+
+        """
+
+        # Create the table if it doesn't already exist
+        db.execute("CREATE TABLE IF NOT EXISTS {} ({});".format(cls.table_name,
+            cls.columns_definition()))
+        db.commit()
+
+        if not cls.table_matches(db):
+            if verify:
+                raise RuntimeError("table is not as expected")
+
+            # The indexes may be on columns the table doesn't have yet, they
+            # are created once the table has been upgraded.
+            return
+
+        cls.create_indexes(db)
+
+    @classmethod
+    def create_indexes(cls, db):
+        """
+        Creates an index named ``<table name>_<column name>`` for each column
+        with ``index`` set, if it does not exist already.
+
+        """
+
+        for i in cls.columns:
+            if not i.index:
+                continue
+
+            query = "CREATE INDEX IF NOT EXISTS {0}_{1} ON {0} ({1})".format(
+                cls.table_name, i.name)
+            if i.index is not True:
+                query += " WHERE {}".format(i.index)
+            db.execute(query + ";")
+        db.commit()
+
+    @classmethod
+    def columns_definition(cls):
+        """
+        Returns the column definitions used to create this model's table.
+
         """
 
         # This will end up looking something like
         # "joined DATE, email TEXT PRIMARY KEY". This is a list comprehenion.
-        columns_definition = ", ".join([
+        return ", ".join([
             "{} {} {}".format(i.name, i.affinity, i.constraint)
                 for i in cls.columns])
 
-        # Create the table if it doesn't already exist
-        db.execute("CREATE TABLE IF NOT EXISTS {} ({});".format(cls.table_name,
-            columns_definition))
-        db.commit()
+    @classmethod
+    def table_matches(cls, db):
+        """
+        Returns ``True`` if this model's table has exactly the columns we
+        expect it to, ``False`` otherwise.
+
+        """
 
         # Verify that the table has exactly the right columns. The PRAGMA
         # table_info query will give us a list of tuples. For information on
@@ -88,7 +278,7 @@ class BaseModel(object):
         column_info = list(db.execute("PRAGMA table_info({});".format(
             cls.table_name)))
         if len(column_info) != len(cls.columns):
-            raise RuntimeError("table is not as expected")
+            return False
         for i, j in zip(column_info, cls.columns):
             # Pull out the column's name and affinity from the data we received
             # from sqlite.
@@ -98,177 +288,1711 @@ class BaseModel(object):
             # Ensure that both the affinity and the name is the same as what
             # we expect.
             if column_name != j.name or column_affinity != j.affinity:
-                raise RuntimeError("table is not as expected")
+                return False
+
+        return True
+
+    @classmethod
+    def create_triggers(cls, db):
+        """
+        Creates any triggers this model uses to keep its table up to date,
+        if they don't exist already. Most models have none.
+
+        ``initialize_schema()`` calls this once every table is up to date,
+        because rebuilding a table with ``upgrade_table()`` drops the
+        triggers on it.
+
+        """
+
+    @classmethod
+    def upgrade_table(cls, db):
+        """
+        Rebuilds this model's table in place so that it has the columns we
+        expect it to. Any columns the old and new tables have in common are
+        copied over, columns that no longer exist are dropped and new columns
+        start out NULL.
+
+        This follows the procedure at
+        http://www.sqlite.org/lang_altertable.html#otheralter.
+
+        """
+
+        new_names = [i.name for i in cls.columns]
+        old_names = [i[1] for i in db.execute("PRAGMA table_info({});".format(
+            cls.table_name))]
+        common_names = ", ".join([i for i in new_names if i in old_names])
+        temp_table_name = "{}__upgrade".format(cls.table_name)
+
+        log.warning("Upgrading table %r from columns %r to %r.",
+            cls.table_name, old_names, new_names)
+
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("CREATE TABLE {} ({});".format(temp_table_name,
+                cls.columns_definition()))
+            db.execute("INSERT INTO {0} ({1}) SELECT {1} FROM {2};".format(
+                temp_table_name, common_names, cls.table_name))
+            db.execute("DROP TABLE {};".format(cls.table_name))
+            db.execute("ALTER TABLE {} RENAME TO {};".format(temp_table_name,
+                cls.table_name))
+        except:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    @classmethod
+    def _compile_statements(cls):
+        """
+        Builds the SQL statements that don't depend on any arguments once,
+        when the model class is created, so that queries don't need to format
+        strings every time they run.
+
+        """
+
+        cls._column_names = tuple(i.name for i in cls.columns)
+
+        # The functions that set each column's slot on an object, in column
+        # order. See from_row().
+        cls._column_setters = tuple(getattr(cls, i).__set__
+            for i in cls._column_names)
+
+        # The to_sql function of each column's adapter (None for columns
+        # without one), in column order. Columns with an adapter get a
+        # setter that converts what's read from the database.
+        cls._column_to_sql = tuple(i.adapter and i.adapter.to_sql
+            for i in cls.columns)
+        setters = list(cls._column_setters)
+        for index, i in enumerate(cls.columns):
+            if i.adapter is not None:
+                setters[index] = (lambda instance, value, setter =
+                    setters[index], from_sql = i.adapter.from_sql:
+                        setter(instance, from_sql(value)))
+        cls._column_setters = tuple(setters)
+        cls._primary_key = None
+        for i in cls.columns:
+            if "PRIMARY KEY" in i.constraint:
+                cls._primary_key = i.name
+
+        # We name the columns rather than using * so that rows always come
+        # back in the same order as our columns list.
+        select = "SELECT {} FROM {}".format(", ".join(cls._column_names),
+            cls.table_name)
 
-    def insert(self, db):
         # This will make a string like "INSERT INTO bla VALUES (?, ?, ?)" with
         # actual question marks. The question marks will be filled in by the
-        # execute call below which will ensure that SQL injection attacks can't
-        # occur here.
-        pre_query = "INSERT INTO {} VALUES ({});".format(self.table_name,
-            ",".join(["?"] * len(self.columns)))
+        # execute call in insert() which will ensure that SQL injection attacks
+        # can't occur here.
+        cls._insert_sql = "INSERT INTO {} VALUES ({});".format(cls.table_name,
+            ",".join(["?"] * len(cls.columns)))
+        cls._select_sql = select
+        cls._iter_all_sql = select + ";"
+        cls._count_all_sql = "SELECT COUNT(*) FROM {};".format(cls.table_name)
+
+        if cls._primary_key is not None:
+            cls._get_sql = "{} WHERE {}=?;".format(select, cls._primary_key)
+            cls._iter_keys_sql = "SELECT {} FROM {};".format(
+                cls._primary_key, cls.table_name)
+            cls._delete_sql = "DELETE FROM {} WHERE {}=?;".format(
+                cls.table_name, cls._primary_key)
+
+    @classmethod
+    def _statement(cls, kind, names, build):
+        """
+        Returns the statement of the given kind involving the given columns
+        from this model's cache, calling ``build(names)`` to create it the
+        first time it's asked for.
+
+        Column names can't be passed to SQLite as parameters so they must be
+        formatted into the statement. We only allow names of our own columns
+        here, which keeps anything a user sends us out of the SQL.
+
+        """
+
+        key = (kind, names)
+        statement = cls._statements.get(key)
+        if statement is None:
+            for i in names:
+                if i not in cls._column_names:
+                    raise ValueError("unknown column {}".format(repr(i)))
+
+            statement = cls._statements[key] = build(names)
+
+        return statement
+
+    @classmethod
+    def _where_clause(cls, names):
+        # This will look like "email=? AND name=?"
+        return " AND ".join(["{}=?".format(i) for i in names])
+
+    @classmethod
+    def insert_query(cls):
+        return cls._insert_sql
+
+    def values(self):
+        """
+        Returns a list of this object's values in the same order as
+        ``columns``, suitable for filling in ``insert_query()``.
+
+        """
 
-        # Generate the list of values we'll shove into our pre_query above
         values = []
-        for i in self.columns:
-            values.append(getattr(self, i.name))
+        for i, to_sql in itertools.izip(self.columns, self._column_to_sql):
+            value = getattr(self, i.name)
+            values.append(value if to_sql is None else to_sql(value))
 
-        # This will execute the query after first filling in all the question
-        # marks with our values. Each value will be shoved through the sqlite3
-        # module's escaping function that should prevent any nasty sql
-        # injection attacks.
-        db.execute(pre_query, values)
-        db.commit()
+        return values
 
-class Member(BaseModel):
-    """Represents a single ACM@UCR member."""
+    @classmethod
+    def sql_value(cls, name, value):
+        """
+        Converts ``value`` of the column ``name`` to what is stored in the
+        database, for use as a query parameter.
 
-    table_name = "members"
-    columns = [
-        Column("joined", "DATETIME", ""),
-        Column("email", "TEXT", "PRIMARY KEY"),
-        Column("name", "TEXT", ""),
-        Column("shirt_size", "TEXT", ""),
-        Column("paid_on", "DATETIME", "")
-    ]
+        """
 
-class RateLimiter(BaseModel):
-    table_name = "rate_limiting"
-    columns = [
-        Column("minute", "INTEGER", "PRIMARY KEY"),
-        Column("join_counter", "INTEGER", ""),
-        Column("check_counter", "INTEGER", "")
-    ]
+        to_sql = cls._column_to_sql[cls._column_names.index(name)]
+        return value if to_sql is None else to_sql(value)
 
-    def insert(self, db):
-        # Simply inserting a row into the rate limiting table might mess things
-        # up and is never what should be done.
-        raise RuntimeError("operation not supported")
+    @classmethod
+    def primary_key(cls):
+        """Returns the name of the column that is this model's primary key."""
+
+        if cls._primary_key is None:
+            raise RuntimeError("{} has no primary key".format(cls.__name__))
+
+        return cls._primary_key
 
     @classmethod
-    def try_action(cls, db, action, max_per_minute):
+    def from_row(cls, row):
         """
-        Tries to record the given action in the rate limiting table.
+        Creates a model object from a row of a query that selected our columns
+        in order.
 
-        :param db: The SQLite database as returned by ``sqlite3.connect()``.
-        :param action: The name of the action. Can be ``"check"`` or
-            ``"join"``.
-        :param max_per_minute: The maximum number of times the action should be
-            allowed to occur in a single minute.
+        The values are put straight into the object's slots. Unlike
+        ``__init__``, nothing is checked, which is fine because the row came
+        from our own table.
 
-        :returns: ``True`` if the action should be performed, ``False``
-            otherwise (the action has occurred too many times in the past
-            minute).
+        """
+
+        instance = cls.__new__(cls)
+        for setter, value in itertools.izip(cls._column_setters, row):
+            setter(instance, value)
 
+        return instance
+
+    @classmethod
+    def row_factory(cls, cursor, row):
         """
+        A row factory (see ``sqlite3.Connection.row_factory``) that makes a
+        cursor return model objects rather than tuples. The query must select
+        our columns in order.
 
-        if action == "join":
-            # What will be added to the join_counter
-            add_to_join_counter = 1
+        """
 
-            # What will be added to the check_counter
-            add_to_check_counter = 0
+        return cls.from_row(row)
 
-            # The column index of the counter we're modifying
-            counter_index = 1
-        elif action == "check":
-            add_to_join_counter = 0
-            add_to_check_counter = 1
-            counter_index = 2
-        else:
-            raise ValueError("unknown action {}".format(repr(action)))
+    @classmethod
+    def get(cls, db, key):
+        """
+        Looks up the object whose primary key is ``key``.
+
+        :returns: The object, or ``None`` if there isn't one.
 
-        # Form up the query that will atomically update the current minute's
-        # entry in the table. This operation is often called an upsert (a
-        # combination of the terms update and insert), because we will update
-        # the row for the current minute if one exists, otherwise it will
-        # a new row.
-        upsert_pre_query = """
-            INSERT OR REPLACE INTO {table_name}
-                    (minute, join_counter, check_counter) VALUES (
-                -- We'll fill in the minute here later by letting the sqlite3
-                -- module do it. Letting the module do it helps us guard
-                -- against SQL injection.
-                :minute,
-
-                -- This will add to either the current value of join_counter
-                -- (which the embedded SELECT retrieves) or set the
-                -- join_counter to whatever {add_to_join_counter} is.
-                {add_to_join_counter} + COALESCE(
-                    (SELECT join_counter FROM {table_name} WHERE
-                        minute=:minute),
-                    0
-                ),
-
-                -- This will do the same thing as above but to the
-                -- check_counter.
-                {add_to_check_counter} + COALESCE(
-                    (SELECT check_counter FROM {table_name} WHERE
-                        minute=:minute),
-                    0
-                )
-            )
         """
 
-        # Actually fill in the {bla} fields in the pre_query. We do this in two
-        # steps (rather than add .format() immediately after the strings above)
-        # because it looks prettier.
-        upsert_pre_query = upsert_pre_query.format(
-            table_name = cls.table_name,
-            add_to_check_counter = add_to_check_counter,
-            add_to_join_counter = add_to_join_counter
-        )
+        row = db.execute(cls._get_sql, (key, )).fetchone()
+        if row is None:
+            return None
 
-        # Form up the query that will delete all the minutes we're not
-        # interested in (which is any minute that has already passed). We
-        # don't know that another process hasn't added a minute that's in the
-        # future which is why we don't do a blanket not equal to.
-        delete_pre_query = "DELETE FROM {} WHERE minute<:minute".format(
-            cls.table_name)
+        return cls.from_row(row)
 
-        # Form up the query that will grab all the current minutes information
-        select_pre_query = "SELECT * FROM {} WHERE minute=:minute".format(
-            cls.table_name)
+    @classmethod
+    def filter(cls, db, **conditions):
+        """
+        Returns a list of every object whose columns are equal to the values
+        given in ``conditions``. For example
+        ``Member.filter(db, shirt_size = "Large")``.
 
-        # Get the current date and time and then strip out the second and
-        # microsecond information. Note that even though the today() function
-        # looks like it would only return a date, it does indeed also return
-        # the time. Also note that the datetime object is immutable so we can't
-        # just assign second and microsecond to 0.
-        now = datetime.datetime.today()
-        now = datetime.datetime(now.year, now.month, now.day,
-            now.hour, now.minute, 0, 0, now.tzinfo)
-
-        # Convert the time into a unix timestamp, this will be our minute
-        # value.
-        minute = calendar.timegm(now.utctimetuple())
-
-        # Start a transaction and immediately lock the database to prevent
-        # anyone else from making a write while we're working.
+        """
+
+        names = tuple(sorted(conditions))
+        if not names:
+            return list(cls.iter_all(db))
+
+        query = cls._statement("filter", names,
+            lambda names: "{} WHERE {};".format(cls._select_sql,
+                cls._where_clause(names)))
         cur = db.cursor()
-        db.execute("BEGIN IMMEDIATE")
+        cur.row_factory = cls.row_factory
+        cur.execute(query, [cls.sql_value(i, conditions[i]) for i in names])
 
-        # Execute our commands
-        cur.execute(upsert_pre_query, {"minute": minute})
-        cur.execute(delete_pre_query, {"minute": minute})
-        cur.execute(select_pre_query, {"minute": minute})
+        return cur.fetchall()
 
-        # Commit the transaction
-        cur.execute("COMMIT")
+    @classmethod
+    def count(cls, db, **conditions):
+        """
+        Returns the number of objects whose columns are equal to the values
+        given in ``conditions``, or the number of objects altogether if no
+        conditions are given.
 
-        # This should give us a single row, the row we just upserted
-        results = cur.fetchall()
-        assert len(results) == 1, "Expected 1 result, got {}.".format(
-            len(results))
+        """
 
-        # Grab our one result
-        results = results[0]
+        names = tuple(sorted(conditions))
+        if not names:
+            return db.execute(cls._count_all_sql).fetchone()[0]
 
-        log.info("Logged %r %r actions in the last minute (minute %r).",
-            results[counter_index], action, minute)
+        query = cls._statement("count", names,
+            lambda names: "SELECT COUNT(*) FROM {} WHERE {};".format(
+                cls.table_name, cls._where_clause(names)))
 
-        # Check the counter (which counter we're looking at is set at the top
-        # of this function) to ensure there hasn't been too many requests in
-        # the past minute.
-        return results[counter_index] <= max_per_minute
+        return db.execute(query,
+            [cls.sql_value(i, conditions[i]) for i in names]).fetchone()[0]
+
+    ITER_BATCH_SIZE = 500
+    """How many rows ``iter_all()`` fetches from SQLite at a time."""
+
+    @classmethod
+    def iter_all(cls, db, batch_size = None):
+        """
+        Yields every object in the table. Rows are fetched ``batch_size`` (or
+        ``ITER_BATCH_SIZE``) at a time so that memory use stays flat however
+        large the table is.
+
+        """
+
+        cur = db.cursor()
+        cur.row_factory = cls.row_factory
+        cur.execute(cls._iter_all_sql)
+
+        batch_size = batch_size or cls.ITER_BATCH_SIZE
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+
+            for i in rows:
+                yield i
+
+    @classmethod
+    def iter_keys(cls, db, batch_size = None):
+        """
+        Yields the primary key of every object in the table, fetched the same
+        way as ``iter_all()``. This only reads the table's primary key index.
+
+        """
+
+        cur = db.execute(cls._iter_keys_sql)
+
+        batch_size = batch_size or cls.ITER_BATCH_SIZE
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+
+            for i in rows:
+                yield i[0]
+
+    @classmethod
+    def convert_rows(cls, db, batch_size = None):
+        """
+        Rewrites the columns that have an adapter in every row so they hold
+        what the adapter would store today, such as turning datetimes stored
+        as text into epoch seconds.
+
+        Rows are rewritten ``batch_size`` (or ``ITER_BATCH_SIZE``) at a time,
+        each batch in its own short transaction, so that everyone else can
+        keep writing in between. Rows that are already right are left alone,
+        so if this is interrupted it can simply be run again.
+
+        Yields the number of rows rewritten by each batch.
+
+        """
+
+        names = [i.name for i in cls.columns if i.adapter is not None]
+        if not names:
+            return
+        adapters = [i.adapter for i in cls.columns if i.adapter is not None]
+
+        # We go through the table in rowid order, which lets each batch pick
+        # up right where the last one left off.
+        select = ("SELECT rowid, {} FROM {} WHERE rowid>? ORDER BY rowid "
+            "LIMIT ?;").format(", ".join(names), cls.table_name)
+        update = "UPDATE {} SET {} WHERE rowid=?;".format(cls.table_name,
+            ", ".join(["{}=?".format(i) for i in names]))
+
+        batch_size = batch_size or cls.ITER_BATCH_SIZE
+        last_rowid = float("-inf")
+        while True:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = db.execute(select, (last_rowid, batch_size)).fetchall()
+                changes = []
+                for row in rows:
+                    stored = list(row[1:])
+                    wanted = [adapter.to_sql(adapter.from_sql(value))
+                        for adapter, value in zip(adapters, stored)]
+                    if wanted != stored:
+                        changes.append(wanted + [row[0]])
+                db.executemany(update, changes)
+            except:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+
+            if not rows:
+                return
+
+            last_rowid = rows[-1][0]
+            yield len(changes)
+
+    @classmethod
+    def update(cls, db, key, **values):
+        """
+        Sets the columns given in ``values`` on the object whose primary key
+        is ``key``.
+
+        :returns: ``True`` if the object was found, ``False`` otherwise.
+
+        """
+
+        names = tuple(sorted(values))
+        cur = db.execute(cls._update_statement(names),
+            [cls.sql_value(i, values[i]) for i in names] + [key])
+        db.commit()
+
+        notify_change(cls, key)
+
+        return cur.rowcount == 1
+
+    @classmethod
+    def _update_statement(cls, names):
+        return cls._statement("update", names,
+            lambda names: "UPDATE {} SET {} WHERE {}=?;".format(
+                cls.table_name, ", ".join(["{}=?".format(i) for i in names]),
+                cls.primary_key()))
+
+    KEY_BATCH_SIZE = 500
+    """
+    How many keys ``existing_keys()`` looks up in one query. SQLite before
+    3.32 allows at most 999 parameters in a statement.
+
+    """
+
+    @classmethod
+    def existing_keys(cls, db, keys):
+        """
+        Returns the set of those ``keys`` that are the primary key of an
+        object in the table.
+
+        """
+
+        keys = list(keys)
+        found = set()
+        for start in xrange(0, len(keys), cls.KEY_BATCH_SIZE):
+            batch = keys[start:start + cls.KEY_BATCH_SIZE]
+            query = "SELECT {0} FROM {1} WHERE {0} IN ({2});".format(
+                cls.primary_key(), cls.table_name, ",".join("?" * len(batch)))
+            found.update(i[0] for i in db.execute(query, batch))
+
+        return found
+
+    @classmethod
+    def update_all(cls, db, names, changes):
+        """
+        Sets the columns ``names`` on many objects in one transaction, with a
+        single ``executemany``.
+
+        :param names: The names of the columns to set.
+        :param changes: A list of ``(key, values)`` tuples, where ``values``
+            holds a value for each of ``names``.
+
+        :returns: The set of keys that no object has. Nothing is done for
+            them, the other changes are still made.
+
+        """
+
+        names = tuple(names)
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            found = cls.existing_keys(db, [key for key, _ in changes])
+            db.executemany(cls._update_statement(names), [
+                [cls.sql_value(name, value) for name, value
+                    in zip(names, values)] + [key]
+                for key, values in changes if key in found])
+        except:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+        for key in found:
+            notify_change(cls, key)
+
+        return set(key for key, _ in changes) - found
+
+    @classmethod
+    def insert_many(cls, db, instances):
+        """
+        Inserts many objects of this model in one transaction, with a single
+        ``executemany``. Unlike ``insert_all()``, an object that can't be
+        inserted (usually because its primary key is taken) is skipped
+        rather than undoing every other insert.
+
+        :returns: A list of ``(instance, reason)`` tuples for the objects that
+            weren't inserted, where ``reason`` is a message saying why.
+
+        """
+
+        primary_key = cls.primary_key()
+        skipped = []
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            taken = cls.existing_keys(db,
+                [getattr(i, primary_key) for i in instances])
+            inserting = []
+            for i in instances:
+                key = getattr(i, primary_key)
+                if key in taken:
+                    skipped.append((i, "{} already exists".format(
+                        primary_key)))
+                else:
+                    # Later objects with the same key are duplicates too
+                    taken.add(key)
+                    inserting.append(i)
+
+            db.execute("SAVEPOINT insert_many")
+            try:
+                db.executemany(cls._insert_sql,
+                    [i.values() for i in inserting])
+            except sqlite3.IntegrityError:
+                # Some other constraint was violated, and executemany can't
+                # tell us by whom. Start over one object at a time.
+                db.execute("ROLLBACK TO insert_many")
+                remaining = inserting
+                inserting = []
+                for i in remaining:
+                    try:
+                        db.execute(cls._insert_sql, i.values())
+                    except sqlite3.IntegrityError as e:
+                        skipped.append((i, str(e)))
+                    else:
+                        inserting.append(i)
+            db.execute("RELEASE insert_many")
+        except:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+        for i in inserting:
+            notify_change(cls, getattr(i, primary_key))
+
+        return skipped
+
+    @classmethod
+    def delete(cls, db, key):
+        """
+        Deletes the object whose primary key is ``key``.
+
+        :returns: ``True`` if the object was found, ``False`` otherwise.
+
+        """
+
+        cur = db.execute(cls._delete_sql, (key, ))
+        db.commit()
+
+        notify_change(cls, key)
+
+        return cur.rowcount == 1
+
+    def insert(self, db):
+        # This will execute the query after first filling in all the question
+        # marks with our values. Each value will be shoved through the sqlite3
+        # module's escaping function that should prevent any nasty sql
+        # injection attacks.
+        db.execute(self.insert_query(), self.values())
+        db.commit()
+
+        notify_change(type(self), getattr(self, self.primary_key()))
+
+def insert_all(db, instances):
+    """
+    Inserts every one of ``instances`` (which may be of different models) in
+    a single transaction. Either all of them end up in the database or, if
+    any insert fails, none of them do.
+
+    """
+
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        for i in instances:
+            db.execute(i.insert_query(), i.values())
+    except:
+        db.execute("ROLLBACK")
+        raise
+    db.execute("COMMIT")
+
+    for i in instances:
+        notify_change(type(i), getattr(i, i.primary_key()))
+
+class Member(BaseModel):
+    """Represents a single ACM@UCR member."""
+
+    table_name = "members"
+    columns = [
+        Column("joined", "DATETIME", "", index = True,
+            adapter = EPOCH_SECONDS),
+        Column("email", "TEXT", "PRIMARY KEY"),
+        Column("name", "TEXT", ""),
+        Column("shirt_size", "TEXT", "", index = True),
+        Column("paid_on", "DATETIME", "", index = True,
+            adapter = EPOCH_SECONDS)
+    ]
+
+    @classmethod
+    def set_paid_on(cls, db, email, paid_on):
+        """
+        Records when the member with the given email paid their dues. Give
+        ``None`` for ``paid_on`` to mark them as not having paid.
+
+        :returns: ``True`` if the member was found, ``False`` otherwise.
+
+        """
+
+        return cls.update(db, email, paid_on = paid_on)
+
+    @classmethod
+    def search(cls, db, joined_from = None, joined_until = None, paid = None,
+            shirt_size = None, after = None, limit = None, page_keys = False):
+        """
+        Finds the members matching every filter that is given, in the order
+        they joined.
+
+        Members whose join time is still stored as text (see migration 3)
+        come after everyone else, in the order they joined, until
+        ``manage.py convert-timestamps`` has rewritten them. SQLite sorts
+        text after every number, and the ``joined`` index is in that order.
+
+        :param joined_from: Only members who joined at or after this time.
+        :param joined_until: Only members who joined before this time.
+        :param paid: ``True`` for only members who have paid their dues,
+            ``False`` for only those who haven't.
+        :param shirt_size: Only members who asked for this shirt size.
+        :param after: The page key of the last member of the previous page,
+            to get the members that come after it. Unlike an OFFSET, which
+            has SQLite step over every earlier member, this jumps straight to
+            the right place in the ``joined`` index.
+        :param limit: The most members to return.
+        :param page_keys: If ``True``, the cursor returns ``(member, page
+            key)`` tuples rather than just members. The page key holds the
+            member's join time as it is stored, which is what ``after``
+            must be given.
+
+        :returns: A cursor that returns ``Member`` objects. Use ``fetchmany``
+            to go through a large number of them.
+
+        """
+
+        conditions = []
+        parameters = []
+        if joined_from is not None or joined_until is not None:
+            # Times stored as numbers and times stored as text each need a
+            # range of their own. Every number sorts before the empty string,
+            # and every string before an empty blob.
+            conditions.append(
+                "((joined>=? AND joined<?) OR (joined>=? AND joined<?))")
+            parameters.extend([
+                float("-inf") if joined_from is None
+                    else cls.sql_value("joined", joined_from),
+                u"" if joined_until is None
+                    else cls.sql_value("joined", joined_until),
+                u"" if joined_from is None
+                    else EPOCH_SECONDS.to_text(joined_from),
+                buffer("") if joined_until is None
+                    else EPOCH_SECONDS.to_text(joined_until)
+            ])
+        if paid is not None:
+            conditions.append("paid_on IS NOT NULL" if paid
+                else "paid_on IS NULL")
+        if shirt_size is not None:
+            conditions.append("shirt_size=?")
+            parameters.append(shirt_size)
+        if after is not None:
+            # This is (joined, email) > after, written so that SQLite can see
+            # it may start from the after's place in the index.
+            conditions.append("joined>=? AND (joined>? OR email>?)")
+            parameters.extend([after[0], after[0], after[1]])
+
+        if page_keys:
+            # The join time as it's stored comes along after our columns,
+            # since the adapter can't tell us whether it was text.
+            query = "SELECT {}, joined, email FROM {}".format(
+                ", ".join(cls._column_names), cls.table_name)
+            row_factory = lambda cursor, row: (cls.from_row(row),
+                tuple(row[-2:]))
+        else:
+            query = cls._select_sql
+            row_factory = cls.row_factory
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY joined, email"
+        if limit is not None:
+            query += " LIMIT ?"
+            parameters.append(limit)
+
+        cur = db.cursor()
+        cur.row_factory = row_factory
+        cur.execute(query + ";", parameters)
+
+        return cur
+
+class MemberStatistic(BaseModel):
+    """
+    Counts of members, kept up to date by triggers on the ``members`` table
+    so that reading them doesn't mean going through every member. Each
+    statistic is named after what it counts:
+
+    * ``total``: Every member.
+    * ``paid`` and ``unpaid``: Members who have and haven't paid their dues.
+    * ``joined:<day>``: Members who joined on a day, like 2014-09-30.
+    * ``shirt_size:<size>``: Members who asked for a shirt size.
+
+    Counts that drop to zero are kept rather than deleted. Changes made
+    without going through ``connections.ConnectionManager`` (say, by hand
+    with the ``sqlite3`` shell) are counted too, except for rows replaced by
+    ``INSERT OR REPLACE`` without ``PRAGMA recursive_triggers`` on. Run
+    ``manage.py check-stats`` to see if the counts have drifted.
+
+    """
+
+    table_name = "member_statistics"
+    columns = [
+        Column("name", "TEXT", "PRIMARY KEY"),
+        Column("value", "INTEGER", "NOT NULL")
+    ]
+
+    # The names of the statistics a member counts towards, as SQL
+    # expressions of the member's row. The trigger below fills in whether
+    # that's the NEW or OLD row.
+    _NAME_EXPRESSIONS = (
+        "'total'",
+        "CASE WHEN {row}.paid_on IS NULL THEN 'unpaid' ELSE 'paid' END",
+        # Members who joined before migration 3 may still have their join
+        # time stored as text rather than as epoch seconds.
+        """'joined:' || COALESCE(CASE typeof({row}.joined)
+            WHEN 'integer' THEN date({row}.joined, 'unixepoch', 'localtime')
+            ELSE date({row}.joined) END, '')""",
+        "'shirt_size:' || COALESCE({row}.shirt_size, '')"
+    )
+
+    def insert(self, db):
+        # The triggers own this table
+        raise RuntimeError("operation not supported")
+
+    @classmethod
+    def _count_sql(cls, row, change):
+        """
+        Returns the statements that add ``change`` to the statistics the
+        member in ``row`` counts towards.
+
+        """
+
+        names = [i.format(row = row) for i in cls._NAME_EXPRESSIONS]
+
+        # We don't use INSERT OR IGNORE here because a statement that sets
+        # its own conflict resolution (like INSERT OR REPLACE INTO members)
+        # would have it override ours.
+        statements = ["""
+            INSERT INTO member_statistics (name, value) SELECT {0}, 0
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM member_statistics WHERE name={0});
+        """.format(i) for i in names]
+        statements.append("""
+            UPDATE member_statistics SET value=value + {} WHERE name IN ({});
+        """.format(change, ", ".join(names)))
+
+        return "".join(statements)
+
+    @classmethod
+    def create_triggers(cls, db):
+        db.execute("""
+            CREATE TRIGGER IF NOT EXISTS member_statistics_insert
+                AFTER INSERT ON members
+            BEGIN {} END;
+        """.format(cls._count_sql("NEW", 1)))
+        db.execute("""
+            CREATE TRIGGER IF NOT EXISTS member_statistics_delete
+                AFTER DELETE ON members
+            BEGIN {} END;
+        """.format(cls._count_sql("OLD", -1)))
+        db.execute("""
+            CREATE TRIGGER IF NOT EXISTS member_statistics_update
+                AFTER UPDATE OF joined, shirt_size, paid_on ON members
+            BEGIN {} {} END;
+        """.format(cls._count_sql("OLD", -1), cls._count_sql("NEW", 1)))
+
+    @classmethod
+    def _count_from_scratch(cls, db):
+        """
+        Yields ``(name, value)`` for every statistic, counted by going
+        through every member.
+
+        """
+
+        names = [i.format(row = "members") for i in cls._NAME_EXPRESSIONS]
+        for name in names:
+            cur = db.execute("""
+                SELECT {0}, COUNT(*) FROM members GROUP BY {0};
+            """.format(name))
+            for i in cur:
+                yield i
+
+    @classmethod
+    def recount(cls, db):
+        """
+        Throws away the statistics and counts them again from scratch. This
+        must be run inside a transaction.
+
+        """
+
+        db.execute("DELETE FROM member_statistics;")
+        db.executemany(
+            "INSERT INTO member_statistics (name, value) VALUES (?, ?);",
+            list(cls._count_from_scratch(db)))
+
+        # Even an empty table has a total
+        db.execute("""
+            INSERT INTO member_statistics (name, value) SELECT 'total', 0
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM member_statistics WHERE name='total');
+        """)
+
+    @classmethod
+    def find_drift(cls, db):
+        """
+        Compares the statistics with counts made from scratch.
+
+        :returns: A list of ``(name, stored, counted)`` tuples for every
+            statistic that is wrong, which is hopefully none of them.
+
+        """
+
+        # Both counts must see the same members, so they're done in one
+        # transaction.
+        db.execute("BEGIN")
+        try:
+            stored = dict((i.name, i.value) for i in cls.iter_all(db))
+            counted = dict(cls._count_from_scratch(db))
+        finally:
+            db.execute("ROLLBACK")
+
+        drift = []
+        for name in sorted(set(stored) | set(counted)):
+            if stored.get(name, 0) != counted.get(name, 0):
+                drift.append((name, stored.get(name), counted.get(name, 0)))
+
+        return drift
+
+    @classmethod
+    def get_all(cls, db):
+        """
+        Returns a dictionary of the statistics. Counts of days and shirt
+        sizes that have dropped to zero are left out.
+
+        """
+
+        result = {"total": 0, "paid": 0, "unpaid": 0, "joined": {},
+            "shirt_size": {}}
+        for i in cls.iter_all(db):
+            kind, separator, key = i.name.partition(":")
+            if not separator:
+                result[kind] = i.value
+            elif i.value:
+                result[kind][key] = i.value
+
+        return result
+
+class RateLimiter(BaseModel):
+    """
+    Counts the actions made site-wide within a sliding window of
+    ``WINDOW_SECONDS``.
+
+    The window is split into buckets of a few seconds each, and the table is a
+    fixed ring of slots with one row per bucket in the window. The bucket
+    starting at ``bucket_start`` lives in slot ``bucket_start //
+    bucket_seconds % slots``, so once a bucket falls out of the window its
+    slot gets reused by a new bucket, and its counters are reset then. This
+    means the table never grows and nothing ever has to be deleted from it.
+
+    """
+
+    table_name = "rate_limiting"
+    columns = [
+        Column("slot", "INTEGER", "PRIMARY KEY"),
+        Column("bucket_start", "INTEGER", ""),
+        Column("join_counter", "INTEGER", ""),
+        Column("check_counter", "INTEGER", "")
+    ]
+
+    WINDOW_SECONDS = 60
+    """How far back, in seconds, actions are counted."""
+
+    USE_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+    """
+    Whether our SQLite supports ``RETURNING``, which lets ``try_action()``
+    record an action and count the actions in the window in one statement.
+
+    """
+
+    def insert(self, db):
+        # Simply inserting a row into the rate limiting table might mess things
+        # up and is never what should be done.
+        raise RuntimeError("operation not supported")
+
+    _try_action_statements = {}
+    """
+    Maps each action to the statements ``try_action()`` runs for it, see
+    ``_get_try_action_statements()``.
+
+    """
+
+    @classmethod
+    def _get_try_action_statements(cls, action):
+        """
+        Returns a tuple of the upsert and select statements that
+        ``try_action()`` runs for the given action. If ``USE_RETURNING`` is
+        true the upsert returns the count itself and the select is ``None``.
+        The statements are only built the first time each action is seen.
+
+        """
+
+        statements = cls._try_action_statements.get(action)
+        if statements is not None:
+            return statements
+
+        if action == "join":
+            # What will be added to the join_counter
+            add_to_join_counter = 1
+
+            # What will be added to the check_counter
+            add_to_check_counter = 0
+        elif action == "check":
+            add_to_join_counter = 0
+            add_to_check_counter = 1
+        else:
+            raise ValueError("unknown action {}".format(repr(action)))
+
+        # The sum of the action's counters in every bucket of the window,
+        # except the current one. Buckets from the future (which are only
+        # there if the clock was turned back) don't count.
+        others_query = """
+            SELECT COALESCE(SUM({action}_counter), 0) FROM {table_name}
+                WHERE slot!=:slot AND bucket_start>:window_start AND
+                    bucket_start<:bucket_start
+        """
+
+        if cls.USE_RETURNING:
+            # Form up the query that will atomically update the current
+            # bucket's slot in the table. This operation is often called an
+            # upsert (a combination of the terms update and insert), because
+            # we will update the slot if it has a row, otherwise it will
+            # insert one. Note that the SET expressions all see the row as it
+            # was before the update.
+            upsert_pre_query = """
+                INSERT INTO {table_name}
+                        (slot, bucket_start, join_counter, check_counter)
+                    VALUES (:slot, :bucket_start, {add_to_join_counter},
+                        {add_to_check_counter})
+                ON CONFLICT (slot) DO UPDATE SET
+                    -- If the slot still holds a bucket that has left the
+                    -- window, this is where its counters get reset.
+                    join_counter = CASE
+                        WHEN bucket_start=excluded.bucket_start
+                            THEN join_counter + excluded.join_counter
+                        ELSE excluded.join_counter END,
+                    check_counter = CASE
+                        WHEN bucket_start=excluded.bucket_start
+                            THEN check_counter + excluded.check_counter
+                        ELSE excluded.check_counter END,
+                    bucket_start = excluded.bucket_start
+
+                -- Other slots aren't touched by this statement so it doesn't
+                -- matter whether the subquery sees them before or after the
+                -- update.
+                RETURNING {action}_counter + ({others_query})
+            """
+            select_pre_query = None
+        else:
+            # Without RETURNING (SQLite older than 3.35), and without the
+            # ON CONFLICT clause on anything older than 3.24, we replace the
+            # slot's row with the new counters and count separately.
+            upsert_pre_query = """
+                INSERT OR REPLACE INTO {table_name}
+                        (slot, bucket_start, join_counter, check_counter)
+                    VALUES (:slot, :bucket_start,
+                        -- The embedded SELECTs only find the slot's counters
+                        -- if they belong to the current bucket, so a reused
+                        -- slot starts over from zero.
+                        {add_to_join_counter} + COALESCE(
+                            (SELECT join_counter FROM {table_name} WHERE
+                                slot=:slot AND bucket_start=:bucket_start),
+                            0
+                        ),
+                        {add_to_check_counter} + COALESCE(
+                            (SELECT check_counter FROM {table_name} WHERE
+                                slot=:slot AND bucket_start=:bucket_start),
+                            0
+                        )
+                    )
+            """
+            select_pre_query = """
+                SELECT {action}_counter + ({others_query}) FROM {table_name}
+                    WHERE slot=:slot
+            """.format(action = action, table_name = cls.table_name,
+                others_query = others_query)
+
+        # Actually fill in the {bla} fields in the pre_query. We do this in two
+        # steps (rather than add .format() immediately after the strings above)
+        # because it looks prettier.
+        others_query = others_query.format(action = action,
+            table_name = cls.table_name)
+        upsert_pre_query = upsert_pre_query.format(
+            table_name = cls.table_name,
+            action = action,
+            others_query = others_query,
+            add_to_check_counter = add_to_check_counter,
+            add_to_join_counter = add_to_join_counter
+        )
+        if select_pre_query is not None:
+            select_pre_query = select_pre_query.format(action = action,
+                table_name = cls.table_name, others_query = others_query)
+
+        statements = cls._try_action_statements[action] = (upsert_pre_query,
+            select_pre_query)
+
+        return statements
+
+    @classmethod
+    def try_action(cls, db, action, max_per_minute, bucket_seconds = 10):
+        """
+        Tries to record the given action in the rate limiting table.
+
+        :param db: The SQLite database as returned by ``sqlite3.connect()``.
+        :param action: The name of the action. Can be ``"check"`` or
+            ``"join"``.
+        :param max_per_minute: The maximum number of times the action should be
+            allowed to occur within ``WINDOW_SECONDS``.
+        :param bucket_seconds: The width of each bucket. Narrower buckets make
+            the window slide more smoothly. Must divide ``WINDOW_SECONDS``.
+
+        :returns: ``True`` if the action should be performed, ``False``
+            otherwise (the action has occurred too many times in the past
+            minute).
+
+        """
+
+        upsert_pre_query, select_pre_query = cls._get_try_action_statements(
+            action)
+
+        # Round the current unix timestamp down to the start of its bucket
+        # and figure out which slot of the ring that bucket goes in.
+        slots = cls.WINDOW_SECONDS // bucket_seconds
+        bucket_start = int(time.time()) // bucket_seconds * bucket_seconds
+        parameters = {
+            "slot": bucket_start // bucket_seconds % slots,
+            "bucket_start": bucket_start,
+            "window_start": bucket_start - cls.WINDOW_SECONDS
+        }
+
+        if select_pre_query is None:
+            # A single statement is atomic on its own, so there's no need for
+            # a transaction. We must fetch every row so that the statement
+            # finishes, and with it the implicit transaction around it.
+            results = db.execute(upsert_pre_query, parameters).fetchall()
+        else:
+            # Start a transaction and immediately lock the database to prevent
+            # anyone else from making a write while we're working.
+            cur = db.cursor()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                cur.execute(upsert_pre_query, parameters)
+                cur.execute(select_pre_query, parameters)
+
+                # We must fetch the row before committing because executing
+                # the COMMIT on this same cursor would throw away the SELECT's
+                # results.
+                results = cur.fetchall()
+            except:
+                cur.execute("ROLLBACK")
+                raise
+            cur.execute("COMMIT")
+
+        # This should give us a single row holding the count
+        assert len(results) == 1, "Expected 1 result, got {}.".format(
+            len(results))
+        count = results[0][0]
+
+        log.info("Logged %r %r actions in the last minute (bucket %r).",
+            count, action, bucket_start)
+
+        # Check the counter to ensure there hasn't been too many requests in
+        # the past minute.
+        return count <= max_per_minute
+
+class OutboxMessage(BaseModel):
+    """
+    An email waiting to be sent (or that has been sent) by the mail worker,
+    see the ``mailer`` module.
+
+    Request handlers never talk to a mail server. They add a message here in
+    the same transaction as whatever the message is about, so a member is
+    never left without their confirmation (or sent one for a signup that
+    didn't happen), and the worker delivers it later.
+
+    """
+
+    table_name = "outbox"
+    columns = [
+        Column("id", "INTEGER", "PRIMARY KEY"),
+
+        # Messages with the same dedup_key are only ever queued once, see
+        # compose(). NULLs never clash so messages without a key always go.
+        Column("dedup_key", "TEXT", "UNIQUE"),
+        Column("recipient", "TEXT", "NOT NULL"),
+        Column("subject", "TEXT", "NOT NULL"),
+        Column("body", "TEXT", "NOT NULL"),
+        Column("created", "REAL", "NOT NULL"),
+
+        # One of STATUSES
+        Column("status", "TEXT", "NOT NULL"),
+        Column("attempts", "INTEGER", "NOT NULL"),
+
+        # The unix time at which the message should next be tried. The worker
+        # only ever looks for pending messages that are due, and there will
+        # be far more sent messages than pending ones.
+        Column("next_attempt", "REAL", "", index = "status='pending'"),
+        Column("sent_on", "REAL", ""),
+        Column("last_error", "TEXT", "")
+    ]
+
+    STATUSES = ("pending", "sent", "failed")
+    """
+    Pending messages are still to be sent, failed messages have been given up
+    on.
+
+    """
+
+    @classmethod
+    def compose(cls, recipient, subject, body, dedup_key = None):
+        """
+        Creates a pending message that is due right away. It still needs to
+        be inserted, ideally along with whatever it is about (see
+        ``insert_all()``).
+
+        :param dedup_key: If given, inserting a second message with the same
+            key raises ``sqlite3.IntegrityError`` rather than queuing the
+            same email twice.
+
+        """
+
+        now = time.time()
+        return cls(id = None, dedup_key = dedup_key, recipient = recipient,
+            subject = subject, body = body, created = now, status = "pending",
+            attempts = 0, next_attempt = now, sent_on = None,
+            last_error = None)
+
+    @classmethod
+    def claim_due(cls, db, limit, lease_seconds):
+        """
+        Returns up to ``limit`` pending messages that are due, oldest first.
+
+        The messages are leased: they won't be due again for
+        ``lease_seconds``, so a second worker won't send them too, and if
+        this worker dies before marking them they will be tried again once
+        the lease runs out.
+
+        """
+
+        now = time.time()
+        cur = db.cursor()
+        cur.row_factory = cls.row_factory
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            cur.execute("""
+                {} WHERE status='pending' AND next_attempt<=?
+                    ORDER BY next_attempt LIMIT ?;
+            """.format(cls._select_sql), (now, limit))
+            messages = cur.fetchall()
+            db.executemany("UPDATE outbox SET next_attempt=? WHERE id=?;",
+                [(now + lease_seconds, i.id) for i in messages])
+        except:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+        return messages
+
+    @classmethod
+    def mark_sent(cls, db, ids):
+        """Records that the messages with the given ids have been sent."""
+
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.executemany("""
+                UPDATE outbox SET status='sent', sent_on=?,
+                    attempts=attempts + 1, next_attempt=NULL WHERE id=?;
+            """, [(time.time(), i) for i in ids])
+        except:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    @classmethod
+    def mark_failed(cls, db, failures):
+        """
+        Records failed attempts at sending messages.
+
+        :param failures: A list of ``(id, error, retry_at)`` tuples, where
+            ``error`` describes what went wrong and ``retry_at`` is the unix
+            time the message should be tried again at, or ``None`` to give up
+            on it.
+
+        """
+
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.executemany("""
+                UPDATE outbox SET
+                    status=CASE WHEN :retry_at IS NULL
+                        THEN 'failed' ELSE 'pending' END,
+                    attempts=attempts + 1, next_attempt=:retry_at,
+                    last_error=:error
+                WHERE id=:id;
+            """, [{"id": message_id, "error": error, "retry_at": retry_at}
+                for message_id, error, retry_at in failures])
+        except:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+class _PendingInsert(object):
+    """
+    Inserts waiting in a ``GroupCommitter`` for their batch to flush. The
+    instances of one pending insert succeed or fail together.
+
+    """
+
+    def __init__(self, instances):
+        self.instances = instances
+
+        # Set once the batch holding this insert has been flushed, at which
+        # point error will be the exception raised by the insert (if any).
+        self.done = threading.Event()
+        self.error = None
+
+class GroupCommitter(object):
+    """
+    Collects inserts made by concurrent requests and writes them to the
+    database in a single transaction, so that a burst of signups costs one
+    fsync rather than one per signup.
+
+    The first insert to arrive leads its batch: it waits until either
+    ``max_batch_size`` inserts have joined the batch or ``max_delay`` seconds
+    have passed, and then flushes the batch using its own connection. Every
+    other insert simply waits for the leader to finish. Each caller gets the
+    result of its own insert, so a duplicate email still raises
+    ``sqlite3.IntegrityError`` from ``insert()`` for just that caller.
+
+    A caller may insert several rows at once (such as a member and the email
+    confirming they joined), in which case either all or none of them are
+    written, just like ``insert_all()``.
+
+    """
+
+    def __init__(self, max_batch_size, max_delay):
+        """
+        :param max_batch_size: The number of inserts that cause a batch to be
+            flushed immediately.
+        :param max_delay: The longest time, in seconds, an insert will wait
+            for other inserts to join its batch.
+
+        """
+
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+
+        # Protects _batch and _batch_full, and the counters below
+        self._lock = threading.Lock()
+
+        # The batch currently being collected, and an event that is set when
+        # it is full.
+        self._start_batch()
+
+        # Counters describing our behavior, see stats()
+        self._batch_sizes = collections.Counter()
+        self._flush_count = 0
+        self._flush_seconds_total = 0.0
+        self._flush_seconds_max = 0.0
+        self._fallback_count = 0
+
+    def insert(self, db, instance, *others):
+        """
+        Inserts ``instance`` into the database as part of the next batch and
+        returns once that batch has been committed.
+
+        :param db: A connection that can be used to flush the batch if this
+            insert ends up leading it.
+        :param instance: The model object to insert.
+        :param others: Any other model objects to insert along with
+            ``instance``. If any of them can't be inserted, none are.
+
+        """
+
+        pending = _PendingInsert((instance, ) + others)
+
+        with self._lock:
+            batch = self._batch
+            batch_full = self._batch_full
+            batch.append(pending)
+            is_leader = len(batch) == 1
+
+            # Once a batch is full later inserts go into a new batch, even
+            # if the leader of this one hasn't woken up to flush it yet.
+            if len(batch) >= self.max_batch_size:
+                batch_full.set()
+                self._start_batch()
+
+        if is_leader:
+            # Give other requests a chance to join our batch, then close it
+            # so that later inserts start a new one.
+            batch_full.wait(self.max_delay)
+            with self._lock:
+                if self._batch is batch:
+                    self._start_batch()
+
+            self._flush(db, batch)
+        else:
+            pending.done.wait()
+
+        if pending.error is not None:
+            raise pending.error
+
+    def _start_batch(self):
+        # Must be called with _lock held
+        self._batch = []
+        self._batch_full = threading.Event()
+
+    def _flush(self, db, batch):
+        start_time = time.time()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                # Write each table's rows with a single executemany. The
+                # batch will almost always hold only members.
+                queries = collections.OrderedDict()
+                for i in batch:
+                    for instance in i.instances:
+                        queries.setdefault(instance.insert_query(),
+                            []).append(instance.values())
+                for query, rows in queries.items():
+                    db.executemany(query, rows)
+            except sqlite3.IntegrityError:
+                # Someone in the batch violated a constraint (most likely by
+                # registering an email twice) and executemany can't tell us
+                # who. Start over and insert the rows one at a time so each
+                # insert gets its own result, still in one transaction.
+                db.execute("ROLLBACK")
+                self._flush_individually(db, batch)
+            except:
+                db.execute("ROLLBACK")
+                raise
+            else:
+                db.execute("COMMIT")
+        except Exception as e:
+            log.exception("Could not flush a batch of %d inserts.",
+                len(batch))
+            for i in batch:
+                i.error = e
+        finally:
+            elapsed = time.time() - start_time
+            with self._lock:
+                self._batch_sizes[len(batch)] += 1
+                self._flush_count += 1
+                self._flush_seconds_total += elapsed
+                self._flush_seconds_max = max(self._flush_seconds_max,
+                    elapsed)
+
+            for i in batch:
+                # A misbehaving listener mustn't leave anyone in the batch
+                # waiting forever.
+                if i.error is None:
+                    try:
+                        for instance in i.instances:
+                            notify_change(type(instance),
+                                getattr(instance, instance.primary_key()))
+                    except Exception:
+                        log.exception("A change listener failed.")
+
+                i.done.set()
+
+    def _flush_individually(self, db, batch):
+        with self._lock:
+            self._fallback_count += 1
+
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            for i in batch:
+                # A constraint violation only undoes the statement that
+                # caused it, the rest of the transaction is left intact. The
+                # savepoint lets us also undo any of the same caller's rows
+                # that went in before it.
+                db.execute("SAVEPOINT pending_insert")
+                try:
+                    for instance in i.instances:
+                        db.execute(instance.insert_query(),
+                            instance.values())
+                except sqlite3.IntegrityError as e:
+                    db.execute("ROLLBACK TO pending_insert")
+                    i.error = e
+                db.execute("RELEASE pending_insert")
+        except:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def stats(self):
+        """
+        Returns a dictionary of counters describing the batches flushed so
+        far. ``batch_sizes`` maps a batch size to the number of batches that
+        were flushed with that many inserts.
+
+        """
+
+        with self._lock:
+            return {
+                "batch_sizes": dict(self._batch_sizes),
+                "flush_count": self._flush_count,
+                "flush_seconds_total": self._flush_seconds_total,
+                "flush_seconds_max": self._flush_seconds_max,
+                "fallback_count": self._fallback_count
+            }
+
+Migration = collections.namedtuple("Migration",
+    ["version", "description", "function"])
+"""A numbered change to the database that ``migrate()`` applies once."""
+
+MIGRATIONS = []
+"""Every known migration. Use the ``migration`` decorator to add to this."""
+
+def migration(version, description):
+    """
+    Decorator that registers a function as a migration. The function will be
+    given the database connection and is run inside of a transaction, which
+    is committed along with the database's new version number.
+
+    Migrations only need to deal with changes to data (or to tables no longer
+    described by a model), ``initialize_schema()`` already takes care of
+    bringing the models' columns up to date.
+
+    """
+
+    def decorator(function):
+        MIGRATIONS.append(Migration(version, description, function))
+        MIGRATIONS.sort()
+        return function
+
+    return decorator
+
+def get_schema_version(db):
+    return db.execute("PRAGMA user_version;").fetchone()[0]
+
+def migrate(db):
+    """
+    Applies any migrations newer than the database's version (which is kept
+    in SQLite's ``user_version`` pragma), oldest first.
+
+    """
+
+    current_version = get_schema_version(db)
+    for i in MIGRATIONS:
+        if i.version <= current_version:
+            continue
+
+        log.warning("Applying migration %r: %s", i.version, i.description)
+
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            i.function(db)
+
+            # PRAGMA statements can't take parameters, but the version is an
+            # integer that we control.
+            db.execute("PRAGMA user_version = {:d};".format(i.version))
+        except:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+def initialize_schema(db):
+    """
+    Creates, migrates and verifies the tables of every model in ``MODELS``.
+    This is meant to be run once when the application starts, the request
+    handlers assume that it already has been.
+
+    """
+
+    # A brand new database doesn't need any of the migrations, its tables
+    # will be created in their latest form.
+    table_count = db.execute(
+        "SELECT COUNT(*) FROM sqlite_master WHERE type='table';").fetchone()[0]
+    is_new = table_count == 0
+
+    for i in MODELS:
+        i.create_table(db, verify = False)
+
+    if is_new and MIGRATIONS:
+        db.execute("PRAGMA user_version = {:d};".format(
+            MIGRATIONS[-1].version))
+    else:
+        migrate(db)
+
+    # Bring any tables whose columns don't match their model up to date
+    # rather than refusing to run.
+    for i in MODELS:
+        if not i.table_matches(db):
+            i.upgrade_table(db)
+
+            if not i.table_matches(db):
+                raise RuntimeError("table is not as expected")
+
+    # Rebuilding a table drops its indexes and triggers, and some tables may
+    # only have just gotten the columns their indexes need.
+    for i in MODELS:
+        i.create_indexes(db)
+        i.create_triggers(db)
+
+@migration(1, "Replace the per-minute rate limiting rows with a ring of slots")
+def _rate_limiting_ring(db):
+    # The old counters are only good for a minute anyway, so rather than
+    # converting them we start over with the new table.
+    db.execute("DROP TABLE IF EXISTS {};".format(RateLimiter.table_name))
+    db.execute("CREATE TABLE {} ({});".format(RateLimiter.table_name,
+        RateLimiter.columns_definition()))
+
+@migration(2, "Count the existing members into member_statistics")
+def _member_statistics(db):
+    # The triggers are made in this transaction too, so no member can join in
+    # between being counted and the triggers counting them.
+    MemberStatistic.create_triggers(db)
+    MemberStatistic.recount(db)
+
+@migration(3, "Count members by the day they joined from epoch seconds too")
+def _member_statistics_epoch_seconds(db):
+    # Member times are now stored as epoch seconds (see EpochSeconds), which
+    # the triggers must understand.
+    for i in ("insert", "delete", "update"):
+        db.execute("DROP TRIGGER IF EXISTS member_statistics_{};".format(i))
+    MemberStatistic.create_triggers(db)
+
+    # Rewriting every member here would lock out signups until it was done,
+    # so it's left to be done a batch at a time while the site is up.
+    if db.execute("""
+            SELECT 1 FROM members WHERE typeof(joined)='text' OR
+                typeof(paid_on)='text' LIMIT 1;
+            """).fetchone() is not None:
+        log.warning("Some members' times are still stored as text, run "
+            "manage.py convert-timestamps to convert them.")
+
+StatementStats = collections.namedtuple("StatementStats",
+    ["count", "errors", "seconds_total", "seconds_max"])
+"""How often statements of one shape ran and how long they took."""
+
+class StatementProfiler(object):
+    """
+    Times every statement run through connections made with
+    ``connection_factory()``.
+
+    Statements are grouped by shape: their text with comments removed,
+    whitespace collapsed and any literal numbers or strings replaced by
+    ``?``. Our statements use
+    parameters for anything that varies, so there are only a few dozen
+    shapes.
+
+    Time spent in ``BEGIN IMMEDIATE`` and ``BEGIN EXCLUSIVE`` is also counted
+    as lock wait. Those statements do nothing but wait for the write lock (up
+    to the busy timeout), so they tell us how long writers queue behind one
+    another. Time spent in ``COMMIT`` is mostly the fsync.
+
+    Only the execute call is timed. For a ``SELECT`` that covers finding the
+    first row, but not fetching the rows after it.
+
+    """
+
+    _literal_re = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+    _comment_re = re.compile(r"--[^\n]*")
+    _lock_statements = ("BEGIN IMMEDIATE", "BEGIN EXCLUSIVE")
+    _whitespace_re = re.compile(r"\s+")
+
+    def __init__(self, slow_threshold = None):
+        """
+        :param slow_threshold: Statements taking longer than this many seconds
+            are logged as they happen. ``None`` disables this.
+
+        """
+
+        self.slow_threshold = slow_threshold
+
+        # Maps shapes to [count, errors, seconds_total, seconds_max]
+        self._stats = {}
+        self._lock_wait_count = 0
+        self._lock_wait_seconds = 0.0
+        self._lock = threading.Lock()
+
+        # Normalizing a statement isn't free, and the same few statement
+        # strings are run over and over.
+        self._shapes = {}
+
+    def shape(self, sql):
+        shape = self._shapes.get(sql)
+        if shape is None:
+            shape = self._comment_re.sub("", sql)
+            shape = self._literal_re.sub("?", shape)
+            shape = self._whitespace_re.sub(" ", shape).strip().rstrip(";")
+            if len(self._shapes) < 1000:
+                self._shapes[sql] = shape
+
+        return shape
+
+    def record(self, sql, seconds, failed = False):
+        shape = self.shape(sql)
+        with self._lock:
+            stats = self._stats.get(shape)
+            if stats is None:
+                stats = self._stats[shape] = [0, 0, 0.0, 0.0]
+            stats[0] += 1
+            stats[1] += failed
+            stats[2] += seconds
+            stats[3] = max(stats[3], seconds)
+
+            if shape.upper().startswith(self._lock_statements):
+                self._lock_wait_count += 1
+                self._lock_wait_seconds += seconds
+
+        if self.slow_threshold is not None and seconds > self.slow_threshold:
+            log.warning("Slow statement took %.1fms%s: %s", seconds * 1000,
+                " and failed" if failed else "", shape)
+
+    def trace(self, sql):
+        """
+        Used as the connection's trace callback where SQLite supports it
+        (``set_trace_callback`` needs Python 3.3). SQLite reports the
+        statements run by triggers as comments, and since those don't go
+        through ``execute`` this is the only way to count them. Their time is
+        included in the statement that fired the trigger.
+
+        """
+
+        if sql.startswith("--"):
+            shape = self._whitespace_re.sub(" ", sql)
+            with self._lock:
+                stats = self._stats.setdefault(shape, [0, 0, 0.0, 0.0])
+                stats[0] += 1
+
+    def stats(self):
+        """Returns a dictionary mapping shapes to ``StatementStats``."""
+
+        with self._lock:
+            return dict((shape, StatementStats(*stats))
+                for shape, stats in self._stats.items())
+
+    def lock_wait(self):
+        """
+        Returns how many times a transaction waited for the write lock and the
+        total number of seconds spent waiting.
+
+        """
+
+        with self._lock:
+            return self._lock_wait_count, self._lock_wait_seconds
+
+    def format_summary(self):
+        """
+        Returns a table of every statement shape, the ones that took the most
+        time in total first.
+
+        """
+
+        stats = sorted(self.stats().items(),
+            key = lambda i: i[1].seconds_total, reverse = True)
+        lines = ["{:>8} {:>6} {:>10} {:>8} {:>8}  {}".format(
+            "count", "errors", "total ms", "mean ms", "max ms", "statement")]
+        for shape, i in stats:
+            lines.append("{:8d} {:6d} {:10.1f} {:8.3f} {:8.1f}  {}".format(
+                i.count, i.errors, i.seconds_total * 1000,
+                i.seconds_total * 1000 / i.count, i.seconds_max * 1000,
+                shape if len(shape) <= 100 else shape[:97] + "..."))
+
+        lock_wait_count, lock_wait_seconds = self.lock_wait()
+        lines.append("Waited for the write lock {} times for {:.1f}ms in "
+            "total.".format(lock_wait_count, lock_wait_seconds * 1000))
+
+        return "\n".join(lines) + "\n"
+
+    def dump_summary(self, stream = None):
+        """
+        Writes ``format_summary()`` to ``stream`` (standard error by default).
+        This is what is registered with ``atexit`` when the summary should be
+        shown as the process exits.
+
+        """
+
+        (stream or sys.stderr).write(self.format_summary())
+
+    def connection_factory(self):
+        """
+        Returns something to pass as the ``factory`` argument of
+        ``sqlite3.connect()`` so that the connection's statements are timed.
+
+        """
+
+        profiler = self
+        def factory(*args, **kwargs):
+            return ProfilingConnection(profiler, *args, **kwargs)
+
+        return factory
+
+class ProfilingCursor(sqlite3.Cursor):
+    """A cursor that reports how long each statement took to its profiler."""
+
+    def execute(self, sql, *args):
+        return self._timed(sqlite3.Cursor.execute, sql, args)
+
+    def executemany(self, sql, *args):
+        return self._timed(sqlite3.Cursor.executemany, sql, args)
+
+    def _timed(self, method, sql, args):
+        start_time = time.time()
+        try:
+            result = method(self, sql, *args)
+        except:
+            self.connection.profiler.record(sql, time.time() - start_time,
+                failed = True)
+            raise
+
+        self.connection.profiler.record(sql, time.time() - start_time)
+        return result
+
+class ProfilingConnection(sqlite3.Connection):
+    """
+    A connection whose statements are timed. The shortcut methods like
+    ``Connection.execute()`` create their cursor by calling ``cursor()``, so
+    handing out ``ProfilingCursor`` objects from there covers them as well.
+
+    """
+
+    def __init__(self, profiler, *args, **kwargs):
+        sqlite3.Connection.__init__(self, *args, **kwargs)
+        self.profiler = profiler
+
+        if hasattr(self, "set_trace_callback"):
+            self.set_trace_callback(profiler.trace)
 
+    def cursor(self, factory = ProfilingCursor):
+        return sqlite3.Connection.cursor(self, factory)
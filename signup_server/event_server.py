@@ -0,0 +1,816 @@
+"""
+An HTTP server that holds many connections open cheaply while capping how many
+requests touch the database at once.
+
+The threaded and pre-forked WSGI servers tie up a thread (or a process) for as
+long as a connection stays open, even while it is idle between keep-alive
+requests or slowly trickling in its request. Here a single thread runs an
+``asyncore`` event loop that does all of the network I/O, and only requests
+that have arrived in full are handed to a fixed pool of worker threads that
+call the WSGI application. Idle connections cost a socket and a small buffer,
+and no matter how many clients are connected at most ``threads`` requests are
+being handled (and so at most ``threads`` database connections are in use).
+
+Our request handlers are plain blocking functions that use the database
+throughout, so the whole WSGI call runs in the pool rather than just the
+queries. The application doesn't need to know it is being served this way:
+it gets the same ``environ`` it would from any other WSGI server.
+
+Bodies are normally read in full before the request goes to the pool, which
+is what keeps slow clients from tying up worker threads. Uploads are too large
+for that, so requests to the paths given as ``streamed_paths`` go to the pool
+as soon as their headers are in, and the event loop passes their body along
+to the worker thread as it arrives.
+
+Run it with the ``event-server.py`` script at the root of the repository.
+
+"""
+
+# stdlib
+import os
+import sys
+import time
+import Queue
+import errno
+import fcntl
+import select
+import socket
+import urllib
+import httplib
+import logging
+import asyncore
+import threading
+import cStringIO
+import collections
+import email.utils
+
+log = logging.getLogger("rock.event_server")
+
+MAX_HEADER_SIZE = 65536
+"""The most bytes the request line and headers of a request may take up."""
+
+READ_SIZE = 8192
+"""How many bytes are read from a connection at a time."""
+
+MAX_STREAM_BUFFER = 65536
+"""
+How many bytes of a streamed body may wait for the application to read them
+before we stop reading from the connection.
+"""
+
+SERVER_NAME = "rock"
+"""Sent in the Server header of every response."""
+
+EXTRA_RESPONSES = {431: "Request Header Fields Too Large"}
+"""Descriptions of the status codes ``httplib.responses`` doesn't know."""
+
+INTERNAL_ERROR = ("500 Internal Server Error",
+    [("Content-Type", "text/plain")], "500 Internal Server Error")
+"""The response sent when the application fails to give us one."""
+
+class Poller(object):
+    """
+    Keeps track of which events each dispatcher is waiting for.
+
+    ``asyncore.loop()`` asks every dispatcher whether it is readable and
+    writable each time around the loop and builds a new poll set from the
+    answers, which costs as much as the number of connections even when only
+    one of them has anything to say. Here each dispatcher is registered with
+    epoll (or poll, where there's no epoll) once, and its registration is
+    only updated after something has happened on it.
+
+    """
+
+    def __init__(self):
+        if hasattr(select, "epoll"):
+            self._poll = select.epoll()
+            self._timeout_scale = 1
+        else:
+            self._poll = select.poll()
+            self._timeout_scale = 1000
+
+        # Maps file descriptors to the events they're registered for
+        self._masks = {}
+
+    def update(self, dispatcher):
+        """Updates the events we wait on for ``dispatcher``."""
+
+        fd = dispatcher._fileno
+        if fd is None:
+            return
+
+        mask = 0
+        if dispatcher.readable():
+            mask |= select.POLLIN | select.POLLPRI
+        if dispatcher.writable():
+            mask |= select.POLLOUT
+
+        old_mask = self._masks.get(fd)
+        if old_mask is None:
+            self._poll.register(fd, mask)
+        elif old_mask != mask:
+            self._poll.modify(fd, mask)
+        self._masks[fd] = mask
+
+    def remove(self, fd):
+        if self._masks.pop(fd, None) is not None:
+            self._poll.unregister(fd)
+
+    def poll(self, timeout):
+        """Returns a list of ``(fd, events)`` tuples, see ``select.poll``."""
+
+        try:
+            return self._poll.poll(timeout * self._timeout_scale)
+        except (IOError, select.error) as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+class WorkerPool(object):
+    """
+    A fixed number of threads taking jobs off a bounded queue. When the queue
+    is full new jobs are refused rather than queued, so a burst of requests
+    turns into quick 503 responses instead of an ever growing backlog.
+
+    """
+
+    def __init__(self, threads, max_queued, on_done):
+        """
+        :param threads: How many jobs may run at once.
+        :param max_queued: How many jobs may wait for a thread.
+        :param on_done: Called from the worker thread as
+            ``on_done(token, result)`` once a job has run.
+
+        """
+
+        self._queue = Queue.Queue(max_queued)
+        self._on_done = on_done
+        self._threads = []
+        for i in range(threads):
+            thread = threading.Thread(target = self._work,
+                name = "event-server-worker-{}".format(i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, function, token):
+        """
+        Queues ``function`` to be called on a worker thread.
+
+        :returns: ``False`` if the queue is full and the job was refused.
+
+        """
+
+        try:
+            self._queue.put_nowait((function, token))
+        except Queue.Full:
+            return False
+
+        return True
+
+    def _work(self):
+        while True:
+            function, token = self._queue.get()
+
+            # Losing a thread to an error would shrink the pool for good
+            try:
+                result = function()
+            except Exception:
+                log.exception("Unhandled exception in a worker thread.")
+                result = INTERNAL_ERROR
+
+            try:
+                self._on_done(token, result)
+            except Exception:
+                log.exception("Could not hand back a job's result.")
+
+class Waker(asyncore.file_dispatcher):
+    """
+    Lets worker threads hand finished responses back to the event loop. The
+    loop may be sleeping in ``poll()``, so besides queueing the response a
+    byte is written to a pipe the loop is watching.
+
+    """
+
+    def __init__(self, socket_map, on_wake):
+        read_fd, self._write_fd = os.pipe()
+        for i in (read_fd, self._write_fd):
+            fcntl.fcntl(i, fcntl.F_SETFL,
+                fcntl.fcntl(i, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+        asyncore.file_dispatcher.__init__(self, read_fd, map = socket_map)
+
+        # file_dispatcher keeps its own duplicate of the descriptor
+        os.close(read_fd)
+
+        self._on_wake = on_wake
+        self._pending = collections.deque()
+
+    def put(self, item):
+        """Queues ``item`` for the event loop. Safe to call from any thread."""
+
+        self._pending.append(item)
+        try:
+            os.write(self._write_fd, "x")
+        except OSError as e:
+            # A full pipe already has plenty of wake ups waiting in it
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        # file_dispatcher reads with os.read() so errors are OSErrors
+        try:
+            self.recv(READ_SIZE)
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+        while self._pending:
+            self._on_wake(self._pending.popleft())
+
+class BodyStream(object):
+    """
+    The ``wsgi.input`` of a request whose body is handed to the application as
+    it arrives. The event loop writes what it reads from the connection, and
+    the worker thread running the application waits whenever it has read
+    everything written so far.
+
+    """
+
+    def __init__(self, on_drain):
+        """
+        :param on_drain: Called from the reading thread when the stream stops
+            being full, so the event loop can start reading again.
+
+        """
+
+        self._condition = threading.Condition()
+        self._chunks = collections.deque()
+        self._buffered = 0
+        self._closed = False
+        self._on_drain = on_drain
+
+    def is_full(self):
+        with self._condition:
+            return self._buffered >= MAX_STREAM_BUFFER
+
+    def write(self, data):
+        with self._condition:
+            if not self._closed:
+                self._chunks.append(data)
+                self._buffered += len(data)
+                self._condition.notify()
+
+    def close(self):
+        """
+        Says no more will be written, either because the whole body has been
+        or because the client went away. Reads past what was written get
+        ``""``.
+
+        """
+
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+
+    def read(self, size = -1):
+        with self._condition:
+            if size < 0:
+                while not self._closed:
+                    self._condition.wait()
+                size = self._buffered
+            else:
+                while not self._chunks and not self._closed:
+                    self._condition.wait()
+
+            was_full = self._buffered >= MAX_STREAM_BUFFER
+            data = []
+            wanted = size
+            while self._chunks and wanted > 0:
+                chunk = self._chunks.popleft()
+                if len(chunk) > wanted:
+                    self._chunks.appendleft(chunk[wanted:])
+                    chunk = chunk[:wanted]
+                data.append(chunk)
+                wanted -= len(chunk)
+            self._buffered -= size - wanted
+            drained = was_full and self._buffered < MAX_STREAM_BUFFER
+
+        if drained:
+            self._on_drain()
+
+        return "".join(data)
+
+def run_application(app, environ):
+    """
+    Calls a WSGI application and collects its whole response. Our responses
+    are small, so buffering them lets the event loop send them with a
+    ``Content-Length`` and keep the connection open.
+
+    :returns: A ``(status, headers, body)`` tuple.
+
+    """
+
+    response = {}
+    body = []
+    def start_response(status, headers, exc_info = None):
+        if exc_info is not None:
+            try:
+                if "status" in response and body:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+            finally:
+                exc_info = None
+
+        response["status"] = status
+        response["headers"] = headers
+        return body.append
+
+    try:
+        result = app(environ, start_response)
+        try:
+            for i in result:
+                body.append(i)
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+
+        if "status" not in response:
+            raise RuntimeError("the application never called "
+                "start_response()")
+
+        return response["status"], response["headers"], "".join(body)
+    except Exception:
+        log.exception("Unhandled exception serving %r.",
+            environ.get("PATH_INFO"))
+        return INTERNAL_ERROR
+
+class HTTPChannel(asyncore.dispatcher):
+    """
+    One client connection. Reads requests, hands each complete one to the
+    worker pool and writes back the responses, one request at a time.
+
+    While a request is being handled we stop reading from the connection, so
+    a client pipelining requests can't make us buffer more than one request
+    ahead.
+
+    """
+
+    def __init__(self, server, sock, address):
+        asyncore.dispatcher.__init__(self, sock, map = server.socket_map)
+        self.server = server
+        self.address = address
+        self.last_activity = time.time()
+
+        self._in_buffer = ""
+        self._out_buffer = ""
+
+        # The environ of the request whose body we're waiting on, and how
+        # many bytes of body it has. For a streamed body it's how many bytes
+        # are yet to be passed along to the application.
+        self._environ = None
+        self._body_length = 0
+
+        # The wsgi.input of a request whose body is being streamed
+        self._stream = None
+
+        # True while a request is in the worker pool
+        self._busy = False
+
+        # The method of the request being answered. Responses to HEAD
+        # requests have no body.
+        self._method = None
+
+        self._keep_alive = False
+        self._close_when_sent = False
+
+    def readable(self):
+        if self._stream is not None:
+            return not self._close_when_sent and not self._stream.is_full()
+
+        return (not self._busy and not self._close_when_sent and
+            len(self._in_buffer) < MAX_HEADER_SIZE +
+                self.server.max_body_size)
+
+    def writable(self):
+        return bool(self._out_buffer)
+
+    def handle_read(self):
+        try:
+            data = self.recv(READ_SIZE)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        if not data:
+            return
+
+        self.last_activity = time.time()
+        self._in_buffer += data
+        self._process_input()
+
+    def _process_input(self):
+        if self._stream is not None:
+            self._feed_stream()
+
+        if self._busy or self._close_when_sent:
+            return
+
+        if self._environ is None:
+            self._method = None
+            end = self._in_buffer.find("\r\n\r\n")
+            if end == -1:
+                if len(self._in_buffer) > MAX_HEADER_SIZE:
+                    self.send_error(431, "Request headers are too large.")
+                return
+
+            head = self._in_buffer[:end]
+            self._in_buffer = self._in_buffer[end + 4:]
+            try:
+                self._environ = self._parse_head(head)
+            except ValueError as e:
+                self.send_error(400, str(e))
+                return
+
+            if self._environ is None:
+                # The error response has already been queued
+                return
+
+        environ = self._environ
+        if (environ["PATH_INFO"] in self.server.streamed_paths and
+                self._body_length > 0):
+            self._environ = None
+            self._stream = BodyStream(
+                lambda: self.server._waker_put(self, None))
+            environ["wsgi.input"] = self._stream
+            self._submit(environ)
+
+            # Some of the body may have come along with the headers
+            if self._stream is not None:
+                self._feed_stream()
+            return
+
+        if len(self._in_buffer) < self._body_length:
+            return
+
+        body = self._in_buffer[:self._body_length]
+        self._in_buffer = self._in_buffer[self._body_length:]
+        environ["wsgi.input"] = cStringIO.StringIO(body)
+        self._environ = None
+        self._body_length = 0
+
+        self._submit(environ)
+
+    def _submit(self, environ):
+        """Hands a request to the worker pool."""
+
+        self._busy = True
+        app = self.server.app
+        if not self.server.pool.submit(lambda: run_application(app, environ),
+                self):
+            self._busy = False
+            self.server.overloaded_count += 1
+            self.send_error(503, "The server is too busy, try again soon.",
+                headers = [("Retry-After", "1")])
+
+    def _feed_stream(self):
+        """Passes what we have of a streamed body along to the application."""
+
+        data = self._in_buffer[:self._body_length]
+        self._in_buffer = self._in_buffer[len(data):]
+        self._body_length -= len(data)
+        if data:
+            self._stream.write(data)
+
+        # Anything left in the buffer belongs to the next request
+        if not self._body_length:
+            self._stream.close()
+            self._stream = None
+
+    def _parse_head(self, head):
+        """
+        Turns the request line and headers into a WSGI environ, or queues an
+        error response and returns ``None`` if the request can't be served.
+
+        :raises ValueError: If the request is malformed.
+
+        """
+
+        lines = head.split("\r\n")
+        parts = lines[0].split()
+        if len(parts) != 3 or not parts[2].startswith("HTTP/"):
+            raise ValueError("Malformed request line.")
+        method, target, protocol = parts
+        self._method = method
+
+        path, _, query = target.partition("?")
+        environ = {
+            "REQUEST_METHOD": method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": urllib.unquote(path),
+            "QUERY_STRING": query,
+            "SERVER_NAME": self.server.server_name,
+            "SERVER_PORT": str(self.server.server_port),
+            "SERVER_PROTOCOL": protocol,
+            "REMOTE_ADDR": self.address[0],
+            "REMOTE_PORT": str(self.address[1]),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False
+        }
+
+        for line in lines[1:]:
+            name, colon, value = line.partition(":")
+            if not colon:
+                raise ValueError("Malformed header.")
+            name = name.strip().upper().replace("-", "_")
+            value = value.strip()
+            if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+                name = "HTTP_" + name
+            if name in environ:
+                environ[name] += "," + value
+            else:
+                environ[name] = value
+
+        connection = environ.get("HTTP_CONNECTION", "").lower()
+        if protocol == "HTTP/1.1":
+            self._keep_alive = "close" not in connection
+        else:
+            self._keep_alive = "keep-alive" in connection
+
+        if "HTTP_TRANSFER_ENCODING" in environ:
+            # Browsers always send forms with a Content-Length
+            self.send_error(411, "Chunked requests are not supported.")
+            return None
+
+        try:
+            self._body_length = int(environ.get("CONTENT_LENGTH") or 0)
+        except ValueError:
+            raise ValueError("Invalid Content-Length.")
+        if self._body_length < 0:
+            raise ValueError("Invalid Content-Length.")
+
+        # Refuse large bodies before they arrive, rather than buffering them
+        # only for the application to turn them away.
+        max_body_size = self.server.streamed_paths.get(environ["PATH_INFO"],
+            self.server.max_body_size)
+        if self._body_length > max_body_size:
+            self.send_error(413, "Request body may be at most {} bytes."
+                .format(max_body_size))
+            return None
+
+        if environ.get("HTTP_EXPECT", "").lower() == "100-continue":
+            self._out_buffer += "HTTP/1.1 100 Continue\r\n\r\n"
+
+        return environ
+
+    def send_error(self, code, message, headers = None):
+        """
+        Sends an error response and closes the connection once it has been
+        sent. Used for requests that never make it to the application.
+
+        """
+
+        status = "{} {}".format(code,
+            httplib.responses.get(code) or EXTRA_RESPONSES[code])
+        self._keep_alive = False
+        self.send_response(status, [("Content-Type", "text/plain")] +
+            (headers or []), "{}\n\n{}".format(status, message))
+
+    def send_response(self, status, headers, body):
+        self._busy = False
+        self.last_activity = time.time()
+
+        # The application answered without reading all of a streamed body,
+        # and the rest of it can't be told apart from a next request.
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+            self._keep_alive = False
+
+        lines = ["HTTP/1.1 " + status]
+        has_length = False
+        for name, value in headers:
+            if name.lower() == "content-length":
+                has_length = True
+            elif name.lower() == "connection":
+                continue
+            lines.append("{}: {}".format(name, value))
+        if not has_length:
+            lines.append("Content-Length: {}".format(len(body)))
+
+        # Close connections once we have as many as we're willing to hold, so
+        # that new clients can get in.
+        if self.server.is_full():
+            self._keep_alive = False
+        lines.append("Connection: " +
+            ("keep-alive" if self._keep_alive else "close"))
+        lines.append("Date: " + email.utils.formatdate(usegmt = True))
+        lines.append("Server: " + SERVER_NAME)
+
+        # A HEAD response has the headers a GET response would have,
+        # including its Content-Length, but no body.
+        if self._method == "HEAD":
+            body = ""
+
+        self._out_buffer += "\r\n".join(lines) + "\r\n\r\n" + body
+        if not self._keep_alive:
+            self._close_when_sent = True
+
+    def handle_write(self):
+        try:
+            sent = self.send(self._out_buffer)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+
+        self.last_activity = time.time()
+        self._out_buffer = self._out_buffer[sent:]
+        if not self._out_buffer:
+            if self._close_when_sent:
+                self.close()
+            else:
+                # The client may have sent its next request already
+                self._process_input()
+
+    def handle_close(self):
+        self.close()
+
+    def close(self):
+        # The application may be waiting on the rest of a streamed body
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+
+        asyncore.dispatcher.close(self)
+
+    def del_channel(self, map = None):
+        # Called by close(), before the socket is closed
+        self.server.poller.remove(self._fileno)
+        asyncore.dispatcher.del_channel(self, map)
+
+    def handle_error(self):
+        log.exception("Error on connection from %r.", self.address)
+        self.close()
+
+class EventServer(asyncore.dispatcher):
+    """Accepts connections and runs the event loop."""
+
+    def __init__(self, app, listening_socket, threads = 8, max_queued = 128,
+            max_connections = 10000, keep_alive_timeout = 15,
+            max_body_size = 16384, streamed_paths = None):
+        """
+        :param app: The WSGI application to serve.
+        :param listening_socket: A bound, listening socket. It must not block.
+        :param threads: How many requests are handled at once. Each worker
+            thread uses its own database connections, so this also caps how
+            many are in use.
+        :param max_queued: How many complete requests may wait for a worker
+            thread. Requests arriving when the queue is full get a ``503``.
+        :param max_connections: The most connections held open at once. We
+            stop accepting new ones until some close.
+        :param keep_alive_timeout: How many seconds an idle connection is kept
+            open.
+        :param max_body_size: The largest request body that will be read.
+        :param streamed_paths: A dictionary mapping the paths whose request
+            bodies are streamed to the application, rather than read in full
+            first, to the largest body each will take instead of
+            ``max_body_size``.
+
+        """
+
+        self.socket_map = {}
+        asyncore.dispatcher.__init__(self, listening_socket,
+            map = self.socket_map)
+
+        # asyncore only knows a socket is listening if it called listen()
+        # itself.
+        self.accepting = True
+
+        self.app = app
+        self.max_connections = max_connections
+        self.keep_alive_timeout = keep_alive_timeout
+        self.max_body_size = max_body_size
+        self.streamed_paths = streamed_paths or {}
+        self.overloaded_count = 0
+
+        host, port = listening_socket.getsockname()[:2]
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+
+        self.poller = Poller()
+        self._waker = Waker(self.socket_map, self._deliver)
+        self.pool = WorkerPool(threads, max_queued, self._waker_put)
+        self._last_idle_check = time.time()
+
+    def _waker_put(self, channel, result):
+        self._waker.put((channel, result))
+
+    def _deliver(self, item):
+        channel, result = item
+
+        # The client may have hung up while its request was being handled
+        if not channel.connected:
+            return
+
+        # Without a response, the application has made room in a streamed
+        # body and the channel may want to read again.
+        if result is not None:
+            channel.send_response(*result)
+        self.poller.update(channel)
+
+    def connection_count(self):
+        # Everything in the map besides ourselves and the waker
+        return len(self.socket_map) - 2
+
+    def is_full(self):
+        return self.connection_count() >= self.max_connections
+
+    def readable(self):
+        return not self.is_full()
+
+    def writable(self):
+        return False
+
+    def handle_accept(self):
+        try:
+            pair = self.accept()
+        except socket.error as e:
+            if e.errno in (errno.EMFILE, errno.ENFILE):
+                log.warning("Out of file descriptors, not accepting.")
+                return
+            raise
+
+        # Another process sharing the socket got to the connection first
+        if pair is None:
+            return
+
+        sock, address = pair
+        self.poller.update(HTTPChannel(self, sock, address))
+
+    def handle_error(self):
+        log.exception("Error accepting a connection.")
+
+    def close_idle(self):
+        """Closes connections that have been idle too long."""
+
+        cutoff = time.time() - self.keep_alive_timeout
+        for i in self.socket_map.values():
+            if not isinstance(i, HTTPChannel):
+                continue
+
+            # A client that stops sending a streamed body is holding up a
+            # worker thread, so it counts as idle too.
+            if ((not i._busy or i._stream is not None) and
+                    not i._out_buffer and i.last_activity < cutoff):
+                i.close()
+
+    def serve_forever(self):
+        self.poller.update(self)
+        self.poller.update(self._waker)
+        while True:
+            for fd, events in self.poller.poll(1):
+                dispatcher = self.socket_map.get(fd)
+                if dispatcher is None:
+                    continue
+
+                asyncore.readwrite(dispatcher, events)
+                self.poller.update(dispatcher)
+
+            # Accepting or closing connections may have changed whether we
+            # can take any more.
+            self.poller.update(self)
+
+            # Looking for idle connections means looking at all of them, so
+            # only do it about once a second.
+            if time.time() - self._last_idle_check >= 1:
+                self._last_idle_check = time.time()
+                self.close_idle()
+
+def create_server(app, listening_socket, config, streamed_paths = ()):
+    """
+    Creates the ``EventServer`` described by the configuration.
+
+    :param config: The dictionary of options from the ``[rock]`` section of
+        the configuration file.
+    :param streamed_paths: The paths whose bodies the application reads
+        itself, like uploads. Their bodies are streamed to it and may be up
+        to ``max_import_size`` bytes.
+
+    """
+
+    max_import_size = int(config.get("max_import_size", "10485760"))
+
+    return EventServer(app, listening_socket,
+        threads = int(config.get("event_threads", "8")),
+        max_queued = int(config.get("event_max_queued", "128")),
+        max_connections = int(config.get("event_max_connections", "10000")),
+        keep_alive_timeout = float(config.get("keep_alive_timeout", "15")),
+        max_body_size = int(config.get("max_body_size", "16384")),
+        streamed_paths = dict((i, max_import_size) for i in streamed_paths))
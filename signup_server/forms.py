@@ -0,0 +1,197 @@
+"""
+Parsing of the form data browsers send us.
+
+Our forms are tiny, so rather than using ``cgi.FieldStorage`` (which will read
+as much as the client cares to send and may spill it into temporary files) we
+parse ``application/x-www-form-urlencoded`` bodies ourselves, refusing
+anything larger than we'd ever expect before reading it.
+
+"""
+
+# stdlib
+import urllib
+
+FORM_CONTENT_TYPE = "application/x-www-form-urlencoded"
+"""The only kind of request body we accept."""
+
+READ_SIZE = 8192
+"""How many bytes are read from the request body at a time."""
+
+class FormError(Exception):
+    """
+    Raised when a request's form data can't be parsed. ``code`` is the HTTP
+    status code that should be sent back, ``message`` explains why.
+
+    """
+
+    def __init__(self, code, message):
+        super(FormError, self).__init__(code, message)
+        self.code = code
+        self.message = message
+
+def get_content_length(environ, max_body_size):
+    """
+    Returns the length of the request body, raising ``FormError`` if it is
+    invalid or larger than ``max_body_size``.
+
+    """
+
+    # An empty or missing CONTENT_LENGTH means there's no body, see
+    # http://legacy.python.org/dev/peps/pep-0333/#environ-variables
+    content_length = environ.get("CONTENT_LENGTH", "")
+    if not content_length:
+        return 0
+
+    try:
+        content_length = int(content_length)
+    except ValueError:
+        raise FormError(400, "Invalid Content-Length.")
+    if content_length < 0:
+        raise FormError(400, "Invalid Content-Length.")
+
+    if content_length > max_body_size:
+        raise FormError(413, "Request body may be at most {} bytes.".format(
+            max_body_size))
+
+    return content_length
+
+def _decode_field(field):
+    name, _, value = field.partition("=")
+    try:
+        return (urllib.unquote_plus(name).decode("utf_8"),
+            urllib.unquote_plus(value).decode("utf_8"))
+    except UnicodeDecodeError:
+        raise FormError(400, "Form data must be encoded with UTF-8.")
+
+def parse_urlencoded(environ, max_body_size, max_fields):
+    """
+    Reads and parses the ``application/x-www-form-urlencoded`` body of a
+    request.
+
+    The body is read in pieces as it is parsed and never past
+    ``CONTENT_LENGTH`` (reading past it can block forever, see PEP 333).
+    Browsers encode form data using the encoding of the page the form is on,
+    which is UTF-8 for our site.
+
+    :param environ: The WSGI environ of the request.
+    :param max_body_size: The most bytes the body may have. Larger requests
+        are rejected before any of their body is read.
+    :param max_fields: The most fields the form may have.
+
+    :returns: A dictionary mapping the field names to their values, all of
+        which are unicode objects. Blank values are kept. If a field appears
+        more than once, its last value is used.
+
+    :raises FormError: If the body is too large, has too many fields, or is
+        not a properly encoded form.
+
+    """
+
+    content_type = environ.get("CONTENT_TYPE", "").partition(";")[0]
+    content_type = content_type.strip().lower()
+    if content_type and content_type != FORM_CONTENT_TYPE:
+        raise FormError(415, "Expected a body of type {}.".format(
+            FORM_CONTENT_TYPE))
+
+    remaining = get_content_length(environ, max_body_size)
+    stream = environ["wsgi.input"]
+
+    form_data = {}
+    field_count = 0
+
+    # Holds the part of the body we've read but not parsed yet. This will
+    # always be the beginning of a field whose end we haven't seen.
+    pending = ""
+
+    while remaining > 0:
+        chunk = stream.read(min(READ_SIZE, remaining))
+        if not chunk:
+            raise FormError(400, "Request body ended early.")
+        remaining -= len(chunk)
+
+        fields = (pending + chunk).split("&")
+
+        # The last field may continue in the next chunk, unless this was the
+        # last chunk.
+        if remaining > 0:
+            pending = fields.pop()
+        else:
+            pending = ""
+
+        for i in fields:
+            # Browsers don't send empty fields but a body like "a=1&&b=2" is
+            # still valid.
+            if not i:
+                continue
+
+            field_count += 1
+            if field_count > max_fields:
+                raise FormError(413, "Form may have at most {} fields.".format(
+                    max_fields))
+
+            key, value = _decode_field(i)
+            form_data[key] = value
+
+    return form_data
+
+def parse_query_string(environ, max_fields):
+    """
+    Parses the query string of a request the same way ``parse_urlencoded()``
+    parses a body. The server has already read the query string, so only the
+    number of fields is limited.
+
+    """
+
+    form_data = {}
+    fields = [i for i in environ.get("QUERY_STRING", "").split("&") if i]
+    if len(fields) > max_fields:
+        raise FormError(413, "Query may have at most {} fields.".format(
+            max_fields))
+
+    for i in fields:
+        key, value = _decode_field(i)
+        form_data[key] = value
+
+    return form_data
+
+def read_lines(environ, max_body_size, content_type = None):
+    """
+    Returns an iterator over the lines of a request's body (each ending with
+    its newline, except perhaps the last). The body is read a piece at a
+    time as the lines are asked for, so a large upload never has to be held
+    in memory all at once.
+
+    :param max_body_size: The most bytes the body may have.
+    :param content_type: If given, the body must be of this type.
+
+    :raises FormError: Right away if the body is too large or of the wrong
+        type. The iterator raises it if the body ends early.
+
+    """
+
+    if content_type is not None:
+        actual_type = environ.get("CONTENT_TYPE", "").partition(";")[0]
+        if actual_type.strip().lower() != content_type:
+            raise FormError(415, "Expected a body of type {}.".format(
+                content_type))
+
+    remaining = get_content_length(environ, max_body_size)
+    return _iter_lines(environ["wsgi.input"], remaining)
+
+def _iter_lines(stream, remaining):
+    # Holds the start of a line whose end we haven't read yet
+    pending = ""
+
+    while remaining > 0:
+        chunk = stream.read(min(READ_SIZE, remaining))
+        if not chunk:
+            raise FormError(400, "Request body ended early.")
+        remaining -= len(chunk)
+
+        lines = (pending + chunk).split("\n")
+        pending = lines.pop()
+        for i in lines:
+            yield i + "\n"
+
+    if pending:
+        yield pending
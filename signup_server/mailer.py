@@ -0,0 +1,325 @@
+"""
+Delivery of the emails waiting in the outbox (``database.OutboxMessage``).
+
+Request handlers only ever queue emails, which costs them one more row in a
+transaction they were making anyway. Talking to the mail server can take
+seconds, so it is left to the worker in ``mail-worker.py``, which runs a
+``Mailer`` in its own process. The mailer takes a batch of due messages at a
+time and sends them all over one SMTP connection, which it keeps open for as
+long as there is mail to send.
+
+A message that can't be sent is tried again later, waiting twice as long
+after each failure, and is given up on after ``max_attempts`` tries. A
+message is marked sent once the mail server has accepted it. If the worker
+dies between the two it will send the message again, with the same
+``Message-ID`` header so mail clients can tell it's the same email.
+
+To try this out without sending anyone email, point ``smtp_host`` and
+``smtp_port`` at a local stub server, such as the one that comes with Python::
+
+    python -m smtpd -n -c DebuggingServer localhost:1025
+
+"""
+
+# stdlib
+import time
+import random
+import socket
+import logging
+import smtplib
+import email.utils
+import email.header
+import email.mime.text
+
+# internal
+import database
+
+log = logging.getLogger("rock.mailer")
+
+CASH_INSTRUCTIONS = (u"To pay your dues in cash, bring them to any ACM@UCR "
+    u"meeting and let the officer collecting dues know the email you joined "
+    u"with. You'll get a receipt by email once your payment is recorded.")
+"""
+What members paying in cash are told to do, unless the ``cash_instructions``
+configuration option says otherwise.
+
+"""
+
+STATUS_MAIL_INTERVAL = 3600
+"""
+By default, the shortest time in seconds between two status emails sent to
+the same address by ``/check``.
+
+"""
+
+def compose_join_confirmation(config, member, payment_type):
+    """
+    Creates the email confirming that ``member`` joined. Members paying in
+    cash are told how to.
+
+    """
+
+    body = (u"Hi {},\n\nThanks for joining ACM@UCR! This email confirms that "
+        u"{} is now registered.\n".format(member.name or u"there",
+            member.email))
+    if payment_type == "cash":
+        instructions = config.get("cash_instructions")
+        if instructions is None:
+            instructions = CASH_INSTRUCTIONS
+        else:
+            instructions = instructions.decode("utf_8")
+        body += u"\n" + instructions + u"\n"
+
+    return database.OutboxMessage.compose(member.email,
+        u"Welcome to ACM@UCR", body, dedup_key = u"join:" + member.email)
+
+def compose_status_reply(config, email_address, status):
+    """
+    Creates the email answering a ``/check`` of ``email_address``.
+
+    Only one of these is queued per address every ``status_mail_interval``
+    seconds, so hammering ``/check`` can't be used to flood someone's inbox.
+
+    """
+
+    interval = int(config.get("status_mail_interval", STATUS_MAIL_INTERVAL))
+    dedup_key = u"check:{}:{}".format(email_address.lower(),
+        int(time.time()) // interval)
+
+    body = (u"Someone (hopefully you) asked for the membership status of this "
+        u"email address on the ACM@UCR website.\n\n{}\n".format(status))
+
+    return database.OutboxMessage.compose(email_address,
+        u"Your ACM@UCR membership status", body, dedup_key = dedup_key)
+
+class PermanentFailure(Exception):
+    """Raised when trying a message again won't help."""
+
+class Mailer(object):
+    """
+    Sends the messages in the outbox, see the module's documentation.
+
+    """
+
+    def __init__(self, db, connect, sender, batch_size = 50,
+            max_attempts = 12, retry_delay = 60, max_retry_delay = 3600,
+            lease_seconds = 300):
+        """
+        :param db: The ``sqlite3.Connection`` of the members database.
+        :param connect: A function returning a new, logged in
+            ``smtplib.SMTP`` object.
+        :param sender: The address messages are sent from.
+        :param batch_size: The most messages taken from the outbox at once.
+        :param max_attempts: How many times a message is tried before giving
+            up on it.
+        :param retry_delay: How long, in seconds, to wait after the first
+            failure. The wait doubles after each failure.
+        :param max_retry_delay: The longest wait between two tries.
+        :param lease_seconds: How long messages are hidden from other workers
+            once taken, see ``OutboxMessage.claim_due()``. Must be longer than
+            sending a batch takes.
+
+        """
+
+        self.db = db
+        self.connect = connect
+        self.sender = sender
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.lease_seconds = lease_seconds
+
+        # The connection to the mail server, while there's mail to send
+        self._smtp = None
+
+        # Message-ID headers need a domain, we use the sender's
+        self._domain = sender.rpartition("@")[2] or socket.getfqdn()
+
+    def send_batch(self):
+        """
+        Sends one batch of due messages.
+
+        :returns: The number of messages taken from the outbox. Fewer than
+            ``batch_size`` means the outbox has no more due messages.
+
+        """
+
+        messages = database.OutboxMessage.claim_due(self.db,
+            self.batch_size, self.lease_seconds)
+
+        sent = []
+        failures = []
+        unreachable = None
+        try:
+            for message in messages:
+                # Once we can't reach the mail server, don't wait on it to
+                # time out again for every other message in the batch.
+                if unreachable is not None:
+                    failures.append((message.id, unreachable,
+                        self._retry_at(message)))
+                    continue
+
+                try:
+                    self._send(message)
+                except PermanentFailure as e:
+                    log.warning("Giving up on message %r to %r: %s",
+                        message.id, message.recipient, e)
+                    failures.append((message.id, unicode(e), None))
+                except (smtplib.SMTPException, socket.error) as e:
+                    failures.append((message.id, unicode(e),
+                        self._retry_at(message)))
+                    log.warning("Could not send message %r to %r: %s",
+                        message.id, message.recipient, e)
+                    if isinstance(e, (socket.error, smtplib.SMTPConnectError,
+                            smtplib.SMTPServerDisconnected)):
+                        unreachable = unicode(e)
+
+                    # Whatever went wrong may have left the connection in a
+                    # bad state, start over with a new one.
+                    self.disconnect()
+                except Exception as e:
+                    # A bug (ours or smtplib's) shouldn't stop every other
+                    # message from going out, or have this one retried
+                    # forever without its attempts being counted.
+                    log.exception("Error sending message %r to %r.",
+                        message.id, message.recipient)
+                    failures.append((message.id, repr(e),
+                        self._retry_at(message)))
+                    self.disconnect()
+                else:
+                    sent.append(message.id)
+        finally:
+            # Both of these are one transaction for the whole batch. They're
+            # recorded even if something above escaped, so messages that
+            # went out aren't sent again.
+            if sent:
+                database.OutboxMessage.mark_sent(self.db, sent)
+            if failures:
+                database.OutboxMessage.mark_failed(self.db, failures)
+
+        if messages:
+            log.info("Sent %d messages, %d failed.", len(sent),
+                len(failures))
+
+        return len(messages)
+
+    def _retry_at(self, message):
+        # message.attempts doesn't count the try that just failed
+        if message.attempts + 1 >= self.max_attempts:
+            return None
+
+        delay = min(self.retry_delay * 2 ** message.attempts,
+            self.max_retry_delay)
+
+        # A little randomness keeps messages that failed together (say because
+        # the mail server was down) from all being retried at the same moment.
+        return time.time() + delay * random.uniform(0.75, 1.0)
+
+    def _send(self, message):
+        # Nothing checks the addresses people type in, and smtplib can only
+        # send to ASCII ones. An address with a line break in it could also
+        # sneak extra headers into the message.
+        try:
+            recipient = message.recipient.encode("ascii")
+        except UnicodeError:
+            raise PermanentFailure("the recipient isn't an ASCII address")
+        if not recipient or "\r" in recipient or "\n" in recipient:
+            raise PermanentFailure("the recipient isn't a valid address")
+
+        mime_message = email.mime.text.MIMEText(message.body.encode("utf_8"),
+            "plain", "utf_8")
+        mime_message["Subject"] = email.header.Header(message.subject,
+            "utf_8")
+        mime_message["From"] = self.sender
+        mime_message["To"] = recipient
+        mime_message["Date"] = email.utils.formatdate(message.created,
+            localtime = True)
+        mime_message["Message-ID"] = "<rock-outbox-{}@{}>".format(message.id,
+            self._domain)
+
+        if self._smtp is None:
+            self._smtp = self.connect()
+
+        try:
+            self._smtp.sendmail(self.sender, [recipient],
+                mime_message.as_string())
+        except smtplib.SMTPRecipientsRefused as e:
+            # The recipient and the message itself are all that's different
+            # about each message, so only a permanent (5xx) refusal of one of
+            # them is a reason to give up on just this message.
+            code, reason = e.recipients.values()[0]
+            if code >= 500:
+                raise PermanentFailure("{} {}".format(code, reason))
+            raise
+        except smtplib.SMTPDataError as e:
+            if e.smtp_code >= 500:
+                raise PermanentFailure("{} {}".format(e.smtp_code,
+                    e.smtp_error))
+            raise
+
+    def disconnect(self):
+        if self._smtp is None:
+            return
+
+        try:
+            self._smtp.quit()
+        except (smtplib.SMTPException, socket.error):
+            self._smtp.close()
+        self._smtp = None
+
+    def run(self, poll_interval = 5, once = False):
+        """
+        Sends messages until interrupted, checking the outbox for new ones
+        every ``poll_interval`` seconds once it's empty.
+
+        :param once: If true, return once the outbox has no more due messages
+            instead.
+
+        """
+
+        try:
+            while True:
+                if self.send_batch() >= self.batch_size:
+                    continue
+
+                # The mail server would close an idle connection eventually
+                # anyway.
+                self.disconnect()
+                if once:
+                    return
+
+                time.sleep(poll_interval)
+        finally:
+            self.disconnect()
+
+def create_mailer(config, db):
+    """
+    Creates the ``Mailer`` described by the configuration.
+
+    :param config: The dictionary of options from the ``[rock]`` section of
+        the configuration file.
+    :param db: The connection the mailer should use.
+
+    """
+
+    host = config.get("smtp_host", "localhost")
+    port = int(config.get("smtp_port", "25"))
+    timeout = float(config.get("smtp_timeout", "30"))
+    username = config.get("smtp_username")
+    starttls = config.get("smtp_starttls", "false").lower() in ("1", "yes",
+        "true", "on")
+
+    def connect():
+        smtp = smtplib.SMTP(host, port, timeout = timeout)
+        if starttls:
+            smtp.starttls()
+        if username:
+            smtp.login(username, config.get("smtp_password", ""))
+        return smtp
+
+    return Mailer(db, connect, config["mail_from"],
+        batch_size = int(config.get("mail_batch_size", "50")),
+        max_attempts = int(config.get("mail_max_attempts", "12")),
+        retry_delay = float(config.get("mail_retry_delay", "60")),
+        max_retry_delay = float(config.get("mail_max_retry_delay", "3600")))
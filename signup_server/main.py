@@ -19,16 +19,33 @@ necessary.
 # stdlib
 import os
 import sys
-import cgi
+import csv
+import hmac
+import json
+import math
+import base64
+import time
+import atexit
+import signal
 import httplib
 import logging
 import ConfigParser
-import wsgiref
+import wsgiref.util
 import sqlite3
 import datetime
+import threading
+import collections
 
 # internal
 import database
+import rate_limiting
+import connections
+import cache
+import forms
+import metrics
+import mailer
+import bulk
+import admission
 
 # Create a logging object we can use throughout the application
 log = logging.getLogger("rock")
@@ -47,23 +64,132 @@ is the configuration file that will be loaded.
 
 """
 
+CONFIG_CHECK_INTERVAL = 2
+"""
+How often, in seconds, the configuration file is checked for changes while
+requests are coming in.
+
+"""
+
+RESTART_OPTIONS = frozenset([
+    "db_file", "journal_mode", "rate_limiter", "rate_limiter_file",
+    "rate_limit_bucket_seconds", "client_limit_buckets",
+    "client_limit_max_keys", "group_commit", "group_commit_max_batch",
+    "group_commit_max_delay_ms", "sql_profile", "sql_slow_ms",
+    "sql_profile_at_exit", "metrics_dir", "event_threads", "event_max_queued",
+    "event_max_connections", "keep_alive_timeout", "member_filter",
+    "member_filter_capacity", "member_filter_error_rate",
+    "admission_max_active", "admission_max_waiting", "admission_timeout_ms",
+    "admission_retry_after"
+])
+"""
+Options that are only looked at when the application starts. Changing them in
+the configuration file has no effect until every process serving the site has
+been restarted. Any option not listed here takes effect when the
+configuration is reloaded, see ``reload_config()``.
+
+"""
+
+CONNECTION_OPTIONS = ("busy_timeout_ms", "synchronous", "cached_statements")
+"""
+Options that are set when a database connection is made, so changing them
+means making new connections.
+
+"""
+
 # This will hold a dictionary containing our configuration options
 config = None
 
-# This will hold our sqlite3.Connection object we'll use to query our database
-db = None
+# The path of the configuration file we loaded, and its modification time
+# when we did.
+config_path = None
+config_mtime = None
+
+# This will hold the connections.ConnectionManager that hands out the
+# sqlite3.Connection objects we'll use to query our database
+connection_manager = None
+
+# This will hold the rate limiting backend picked in the configuration file
+rate_limiter = None
+
+# This will hold the rate_limiting.SlidingWindowLimiter that keeps individual
+# clients from using up the site-wide limits.
+client_limiter = None
+
+# This will hold a cache.LRUCache mapping emails to database.Member objects (or
+# None for emails that aren't registered) so that repeated checks don't go to
+# the database.
+member_cache = None
+
+# This will hold a cache.BloomFilter of every registered email so that most
+# duplicate signups can be turned away without touching the database, or None
+# if it's disabled in the configuration file.
+member_filter = None
+
+# This will hold a database.GroupCommitter if group commit mode is enabled in
+# the configuration file, otherwise it will be None.
+group_committer = None
+
+# This will hold a database.StatementProfiler if SQL profiling is enabled in
+# the configuration file, otherwise it will be None.
+statement_profiler = None
+
+# This will hold the metrics.SnapshotDirectory where each process serving the
+# site shares its metrics, or None if the configuration file doesn't name one.
+metrics_snapshots = None
+
+# This will hold the admission.AdmissionMiddleware that limits how many
+# requests wait on the database's write lock at once.
+admission_controller = None
+
+# This will hold the metrics.MetricsMiddleware wrapped around dispatch() (by
+# way of the admission controller) once we've been initialized.
+instrumented_app = None
+
+def config_boolean(name, default = False):
+    """
+    Interprets the configuration option ``name`` as a boolean, the same way
+    ``ConfigParser`` would.
+
+    """
+
+    if name not in config:
+        return default
+
+    return config[name].lower() in ("1", "yes", "true", "on")
+
+def load_config(path):
+    """
+    Reads the configuration file at ``path``.
+
+    :returns: A dictionary of the options in its ``[rock]`` section.
+
+    """
+
+    config_parser = ConfigParser.RawConfigParser()
+    with open(path, "r") as config_file:
+        config_parser.readfp(config_file)
+
+    # This will grab all of the configuration options under the rock section
+    # in the ini file and put them in our config dictionary.
+    return dict(config_parser.items("rock"))
 
-# Load the configuration file when the module is imported so everyone has
-# access to it.
-def initialize():
+def initialize(path = None):
     """
     This performs any initialization logic for our application. It will be run
-    once per WSGI process.
+    once per WSGI process, either by ``create_app()`` or when the first request
+    comes in.
+
+    :param path: The configuration file to load. By default this is the file
+        named by the environmental variable ``CONFIG_PATH_VAR``, or
+        ``DEFAULT_CONFIG_PATH`` if it isn't set.
 
     """
 
     # Let the user know how the configuration file is going to be loaded
-    if CONFIG_PATH_VAR in os.environ:
+    if path is not None:
+        print "Loading configuration at {}.".format(path)
+    elif CONFIG_PATH_VAR in os.environ:
         print ("Environmental variable {} set. Loading configuration at "
             "{}.".format(CONFIG_PATH_VAR, os.environ[CONFIG_PATH_VAR]))
     else:
@@ -71,31 +197,425 @@ def initialize():
             "configuration at {}.".format(
                 CONFIG_PATH_VAR, DEFAULT_CONFIG_PATH))
 
-    # Actually load the configuration file
-    config_file_path = os.environ.get(CONFIG_PATH_VAR, DEFAULT_CONFIG_PATH)
-    config_file = open(config_file_path, "r")
+    # Actually load the configuration file. We note when it was last changed
+    # so we can tell when it's changed again.
+    global config, config_path, config_mtime
+    if path is None:
+        path = os.environ.get(CONFIG_PATH_VAR, DEFAULT_CONFIG_PATH)
+    config_path = path
+    config_mtime = os.stat(path).st_mtime
+    config = load_config(path)
 
-    # Parse the configuration file
-    config_parser = ConfigParser.RawConfigParser()
-    config_parser.readfp(config_file)
+    # Profiling times every SQL statement we run so we can see whether we're
+    # waiting on locks, on fsyncs or on the queries themselves.
+    global statement_profiler
+    if config_boolean("sql_profile"):
+        slow_ms = config.get("sql_slow_ms")
+        statement_profiler = database.StatementProfiler(
+            slow_threshold = float(slow_ms) / 1000 if slow_ms else None)
+        if config_boolean("sql_profile_at_exit", True):
+            atexit.register(statement_profiler.dump_summary)
+    else:
+        statement_profiler = None
 
-    # This will grab all of the configuration options under the rock section
-    # in the ini file and put them in our config dictionary.
-    global config
-    config = dict(config_parser.items("rock"))
+    # Set up the connections to the sqlite database. Each thread that handles
+    # requests will get its own connections.
+    global connection_manager
+    connection_manager = connections.create_manager(config,
+        profiler = statement_profiler)
+
+    # Create any missing tables and bring the existing ones up to date. The
+    # request handlers rely on this having been done.
+    database.initialize_schema(connection_manager.writer())
+
+    # Pick the rate limiting backend. See the rate_limiting module for the
+    # available backends.
+    global rate_limiter
+    rate_limiter = rate_limiting.create_backend(config)
+    global client_limiter
+    client_limiter = rate_limiting.create_client_limiter(config)
+
+    # Group commit mode trades a few milliseconds of latency on each signup
+    # for far fewer fsyncs when many people are signing up at once.
+    global group_committer
+    if config_boolean("group_commit"):
+        group_committer = database.GroupCommitter(
+            max_batch_size = int(config.get("group_commit_max_batch", "50")),
+            max_delay = float(config.get("group_commit_max_delay_ms", "5"))
+                / 1000)
+    else:
+        group_committer = None
+
+    # Members are cached for a short time and dropped from the cache whenever
+    # they change.
+    global member_cache
+    member_cache = cache.LRUCache(
+        max_size = int(config.get("member_cache_size", "1024")),
+        ttl = float(config.get("member_cache_ttl", "60")))
+    database.add_change_listener(invalidate_member_cache)
+
+    # Every email that's registered goes into the member filter, as does
+    # every member who joins from now on (at least through this process).
+    global member_filter
+    if config_boolean("member_filter", True):
+        member_filter = create_member_filter(connection_manager.reader())
+        database.add_change_listener(remember_member)
+    else:
+        member_filter = None
+
+    # When the site is served by several processes they each need to write
+    # their metrics somewhere the process answering /metrics can read them.
+    global metrics_snapshots
+    if "metrics_dir" in config:
+        metrics_snapshots = metrics.SnapshotDirectory(config["metrics_dir"])
+    else:
+        metrics_snapshots = None
+    metrics.registry.add_collector(collect_metrics)
+
+    # Requests that write to the database are let in a few at a time, and
+    # turned away quickly once too many are waiting, rather than all piling
+    # up on the write lock.
+    global admission_controller
+    admission_controller = admission.AdmissionMiddleware(dispatch,
+        [path for path, route in ROUTE_TABLE.items() if route.writes],
+        error_response, metrics.registry,
+        max_active = int(config.get("admission_max_active", "4")),
+        max_waiting = int(config.get("admission_max_waiting", "16")),
+        timeout = float(config.get("admission_timeout_ms", "500")) / 1000,
+        retry_after = int(config.get("admission_retry_after", "1")))
+
+    # This times every request and records how we responded, including the
+    # requests the admission controller turned away.
+    global instrumented_app
+    instrumented_app = metrics.MetricsMiddleware(admission_controller,
+        metrics.registry, ROUTE_TABLE, snapshots = metrics_snapshots)
+
+# Set by a SIGHUP to have the next request reload the configuration file
+reload_requested = False
+
+def request_reload(signum = None, frame = None):
+    """
+    Makes the next request reload the configuration file. This is the SIGHUP
+    handler installed by ``install_reload_signal()``, and only sets a flag
+    because a signal handler may interrupt anything, including a request in
+    the middle of reading the configuration.
+
+    """
+
+    global reload_requested
+    reload_requested = True
+
+def install_reload_signal():
+    """
+    Reloads the configuration file on SIGHUP. Signal handlers can only be
+    installed by the main thread, so servers that want this should call this
+    themselves when starting up.
+
+    """
+
+    signal.signal(signal.SIGHUP, request_reload)
+
+RELOADED_NUMBERS = {
+    "busy_timeout_ms": int,
+    "cached_statements": int,
+    "member_cache_size": int,
+    "member_cache_ttl": float,
+    "status_mail_interval": int,
+    "import_batch_size": int
+}
+"""
+Options that are numbers and take effect when the configuration is
+reloaded, besides the ``max_*`` options (which are all whole numbers).
+
+"""
+
+REQUIRED_OPTIONS = ("max_joins_per_minute", "max_checks_per_minute")
+"""Options the request handlers can't do without."""
+
+def check_reloaded_config(new_config):
+    """
+    Makes sure every option that takes effect when the configuration is
+    reloaded has a value we can use, so that applying it can't fail halfway
+    through (or fail the requests that come after).
+
+    :raises ValueError: If an option is missing or has a bad value.
+
+    """
+
+    for key in REQUIRED_OPTIONS:
+        if key not in new_config:
+            raise ValueError("the {} option is required".format(key))
+
+    for key, value in new_config.items():
+        parse = RELOADED_NUMBERS.get(key)
+        if parse is None and key.startswith("max_"):
+            parse = int
+        if parse is None:
+            continue
+
+        try:
+            number = parse(value)
+        except ValueError:
+            raise ValueError("the {} option must be a number, not {}".format(
+                key, repr(value)))
+        if number < 0:
+            raise ValueError("the {} option can't be negative".format(key))
+
+    connections.check_synchronous(new_config.get("synchronous", "NORMAL"))
+
+def reload_config():
+    """
+    Reloads the configuration file and applies what changed, without
+    interrupting requests that are being handled.
+
+    Most options are looked up by the request handlers every time they're
+    used, so swapping in the new dictionary is all they need. Connection
+    settings make each thread open new connections the next time it asks for
+    one, and the member cache is resized in place. Options in
+    ``RESTART_OPTIONS`` keep their old values, with a warning.
+
+    Nothing is applied unless every new value is usable. A file that isn't
+    is complained about and tried again the next time the configuration is
+    checked, in case it was caught halfway through being written.
+
+    :returns: Whether the configuration was reloaded.
+
+    """
+
+    global config, config_mtime
+    try:
+        new_mtime = os.stat(config_path).st_mtime
+        new_config = load_config(config_path)
+    except Exception:
+        log.exception("Could not reload the configuration at %r, keeping "
+            "the current configuration.", config_path)
+        return False
+
+    for key in RESTART_OPTIONS:
+        if new_config.get(key) != config.get(key):
+            log.warning("The %r option can't be changed without restarting, "
+                "keeping %r.", key, config.get(key))
+            if key in config:
+                new_config[key] = config[key]
+            else:
+                del new_config[key]
+
+    try:
+        check_reloaded_config(new_config)
+    except ValueError as e:
+        log.error("Could not reload the configuration at %r, keeping the "
+            "current configuration: %s.", config_path, e)
+        return False
+
+    if any(new_config.get(i) != config.get(i) for i in CONNECTION_OPTIONS):
+        connection_manager.reconfigure(
+            busy_timeout = int(new_config.get("busy_timeout_ms", "5000")),
+            synchronous = new_config.get("synchronous", "NORMAL"),
+            cached_statements = int(new_config.get("cached_statements",
+                "128")))
+
+    member_cache.resize(
+        max_size = int(new_config.get("member_cache_size", "1024")),
+        ttl = float(new_config.get("member_cache_ttl", "60")))
+
+    config = new_config
+    config_mtime = new_mtime
+    log.warning("Reloaded the configuration at %r.", config_path)
+    return True
+
+_initialize_lock = threading.Lock()
+_next_config_check = 0
+
+def create_app(path = None):
+    """
+    Initializes the application (if it hasn't been already) and returns the
+    WSGI application to serve. Importing this module does nothing, so this is
+    the place to fail early when the configuration or database is broken.
+
+    """
+
+    with _initialize_lock:
+        if instrumented_app is None:
+            initialize(path)
+
+    return app
+
+def maybe_reload_config():
+    """
+    Reloads the configuration file if we got a SIGHUP or if the file has been
+    changed. The file is only looked at every ``CONFIG_CHECK_INTERVAL``
+    seconds.
+
+    """
+
+    global reload_requested, _next_config_check
+    now = time.time()
+    if not reload_requested and now < _next_config_check:
+        return
+
+    with _initialize_lock:
+        if not reload_requested and now < _next_config_check:
+            return
+        _next_config_check = now + CONFIG_CHECK_INTERVAL
+
+        try:
+            changed = os.stat(config_path).st_mtime != config_mtime
+        except OSError:
+            # The file may be in the middle of being replaced
+            changed = False
+
+        if reload_requested or changed:
+            reload_requested = False
+            reload_config()
+
+def invalidate_member_cache(model, key):
+    """
+    Called by the database module whenever a row changes, see
+    ``database.add_change_listener()``.
 
-    # Connect to the sqlite database. We set the isolation_level to None here
-    # in order to disable automatic transactions. See
-    # http://johncs.com/posts/1-sqlite3_transactions.htm for more information
-    # on this behavior.
-    global db
-    db = sqlite3.connect(config["db_file"], isolation_level = None)
+    """
+
+    if model is database.Member and member_cache is not None:
+        member_cache.invalidate(key)
+
+def create_member_filter(db):
+    """
+    Creates a ``cache.BloomFilter`` holding the email of every member. It is
+    sized for the ``member_filter_capacity`` option, or twice the number of
+    members if that's larger, so there's room for plenty more to join.
+
+    """
+
+    capacity = max(int(config.get("member_filter_capacity", "10000")),
+        2 * database.Member.count(db))
+    member_filter = cache.BloomFilter(capacity,
+        error_rate = float(config.get("member_filter_error_rate", "0.01")))
+    for email in database.Member.iter_keys(db):
+        member_filter.add(email)
+
+    log.info("Loaded %d members into the member filter (%d bits).",
+        member_filter.count, member_filter.bit_count)
+
+    return member_filter
+
+def remember_member(model, key):
+    """
+    Called by the database module whenever a row changes, see
+    ``database.add_change_listener()``.
+
+    """
+
+    if model is database.Member and member_filter is not None:
+        member_filter.add(key)
+
+def is_registered(email):
+    """
+    Returns ``True`` if ``email`` is already registered, going to the
+    database only if the member filter says it might be.
+
+    Members who joined through another process since we started aren't in
+    our filter, so this can say ``False`` for them. Inserting them will still
+    fail, it will just take longer to.
+
+    """
 
-# Run our initialization code. This will occur when this module is first
-# imported.
-initialize()
+    if member_filter is None:
+        return False
+
+    if email not in member_filter:
+        metrics.registry.increment("rock_member_filter_lookups_total",
+            result = "absent")
+        return False
+
+    # The filter only knows the email might be registered. Its primary key
+    # index can tell us for sure without waiting on anyone's write.
+    registered = database.Member.get(connection_manager.reader(),
+        email) is not None
+    metrics.registry.increment("rock_member_filter_lookups_total",
+        result = "present" if registered else "false_positive")
+
+    return registered
+
+def get_member(email):
+    """
+    Looks up the member with the given email, going to the database only if
+    they aren't in our cache.
+
+    :returns: A ``database.Member`` object, or ``None`` if nobody with that
+        email has joined.
+
+    """
+
+    member = member_cache.get(email)
+    if member is cache.MISSING:
+        # If they join while we're looking them up, the None we found must
+        # not be cached after the join has invalidated their entry.
+        version = member_cache.version(email)
+        member = database.Member.get(connection_manager.reader(), email)
+        member_cache.put(email, member, version = version)
+
+    return member
+
+def insert_rows(db, instances):
+    """
+    Inserts the given model objects in one transaction, as part of a group
+    commit batch if group commit mode is enabled.
+
+    """
+
+    if group_committer is not None:
+        group_committer.insert(db, *instances)
+    else:
+        database.insert_all(db, instances)
+
+def collect_metrics():
+    """
+    Reports the counters kept by the member cache, the client limiter, the
+    group committer, the admission controller and the statement profiler, see
+    ``metrics.Registry.add_collector()``.
 
-def error_response(code, start_response, message = None):
+    """
+
+    collected = []
+    if member_filter is not None:
+        for name, value in sorted(member_filter.stats().items()):
+            collected.append(("rock_member_filter_" + name, {}, value))
+
+    if member_cache is not None:
+        for name, value in sorted(member_cache.stats().items()):
+            collected.append(("rock_member_cache_" + name, {}, value))
+
+    if group_committer is not None:
+        stats = group_committer.stats()
+        for name in ("flush_count", "fallback_count", "flush_seconds_total",
+                "flush_seconds_max"):
+            collected.append(("rock_group_commit_" + name, {}, stats[name]))
+
+    if client_limiter is not None:
+        for name, value in sorted(client_limiter.stats().items()):
+            collected.append(("rock_client_limiter_" + name, {}, value))
+
+    if admission_controller is not None:
+        for name, value in sorted(admission_controller.stats().items()):
+            collected.append(("rock_admission_" + name, {}, value))
+
+    if statement_profiler is not None:
+        count, seconds = statement_profiler.lock_wait()
+        collected.append(("rock_sql_lock_waits", {}, count))
+        collected.append(("rock_sql_lock_wait_seconds", {}, seconds))
+
+    return collected
+
+EXTRA_DESCRIPTIONS = {
+    429: "Too Many Requests"
+}
+"""
+Descriptions of the status codes we use that ``httplib.responses`` doesn't
+know about.
+
+"""
+
+def error_response(code, start_response, message = None, headers = None):
     """
     Sends a simple error response to the user that includes the error code and
     a generic description of the error.
@@ -110,19 +630,22 @@ def error_response(code, start_response, message = None):
     :param code: The error code (ex: 404).
     :param start_response: The same ``start_response`` callable provided to
         the WSGI app.
+    :param message: An explanation of the error shown below the status.
+    :param headers: A list of any extra headers to send, such as the
+        ``Allow`` header a 405 response should have.
 
     :returns: An iterable appropriate to return from the WSGI app callable.
 
     """
 
     # Get a textual description of the error so we can give it to the user
-    description = httplib.responses[code]
+    description = httplib.responses.get(code) or EXTRA_DESCRIPTIONS[code]
 
     # The status should look similar to 404 Not Found
     status = "{} {}".format(code, description)
 
     # Figure out any headers we need
-    headers = [("Content-Type", "text/plain")]
+    headers = [("Content-Type", "text/plain")] + (headers or [])
 
     # Figure out the content we're going to send to the user
     content = "{}".format(status)
@@ -133,10 +656,24 @@ def error_response(code, start_response, message = None):
     start_response(status, headers)
     return [content]
 
-def app(environ, start_response):
+Route = collections.namedtuple("Route",
+    ["handler", "method", "check_referer", "raw_body", "writes"])
+Route.__new__.__defaults__ = (False, False)
+"""
+Describes how a path is served. ``handler`` is called with the environ, the
+parsed form data (or query string for ``GET`` routes) and ``start_response``.
+Requests using any method other than ``method`` are turned away, as are
+requests that don't come from one of our pages if ``check_referer`` is true.
+If ``raw_body`` is true the body is left for the handler to read, and it's
+given the parsed query string instead. Routes whose handler writes to the
+database should set ``writes`` so the admission controller limits them.
+
+"""
+
+def dispatch(environ, start_response):
     """
     The entry point to our application. Every request we receive will start
-    here.
+    here (by way of the ``app`` below, which times it).
 
     .. seealso::
 
@@ -149,73 +686,133 @@ def app(environ, start_response):
 
     """
 
-    # We don't support anything but POST requests so tell them to go away if
-    # they try anything else.
-    if environ["REQUEST_METHOD"] != "POST":
+    # Grab the path they're trying to hit (like /check or /join)
+    path_info = environ["PATH_INFO"]
+    if path_info not in ROUTE_TABLE:
+        return error_response(404, start_response)
+    route = ROUTE_TABLE[path_info]
+
+    # Each route only supports one method so tell them to go away if they try
+    # anything else.
+    if environ["REQUEST_METHOD"] != route.method:
         # See http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.6
         # for more information on this response.
-        return error_response(405, start_response)
+        return error_response(405, start_response,
+            headers = [("Allow", route.method)])
 
     # CSRF attacks are very common, and though we do not have the ability to
     # protect against these attacks using the typical token-per-form approach
     # checking the referrer header seems to be a solid approach when done
     # right. Hopefully I'm doing it right here. For more information on this
     # see https://www.owasp.org/index.php/Cross-Site_Request_Forgery_%28CSRF%29_Prevention_Cheat_Sheet#Checking_The_Referer_Header
+    if route.check_referer:
+        # This will grab the url of our application. For example,
+        # http://localhost:8000 or http://acm.cs.ucr.edu might be the value
+        # here
+        app_url = wsgiref.util.application_uri(environ)
 
-    # This will grab the url of our application. For example,
-    # http://localhost:8000 or http://acm.cs.ucr.edu might be the value here
-    app_url = wsgiref.util.application_uri(environ)
+        # Make sure that the referer comes from our site
+        if not environ.get("HTTP_REFERER", "").startswith(app_url):
+            # There's not really an ideal status code to return here but
+            # unauthorized seemed like the best fit.
+            return error_response(401, start_response)
 
-    # Make sure that the referer comes from our site
-    if not environ.get("HTTP_REFERER", "").startswith(app_url):
-        # There's not really an ideal status code to return here but
-        # unauthorized seemed like the best fit.
-        return error_response(401, start_response)
+    # Parse the form data we received into a dictionary. All the keys and
+    # values in this dictionary will be unicode objects. Requests that are
+    # larger than any of our forms could produce are turned away before we
+    # read them.
+    max_fields = int(config.get("max_form_fields", "20"))
+    try:
+        if route.method == "POST" and not route.raw_body:
+            form_data = forms.parse_urlencoded(environ,
+                max_body_size = int(config.get("max_body_size", "16384")),
+                max_fields = max_fields)
+        else:
+            form_data = forms.parse_query_string(environ, max_fields)
+    except forms.FormError as e:
+        return error_response(e.code, start_response, e.message)
 
-    # Associate paths with different handling functions
-    ROUTE_TABLE = {"/join": handle_join, "/check": handle_check}
+    return route.handler(environ, form_data, start_response)
 
-    # Grab the path they're trying to hit (like /check or /join)
-    path_info = environ["PATH_INFO"]
-    if path_info not in ROUTE_TABLE:
-        return error_response(404, start_response)
-    handler = ROUTE_TABLE[path_info]
+def rate_limited_response(route, scope, start_response):
+    """
+    Turns away a request that went over a rate limit with a ``429``, telling
+    the client when the limit it hit lets up.
 
-    # Let the cgi module parse out the form data we received
-    form_data_storage = cgi.FieldStorage(
-        fp = environ["wsgi.input"],
-        environ = environ,
-        keep_blank_values = True
-    )
+    :param route: The path that was requested.
+    :param scope: Which limit was hit, ``site`` or one of
+        ``CLIENT_LIMIT_SCOPES``.
+
+    """
+
+    metrics.registry.increment("rock_rate_limited_total", route = route,
+        scope = scope)
+
+    limiter = rate_limiter if scope == "site" else client_limiter
+    retry_after = int(math.ceil(limiter.retry_after()))
+    return error_response(429, start_response,
+        "Request failed due to rate limiting.",
+        headers = [("Retry-After", str(retry_after))])
+
+CLIENT_LIMIT_SCOPES = ("client", "email")
+"""
+The ways a single client's actions can be limited: by their address, or by
+the email they submitted. The limits are set with the
+``max_<action>s_per_<scope>_per_minute`` configuration options, any of which
+may be left out.
+
+"""
+
+def limited_client_scope(environ, action, form_data):
+    """
+    Checks (and counts) an action against the per-client limits.
+
+    :returns: The scope whose limit the action went over, or ``None`` if the
+        action is allowed.
+
+    """
+
+    for scope in CLIENT_LIMIT_SCOPES:
+        limit = config.get("max_{}s_per_{}_per_minute".format(action, scope))
+        if not limit:
+            continue
+
+        if scope == "client":
+            value = environ.get("REMOTE_ADDR", "")
+        else:
+            # Emails are case insensitive in practice, so don't let changing
+            # the case get anyone around the limit.
+            value = form_data.get("email", u"").lower()
+            if not value:
+                continue
 
-    # Convert the form data into a more convenient dictionary. We also decode
-    # the text here. We expect the text to be encoded using UTF-8 because
-    # browsers should default to using the encoding that the document is
-    # encoded in (which is UTF-8 for our site). All the keys and values in
-    # this dictionary will be unicode objects.
-    form_data = {}
-    for i in form_data_storage.keys():
-        key = i.decode("utf_8")
-        value = form_data_storage[i].value.decode("utf_8")
-        form_data[key] = value
+        if not client_limiter.try_action((action, scope, value), int(limit)):
+            return scope
 
-    return handler(form_data, start_response)
+    return None
 
-def handle_join(form_data, start_response):
-    # This ensures that the rate limiting table is created and has the exact
-    # columns we expect it to.
-    database.RateLimiter.create_table(db)
+def handle_join(environ, form_data, start_response):
+    db = connection_manager.writer()
+
+    # Turn away anyone making far more join attempts than a person would
+    # before they can eat into the site-wide limit below.
+    scope = limited_client_scope(environ, "join", form_data)
+    if scope is not None:
+        return rate_limited_response("/join", scope, start_response)
+
+    # Most duplicate signups are double submits and people who forgot they'd
+    # already joined. Turn them away before taking the database's write lock
+    # (which both the site-wide limit and the insert below need).
+    if is_registered(form_data["email"]):
+        metrics.registry.increment("rock_duplicate_emails_total")
+        return error_response(500, start_response,
+            "Email is already registered.")
 
     # See if we should reject the join attempt because too many attempts have
     # been made site-wide in this minute.
-    if not database.RateLimiter.try_action(db, "join",
+    if not rate_limiter.try_action(db, "join",
             int(config["max_joins_per_minute"])):
-        return error_response(500, start_response,
-            "Request failed due to rate limiting.")
-
-    # This ensures that the member table is created and that it has the exact
-    # columns we expect it to.
-    database.Member.create_table(db)
+        return rate_limited_response("/join", "site", start_response)
 
     # Craft a new member (doesn't put it into the database immediately)
     new_member = database.Member(
@@ -226,16 +823,26 @@ def handle_join(form_data, start_response):
         paid_on = None
     )
 
+    # The confirmation email goes into the outbox in the same transaction as
+    # the member, so they either both make it or neither does.
+    rows = [new_member]
+    if config_boolean("send_mail"):
+        rows.append(mailer.compose_join_confirmation(config, new_member,
+            form_data.get("payment-type")))
+
     try:
         # Add the member to the database
-        new_member.insert(db)
-    except sqlite3.IntegrityError:
+        insert_rows(db, rows)
+    except sqlite3.IntegrityError as e:
         # This will occur if the email that was provided was not unique or some
         # other contraint was violated. We will assume the case is the former,
         # but check the logs for the actual exception if users are reporting
-        # difficulties joining.
-        log.info("Could not add user with email %r to database.",
-            form_data["email"], exc_info = True)
+        # difficulties joining. With the member filter on, this only happens
+        # when two people join with the same email at about the same time, or
+        # when they joined through another process.
+        log.info("Could not add user with email %r to database: %s",
+            form_data["email"], e)
+        metrics.registry.increment("rock_duplicate_emails_total")
         return error_response(500, start_response,
             "Email is already registered.")
 
@@ -244,19 +851,378 @@ def handle_join(form_data, start_response):
     start_response(status, response_headers)
     return ["I am a teapot."]
 
-def handle_check(form_data, start_response):
-    # This ensures that the rate limiting table is created and has the exact
-    # columns we expect it to.
-    database.RateLimiter.create_table(db)
+def handle_check(environ, form_data, start_response):
+    db = connection_manager.writer()
+
+    scope = limited_client_scope(environ, "check", form_data)
+    if scope is not None:
+        return rate_limited_response("/check", scope, start_response)
 
     # See if we should reject the check attempt because too many attempts have
     # been made site-wide in this minute
-    if not database.RateLimiter.try_action(db, "check",
+    if not rate_limiter.try_action(db, "check",
             int(config["max_checks_per_minute"])):
-        return error_response(500, start_response,
-            "Request failed due to rate limiting.")
+        return rate_limited_response("/check", "site", start_response)
+
+    if "email" not in form_data:
+        return error_response(400, start_response, "No email was given.")
+    email = form_data["email"]
+
+    member = get_member(email)
+    if member is None:
+        message = u"{} is not a member.".format(email)
+    else:
+        # The first 10 characters of the timestamps are the date, like
+        # 2014-09-30.
+        message = u"{} has been a member since {}.".format(email,
+            unicode(member.joined)[:10])
+        if member.paid_on is None:
+            message += u" Membership dues have not been paid yet."
+        else:
+            message += u" Membership dues were paid on {}.".format(
+                unicode(member.paid_on)[:10])
+
+    if config_boolean("send_mail"):
+        try:
+            insert_rows(db, [mailer.compose_status_reply(config, email,
+                message)])
+        except sqlite3.IntegrityError:
+            # We've already queued a status email for this address recently
+            log.info("Not sending another status email to %r.", email)
 
     status = "200 OK"
-    response_headers = [("Content-type", "text/plain")]
+    response_headers = [("Content-type", "text/plain; charset=utf-8")]
+    start_response(status, response_headers)
+    return [message.encode("utf_8")]
+
+def check_token(environ, start_response, option, realm):
+    """
+    Makes sure the request has an ``Authorization: Bearer <token>`` header
+    with the token set by the configuration option ``option``. Without a
+    token there's no way in, so we pretend there's nothing here.
+
+    :returns: ``None`` if the request may go ahead, otherwise the error
+        response to send.
+
+    """
+
+    token = config.get(option)
+    if not token:
+        return error_response(404, start_response)
+
+    # compare_digest takes as long to reject a wrong token no matter how much
+    # of it was right, so the token can't be guessed one character at a time.
+    authorization = environ.get("HTTP_AUTHORIZATION", "")
+    if not hmac.compare_digest(authorization, "Bearer " + token):
+        return error_response(401, start_response,
+            headers = [("WWW-Authenticate", 'Bearer realm="{}"'.format(
+                realm))])
+
+    return None
+
+def handle_metrics(environ, form_data, start_response):
+    # The metrics say a fair bit about who is signing up and when, so only
+    # whoever has the token from the configuration file may see them.
+    denied = check_token(environ, start_response, "metrics_token", "metrics")
+    if denied is not None:
+        return denied
+
+    if metrics_snapshots is None:
+        content = metrics.registry.render()
+    else:
+        # Our own snapshot may be a few seconds old, bring it up to date
+        # before adding everyone's together.
+        metrics_snapshots.write(metrics.registry)
+        content = metrics.registry.render(metrics_snapshots.read_all())
+
+    status = "200 OK"
+    response_headers = [("Content-type", "text/plain; version=0.0.4")]
     start_response(status, response_headers)
-    return [repr(form_data)]
+    return [content]
+
+ADMIN_PAGE_SIZE = 100
+"""How many members ``/admin/members`` lists per page by default."""
+
+ADMIN_MAX_PAGE_SIZE = 1000
+"""The most members ``/admin/members`` will list per page."""
+
+EXPORT_BATCH_SIZE = 500
+"""How many members are fetched and sent at a time when exporting CSV."""
+
+MEMBER_FIELDS = ("joined", "email", "name", "shirt_size", "paid_on")
+"""The fields of each member listed by ``/admin/members``, in order."""
+
+def parse_member_search(form_data):
+    """
+    Turns the query string given to ``/admin/members`` into the keyword
+    arguments of ``database.Member.search()``. The filters are:
+
+    * ``joined_from`` and ``joined_until``: The first and last day (like
+      2014-09-30) members joined on.
+    * ``paid``: ``yes`` or ``no``.
+    * ``shirt_size``: The shirt size members asked for.
+    * ``after``: The ``next`` value of the previous page.
+
+    Raises ``ValueError`` with a message for the user if the query string
+    isn't valid.
+
+    """
+
+    def parse_day(name):
+        try:
+            return datetime.datetime.strptime(form_data[name], "%Y-%m-%d")
+        except ValueError:
+            raise ValueError("{} must be a date like 2014-09-30.".format(
+                name))
+
+    search = {}
+    if "joined_from" in form_data:
+        search["joined_from"] = parse_day("joined_from")
+    if "joined_until" in form_data:
+        search["joined_until"] = (parse_day("joined_until") +
+            datetime.timedelta(days = 1))
+    if "paid" in form_data:
+        if form_data["paid"] not in ("yes", "no"):
+            raise ValueError("paid must be yes or no.")
+        search["paid"] = form_data["paid"] == "yes"
+    if "shirt_size" in form_data:
+        search["shirt_size"] = form_data["shirt_size"]
+    if "after" in form_data:
+        search["after"] = decode_page_key(form_data["after"])
+
+    return search
+
+def encode_page_key(key):
+    # The key is opaque to whoever's paging through, and survives being put
+    # in a URL.
+    return base64.urlsafe_b64encode(json.dumps(key))
+
+def decode_page_key(value):
+    try:
+        key = json.loads(base64.urlsafe_b64decode(value.encode("ascii")))
+    except (ValueError, TypeError, UnicodeEncodeError):
+        key = None
+    if not isinstance(key, list) or len(key) != 2:
+        raise ValueError("after is not valid.")
+
+    # The key goes straight to the database, which only takes plain values.
+    # It holds when the member joined (a number, or text for members from
+    # before times were stored as numbers) and their email.
+    joined, email = key
+    if isinstance(joined, bool) or not isinstance(joined,
+            (unicode, int, long, float)):
+        raise ValueError("after is not valid.")
+    if isinstance(joined, (int, long)) and not -2 ** 63 <= joined < 2 ** 63:
+        raise ValueError("after is not valid.")
+    if not isinstance(email, unicode):
+        raise ValueError("after is not valid.")
+
+    return key
+
+def format_member_field(member, name):
+    value = getattr(member, name)
+    if value is None:
+        return u""
+
+    return unicode(value)
+
+def handle_admin_members(environ, form_data, start_response):
+    # This lists everything we know about every member
+    denied = check_token(environ, start_response, "admin_token", "admin")
+    if denied is not None:
+        return denied
+
+    limit = form_data.get("limit", unicode(ADMIN_PAGE_SIZE))
+    if not limit.isdigit() or not 1 <= int(limit) <= ADMIN_MAX_PAGE_SIZE:
+        return error_response(400, start_response,
+            "limit must be between 1 and {}.".format(ADMIN_MAX_PAGE_SIZE))
+    limit = int(limit)
+
+    try:
+        search = parse_member_search(form_data)
+    except ValueError as e:
+        return error_response(400, start_response, str(e))
+
+    # This only ever reads, so it uses the read-only connection, which never
+    # waits on (or holds up) anyone writing to the database.
+    db = connection_manager.reader()
+
+    output_format = form_data.get("format", "json")
+    if output_format == "csv":
+        # The export is every matching member rather than a page of them
+        search.pop("after", None)
+        cursor = database.Member.search(db, **search)
+
+        status = "200 OK"
+        response_headers = [
+            ("Content-type", "text/csv; charset=utf-8"),
+            ("Content-Disposition", 'attachment; filename="members.csv"')
+        ]
+        start_response(status, response_headers)
+        return stream_members_csv(cursor)
+    elif output_format != "json":
+        return error_response(400, start_response,
+            "format must be json or csv.")
+
+    # We ask for one more member than we'll list so we know whether there is
+    # another page after this one.
+    rows = database.Member.search(db, limit = limit + 1, page_keys = True,
+        **search).fetchall()
+    next_key = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_key = encode_page_key(rows[-1][1])
+    members = [member for member, _ in rows]
+
+    content = json.dumps({
+        "members": [dict((i, format_member_field(member, i))
+            for i in MEMBER_FIELDS) for member in members],
+        "next": next_key
+    })
+
+    status = "200 OK"
+    response_headers = [("Content-type", "application/json")]
+    start_response(status, response_headers)
+    return [content]
+
+def handle_stats(environ, form_data, start_response):
+    denied = check_token(environ, start_response, "admin_token", "admin")
+    if denied is not None:
+        return denied
+
+    # These are kept up to date as members join and pay (see
+    # database.MemberStatistic), so this is quick however many members
+    # there are.
+    content = json.dumps(database.MemberStatistic.get_all(
+        connection_manager.reader()), sort_keys = True)
+
+    status = "200 OK"
+    response_headers = [("Content-type", "application/json")]
+    start_response(status, response_headers)
+    return [content]
+
+def handle_admin_import(environ, form_data, start_response):
+    # This changes members wholesale, so it's for officers only. Requests
+    # carrying the token don't come from a browser, so there's no need to
+    # check the referer.
+    denied = check_token(environ, start_response, "admin_token", "admin")
+    if denied is not None:
+        return denied
+
+    action = form_data.get("action")
+    if action not in bulk.ACTIONS:
+        return error_response(400, start_response,
+            "action must be one of {}.".format(", ".join(bulk.ACTIONS)))
+
+    # A roster with ten thousand members is well under the default
+    try:
+        lines = forms.read_lines(environ,
+            max_body_size = int(config.get("max_import_size", "10485760")),
+            content_type = "text/csv")
+        applied, errors = bulk.apply_csv(connection_manager.writer(), action,
+            lines, batch_size = int(config.get("import_batch_size",
+                unicode(bulk.BATCH_SIZE))))
+    except forms.FormError as e:
+        # If the upload was cut short, the batches before that were applied.
+        # Sending the file again is safe, rows that were applied are skipped
+        # or set to the same values.
+        return error_response(e.code, start_response, e.message)
+    except bulk.BulkError as e:
+        return error_response(400, start_response, str(e))
+
+    log.info("Applied %d rows of a %s import, %d rows had errors.",
+        applied, action, len(errors))
+
+    content = json.dumps({
+        "applied": applied,
+        "errors": [{"line": line, "email": email, "error": message}
+            for line, email, message in errors]
+    })
+
+    status = "200 OK"
+    response_headers = [("Content-type", "application/json")]
+    start_response(status, response_headers)
+    return [content]
+
+class _LineBuffer(object):
+    """Collects what a ``csv.writer`` writes until it's taken."""
+
+    def __init__(self):
+        self.lines = []
+
+    def write(self, line):
+        self.lines.append(line)
+
+    def take(self):
+        data = "".join(self.lines)
+        self.lines = []
+        return data
+
+def stream_members_csv(cursor):
+    """
+    Yields the members returned by ``cursor`` as CSV, a batch at a time, so
+    that exporting every member doesn't mean holding every member in memory.
+
+    """
+
+    buffer = _LineBuffer()
+    writer = csv.writer(buffer)
+    try:
+        writer.writerow(MEMBER_FIELDS)
+        while True:
+            members = cursor.fetchmany(EXPORT_BATCH_SIZE)
+            if not members:
+                break
+
+            for member in members:
+                writer.writerow([csv_cell(format_member_field(member, i))
+                    for i in MEMBER_FIELDS])
+            yield buffer.take()
+    finally:
+        # If the client goes away halfway through we're closed early, and
+        # this ends the read transaction the cursor had open.
+        cursor.close()
+
+def csv_cell(value):
+    # Spreadsheets treat cells starting with these as formulas, which would
+    # let anyone who signs up put a formula in the treasurer's spreadsheet.
+    if value[:1] in (u"=", u"+", u"-", u"@"):
+        value = u"'" + value
+
+    return value.encode("utf_8")
+
+# Associate paths with the functions that handle them
+ROUTE_TABLE = {
+    "/join": Route(handle_join, "POST", check_referer = True, writes = True),
+    "/check": Route(handle_check, "POST", check_referer = True,
+        writes = True),
+    "/metrics": Route(handle_metrics, "GET", check_referer = False),
+    "/admin/members": Route(handle_admin_members, "GET",
+        check_referer = False),
+    "/stats": Route(handle_stats, "GET", check_referer = False),
+    "/admin/import": Route(handle_admin_import, "POST", check_referer = False,
+        raw_body = True, writes = True)
+}
+
+metrics.registry.describe("rock_rate_limited_total", "counter",
+    "Requests turned away by the rate limiters, by route and by whether a "
+    "site-wide, per-client or per-email limit was hit.")
+metrics.registry.describe("rock_duplicate_emails_total", "counter",
+    "Join attempts with an email that is already registered.")
+metrics.registry.describe("rock_member_filter_lookups_total", "counter",
+    "Emails looked up in the member filter at /join, by whether the filter "
+    "ruled them out, they were registered, or the filter was wrong.")
+
+def app(environ, start_response):
+    """
+    This is what the WSGI server should serve. The application is initialized
+    by the first request if ``create_app()`` wasn't called already.
+
+    """
+
+    if instrumented_app is None:
+        create_app()
+    else:
+        maybe_reload_config()
+
+    return instrumented_app(environ, start_response)
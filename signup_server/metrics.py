@@ -0,0 +1,370 @@
+"""
+Counters and latency histograms describing how the application is doing,
+served in the `Prometheus text format
+<http://prometheus.io/docs/instrumenting/exposition_formats/>`_ at
+``/metrics``.
+
+Every process keeps its own ``Registry``. To see the whole site when it is
+served by several processes, give each of them the same ``metrics_dir``: each
+process then periodically writes a snapshot of its registry there and
+``/metrics`` adds up the snapshots of every live process. Histograms have a
+fixed set of buckets so adding them up is just adding up each bucket.
+
+"""
+
+# stdlib
+import os
+import json
+import time
+import errno
+import bisect
+import logging
+import tempfile
+import threading
+
+log = logging.getLogger("rock.metrics")
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0)
+"""The upper bounds, in seconds, of the buckets request latencies fall in."""
+
+class Histogram(object):
+    """
+    Counts observations in a fixed set of buckets. Recording an observation
+    only bumps a couple of numbers in lists created up front.
+
+    """
+
+    __slots__ = ("buckets", "counts", "sum")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+
+        # One count per bucket plus one for everything larger than the last
+        # bucket (the +Inf bucket).
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        # This isn't locked. Two threads observing at the same moment may
+        # (very rarely) lose a count, which is fine for a latency histogram.
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def merge(self, counts, total):
+        for i, count in enumerate(counts):
+            self.counts[i] += count
+        self.sum += total
+
+class Registry(object):
+    """
+    Holds every counter and histogram of a process. Each is identified by a
+    name and a set of labels, like Prometheus does.
+
+    """
+
+    def __init__(self):
+        # Both map (name, labels) to a value, where labels is a sorted tuple of
+        # (key, value) tuples.
+        self._counters = {}
+        self._histograms = {}
+
+        # Maps names to a (type, help text) tuple
+        self._descriptions = {}
+
+        # Functions that are called at render time to add the values of
+        # things that count on their own (such as caches).
+        self._collectors = []
+
+        self._lock = threading.Lock()
+
+    def describe(self, name, kind, help_text):
+        """
+        Sets the type (``counter``, ``gauge`` or ``histogram``) and help text
+        shown for a metric.
+
+        """
+
+        self._descriptions[name] = (kind, help_text)
+
+    def increment(self, name, amount = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def get_histogram(self, name, buckets = LATENCY_BUCKETS, **labels):
+        """
+        Returns the histogram with the given name and labels, creating it if
+        it doesn't exist yet. Hold onto the result to skip the lookup next
+        time.
+
+        """
+
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key,
+                    Histogram(buckets))
+
+        return histogram
+
+    def add_collector(self, collector):
+        """
+        Registers a function returning a list of ``(name, labels, value)``
+        tuples to be reported as gauges. Collected values are not kept in
+        snapshots, they only describe this process.
+
+        """
+
+        if collector not in self._collectors:
+            self._collectors.append(collector)
+
+    def snapshot(self):
+        """Returns the counters and histograms in a JSON friendly form."""
+
+        with self._lock:
+            return {
+                "counters": [[name, labels, value] for (name, labels), value
+                    in self._counters.items()],
+                "histograms": [[name, labels, list(i.buckets),
+                    list(i.counts), i.sum] for (name, labels), i
+                    in self._histograms.items()]
+            }
+
+    def render(self, snapshots = None):
+        """
+        Returns the metrics in the Prometheus text format. If ``snapshots``
+        is given, the sum of those snapshots is rendered rather than this
+        registry's values.
+
+        """
+
+        if snapshots is None:
+            snapshots = [self.snapshot()]
+
+        counters = {}
+        histograms = {}
+        for snapshot in snapshots:
+            for name, labels, value in snapshot["counters"]:
+                key = (name, tuple(tuple(i) for i in labels))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, buckets, counts, total in snapshot["histograms"]:
+                key = (name, tuple(tuple(i) for i in labels))
+                if key not in histograms:
+                    histograms[key] = Histogram(tuple(buckets))
+                histograms[key].merge(counts, total)
+
+        gauges = {}
+        for collector in self._collectors:
+            for name, labels, value in collector():
+                gauges[(name, tuple(sorted(labels.items())))] = value
+
+        lines = []
+        described = set()
+        def describe(name, default_kind):
+            if name in described:
+                return
+            described.add(name)
+            kind, help_text = self._descriptions.get(name,
+                (default_kind, None))
+            if help_text is not None:
+                lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, kind))
+
+        for (name, labels), value in sorted(counters.items()):
+            describe(name, "counter")
+            lines.append("{}{} {}".format(name, format_labels(labels), value))
+
+        for (name, labels), value in sorted(gauges.items()):
+            describe(name, "gauge")
+            lines.append("{}{} {}".format(name, format_labels(labels), value))
+
+        for (name, labels), histogram in sorted(histograms.items()):
+            describe(name, "histogram")
+
+            # Prometheus buckets are cumulative
+            cumulative = 0
+            bounds = [repr(i) for i in histogram.buckets] + ["+Inf"]
+            for bound, count in zip(bounds, histogram.counts):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(name,
+                    format_labels(labels + (("le", bound), )), cumulative))
+            lines.append("{}_sum{} {!r}".format(name, format_labels(labels),
+                histogram.sum))
+            lines.append("{}_count{} {}".format(name, format_labels(labels),
+                cumulative))
+
+        return "\n".join(lines) + "\n"
+
+def format_labels(labels):
+    if not labels:
+        return ""
+
+    # Label values must have backslashes, quotes and newlines escaped
+    return "{" + ",".join('{}="{}"'.format(k, unicode(v).encode("utf_8")
+        .replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            for k, v in labels) + "}"
+
+class SnapshotDirectory(object):
+    """
+    A directory where every process serving the site keeps a snapshot of its
+    registry, named after its process ID.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def write(self, registry):
+        # Write to a temporary file and rename it into place so that readers
+        # never see half of a snapshot.
+        fd, temp_path = tempfile.mkstemp(dir = self.path, suffix = ".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(registry.snapshot(), f)
+        os.rename(temp_path, os.path.join(self.path,
+            "{}.json".format(os.getpid())))
+
+    def read_all(self):
+        """
+        Returns the snapshots of every live process. Snapshots left behind by
+        processes that have exited are deleted.
+
+        """
+
+        snapshots = []
+        for i in os.listdir(self.path):
+            name, extension = os.path.splitext(i)
+            if extension != ".json" or not name.isdigit():
+                continue
+
+            snapshot_path = os.path.join(self.path, i)
+            if not is_process_alive(int(name)):
+                try:
+                    os.remove(snapshot_path)
+                except OSError:
+                    pass
+                continue
+
+            try:
+                with open(snapshot_path) as f:
+                    snapshots.append(json.load(f))
+            except (IOError, ValueError):
+                log.warning("Could not read metrics snapshot %r.",
+                    snapshot_path, exc_info = True)
+
+        return snapshots
+
+def is_process_alive(pid):
+    try:
+        # Signal 0 doesn't do anything to the process but still fails if it
+        # doesn't exist.
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+
+    return True
+
+class MetricsMiddleware(object):
+    """
+    WSGI middleware that counts every request and records how long it took,
+    by route and by status code.
+
+    """
+
+    def __init__(self, app, registry, routes, snapshots = None,
+            snapshot_interval = 5):
+        """
+        :param app: The WSGI application to wrap.
+        :param registry: The ``Registry`` to record into.
+        :param routes: The paths to record separately. Requests for any other
+            path are recorded under ``other`` so that a stream of bogus paths
+            can't make us keep track of an unlimited number of histograms.
+        :param snapshots: A ``SnapshotDirectory`` to write the registry into
+            every ``snapshot_interval`` seconds, or ``None``.
+
+        """
+
+        self.app = app
+        self.registry = registry
+        self.routes = frozenset(routes)
+        self.snapshots = snapshots
+        self.snapshot_interval = snapshot_interval
+        self._last_snapshot = 0
+
+        registry.describe("rock_requests_total", "counter",
+            "Requests handled, by route and status code.")
+        registry.describe("rock_request_duration_seconds", "histogram",
+            "Time spent handling requests, by route and status code.")
+
+        # Maps (route, status) to the histogram of those requests
+        self._histograms = {}
+
+    def __call__(self, environ, start_response):
+        start_time = time.time()
+        route = environ.get("PATH_INFO", "")
+        if route not in self.routes:
+            route = "other"
+
+        # We need the status code the application responds with
+        status = ["500"]
+        def recording_start_response(status_line, headers, exc_info = None):
+            status[0] = status_line[:3]
+            return start_response(status_line, headers, exc_info)
+
+        try:
+            result = self.app(environ, recording_start_response)
+        except:
+            self.record(route, "500", start_time)
+            raise
+
+        # The body may not have been produced yet (it could be a generator)
+        # so we stop the clock once the server is done with it.
+        return RecordingIterable(result,
+            lambda: self.record(route, status[0], start_time))
+
+    def record(self, route, status, start_time):
+        key = (route, status)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = self.registry.get_histogram(
+                "rock_request_duration_seconds", route = route,
+                status = status)
+        histogram.observe(time.time() - start_time)
+        self.registry.increment("rock_requests_total", route = route,
+            status = status)
+
+        if (self.snapshots is not None and
+                time.time() - self._last_snapshot > self.snapshot_interval):
+            self._last_snapshot = time.time()
+            try:
+                self.snapshots.write(self.registry)
+            except (IOError, OSError):
+                log.warning("Could not write metrics snapshot.",
+                    exc_info = True)
+
+class RecordingIterable(object):
+    """
+    Wraps the iterable a WSGI application returned, calling ``on_close``
+    once the server closes it (which PEP 333 says it must).
+
+    """
+
+    def __init__(self, iterable, on_close):
+        self.iterable = iterable
+        self.on_close = on_close
+
+    def __iter__(self):
+        return iter(self.iterable)
+
+    def close(self):
+        try:
+            if hasattr(self.iterable, "close"):
+                self.iterable.close()
+        finally:
+            self.on_close()
+
+registry = Registry()
+"""The registry of this process."""
@@ -0,0 +1,290 @@
+"""
+Rate limiting of the ``/join`` and ``/check`` actions.
+
+There are two kinds of limits. The site-wide limits cap how many of each
+action everyone put together may make per minute. Every site-wide backend
+exposes the same ``try_action(db, action, max_per_minute)`` method as
+:meth:`database.RateLimiter.try_action`, and a ``retry_after()`` method
+saying when a rejected action is worth trying again, so the request handlers
+don't need to care which one is in use. The backend is picked with the
+``rate_limiter`` option in the ``[rock]`` section of the configuration file.
+
+The per-client limits are kept by a ``SlidingWindowLimiter`` and cap how many
+actions a single client (or a single email) may make, so that one script
+can't use up the site-wide limit for everyone else.
+
+"""
+
+# stdlib
+import os
+import mmap
+import time
+import fcntl
+import struct
+import logging
+import threading
+import collections
+
+# internal
+import database
+
+log = logging.getLogger("rock.rate_limiting")
+
+ACTIONS = ("join", "check")
+"""The actions that can be rate limited, in the order they are stored."""
+
+class SQLiteBackend(object):
+    """
+    Keeps the counters in the ``rate_limiting`` table of the members database.
+
+    Every call takes the database's write lock, so prefer the shared memory
+    backend when many WSGI processes are serving requests.
+
+    """
+
+    def __init__(self, bucket_seconds = 10):
+        """
+        :param bucket_seconds: The width of the buckets the sliding minute is
+            split into, see ``database.RateLimiter``.
+
+        """
+
+        if (bucket_seconds <= 0 or
+                database.RateLimiter.WINDOW_SECONDS % bucket_seconds):
+            raise ValueError("bucket_seconds must divide {}".format(
+                database.RateLimiter.WINDOW_SECONDS))
+
+        self.bucket_seconds = bucket_seconds
+
+    def try_action(self, db, action, max_per_minute):
+        return database.RateLimiter.try_action(db, action, max_per_minute,
+            bucket_seconds = self.bucket_seconds)
+
+    def retry_after(self):
+        """
+        Returns how many seconds from now the oldest bucket leaves the
+        window, freeing up whatever was counted in it.
+
+        """
+
+        return self.bucket_seconds - time.time() % self.bucket_seconds
+
+class SharedMemoryBackend(object):
+    """
+    Keeps the counters in a small memory mapped file that every WSGI process
+    on the machine maps into its address space.
+
+    Access to the counters is serialized with an exclusive ``flock`` on the
+    file (between processes) and a ``threading.Lock`` (between threads of the
+    same process, which share the file's lock). The members database is never
+    touched.
+
+    """
+
+    LAYOUT = struct.Struct("=q" + "Q" * len(ACTIONS))
+    """
+    The layout of the counter file: the minute the counters belong to,
+    followed by one counter for each action in ``ACTIONS``.
+
+    """
+
+    def __init__(self, path):
+        """
+        :param path: The path of the counter file. It will be created if it
+            does not exist already.
+
+        """
+
+        self.path = path
+
+        # We hold onto the file descriptor for the lifetime of the backend
+        # because the flock calls below need it.
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+
+        # A freshly created file is empty and can't be mapped, so grow it to
+        # the size of our layout. The new bytes will be zero, which is a valid
+        # (if very old) minute with no actions recorded.
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size < self.LAYOUT.size:
+                os.ftruncate(self._fd, self.LAYOUT.size)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+        self._map = mmap.mmap(self._fd, self.LAYOUT.size)
+        self._lock = threading.Lock()
+
+    def try_action(self, db, action, max_per_minute):
+        """
+        Same as :meth:`database.RateLimiter.try_action`. The ``db`` parameter
+        is ignored.
+
+        """
+
+        if action not in ACTIONS:
+            raise ValueError("unknown action {}".format(repr(action)))
+        counter_index = ACTIONS.index(action) + 1
+
+        # Strip the seconds out of the current unix timestamp
+        minute = int(time.time()) // 60 * 60
+
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                values = list(self.LAYOUT.unpack_from(self._map, 0))
+
+                # Reset the counters when we've moved onto a new minute. If
+                # another process already moved onto the next minute while we
+                # were waiting for the lock we count ourselves in that minute
+                # instead of throwing its counters away.
+                if values[0] < minute:
+                    values = [minute] + [0] * len(ACTIONS)
+
+                values[counter_index] += 1
+                self.LAYOUT.pack_into(self._map, 0, *values)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+        log.info("Logged %r %r actions in the last minute (minute %r).",
+            values[counter_index], action, values[0])
+
+        return values[counter_index] <= max_per_minute
+
+    def retry_after(self):
+        """Returns how many seconds from now the counters are reset."""
+
+        return 60 - time.time() % 60
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+class SlidingWindowLimiter(object):
+    """
+    Counts actions per key (such as a client's address) over a window that
+    slides along with the current time, rather than resetting at the top of
+    each minute. A fixed minute lets a client make twice its limit by
+    spreading its attempts across the end of one minute and the start of the
+    next. Here the window is split into ``buckets`` slices, so the most a
+    client can squeeze in is ``1 + 1 / buckets`` times its limit.
+
+    At most ``max_keys`` keys are tracked. When that many are tracked, the
+    least recently seen key is forgotten to make room, so memory use stays
+    the same no matter how many clients show up. A forgotten key starts over
+    with a clean slate, but a client that is hammering us is also the most
+    recently seen one, so it won't be the one forgotten.
+
+    The counts are kept in this process's memory. When several processes
+    serve the site, a client could get up to the limit once per process.
+
+    """
+
+    def __init__(self, window = 60, buckets = 6, max_keys = 10000):
+        """
+        :param window: The length of the window in seconds.
+        :param buckets: How many slices the window is split into.
+        :param max_keys: The most keys that will be tracked at once.
+
+        """
+
+        self.window = window
+        self.buckets = buckets
+        self.bucket_width = float(window) / buckets
+        self.max_keys = max_keys
+
+        # Maps each key to a list holding the number of the last bucket the
+        # key was seen in, followed by the count of each bucket (the bucket
+        # numbered n is counted at index 1 + n % buckets). The least recently
+        # seen key is always first.
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        self.evictions = 0
+
+    def try_action(self, key, max_per_window):
+        """
+        Records an action made by ``key`` if it has made fewer than
+        ``max_per_window`` actions within the window.
+
+        :returns: ``True`` if the action is allowed. Actions that aren't
+            allowed are not counted, so a client that keeps trying gets in
+            again once its earlier actions have left the window.
+
+        """
+
+        bucket = int(time.time() / self.bucket_width)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                entry = [bucket] + [0] * self.buckets
+                while len(self._entries) >= self.max_keys:
+                    self._entries.popitem(last = False)
+                    self.evictions += 1
+            elif bucket > entry[0]:
+                # Empty the buckets that have fallen out of the window since
+                # the key was last seen, which is all of them if it's been a
+                # while.
+                for i in xrange(entry[0] + 1,
+                        min(bucket, entry[0] + self.buckets) + 1):
+                    entry[1 + i % self.buckets] = 0
+                entry[0] = bucket
+
+            # Putting the entry back moves it to the end, marking it as the
+            # most recently seen.
+            self._entries[key] = entry
+
+            allowed = sum(entry) - entry[0] < max_per_window
+            if allowed:
+                entry[1 + entry[0] % self.buckets] += 1
+
+        return allowed
+
+    def retry_after(self):
+        """
+        Returns how many seconds from now the oldest bucket leaves the
+        window, freeing up whatever was counted in it.
+
+        """
+
+        return self.bucket_width - time.time() % self.bucket_width
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "evictions": self.evictions}
+
+BACKENDS = ("sqlite", "shared_memory")
+"""The values the ``rate_limiter`` configuration option can take."""
+
+def create_backend(config):
+    """
+    Creates the rate limiting backend described by the configuration.
+
+    :param config: The dictionary of options from the ``[rock]`` section of
+        the configuration file.
+
+    """
+
+    name = config.get("rate_limiter", "sqlite")
+    if name == "sqlite":
+        return SQLiteBackend(
+            int(config.get("rate_limit_bucket_seconds", "10")))
+    elif name == "shared_memory":
+        # By default keep the counter file right next to the database so
+        # every process serving the same site shares the same counters.
+        path = config.get("rate_limiter_file",
+            config["db_file"] + "-rate-limiting")
+        return SharedMemoryBackend(path)
+    else:
+        raise ValueError("unknown rate_limiter {}, expected one of {}".format(
+            repr(name), ", ".join(BACKENDS)))
+
+def create_client_limiter(config):
+    """
+    Creates the per-client ``SlidingWindowLimiter`` described by the
+    configuration.
+
+    """
+
+    return SlidingWindowLimiter(
+        buckets = int(config.get("client_limit_buckets", "6")),
+        max_keys = int(config.get("client_limit_max_keys", "10000")))
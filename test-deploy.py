@@ -22,16 +22,25 @@ if __name__ != "__main__":
     raise ImportError("This script should not be imported.")
 
 # stdlib
-import hashlib
+import ctypes
+import ctypes.util
+import email.utils
+import errno
 import logging
 import mimetypes
 import multiprocessing
 import os
+import select
+import socket
+import struct
 import sys
+import threading
 import time
 import types
 import wsgiref
 import wsgiref.simple_server
+import wsgiref.util
+import zlib
 
 # internal
 import signup_server as wsgi_app
@@ -42,6 +51,9 @@ DEFAULT_PORT = 8000
 DEFAULT_ADDRESS = "localhost"
 """The default address to listen on if no address is provided."""
 
+DEFAULT_WORKERS = 1
+"""The default number of worker processes to serve requests with."""
+
 SCRIPT_DIR = os.path.dirname(os.path.realpath(sys.argv[0]))
 """The directory the script is running within."""
 
@@ -51,6 +63,226 @@ WSGI_DIR = os.path.join(SCRIPT_DIR, "signup_server")
 STATIC_DIR = os.path.join(SCRIPT_DIR, "main_site")
 """The directory containing the static portions of the site."""
 
+MAX_CACHED_FILE_SIZE = 256 * 1024
+"""
+Static files larger than this many bytes are streamed from disk on every
+request rather than being kept in memory.
+
+"""
+
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json",
+    "image/svg+xml")
+"""Prefixes of the MIME types worth serving gzipped."""
+
+class StaticFile(object):
+    """
+    Everything we need to know to serve one static file, read when the file
+    was last modified.
+
+    """
+
+    def __init__(self, file_path, stat_result):
+        self.file_path = file_path
+        self.mtime = stat_result.st_mtime
+        self.size = stat_result.st_size
+
+        # We have to tell the user what kind of file we're giving it (text,
+        # image, cupcakes). The simplest way to do this is to look at the
+        # extension of the file we're about to serve and guess at the data
+        # inside using that information. The mimetypes module has a function
+        # that does the guessing for us. The encoding has to do with whether
+        # or not the files are compressed or otherwise transformed, we don't
+        # use it.
+        mime_type, encoding = mimetypes.guess_type(file_path)
+        self.mime_type = mime_type or "application/octet-stream"
+
+        # The ETag changes whenever the file does, which lets browsers ask us
+        # whether their copy is still good rather than downloading it again.
+        self.etag = '"{:x}-{:x}"'.format(int(self.mtime * 1000000), self.size)
+        self.last_modified = email.utils.formatdate(self.mtime,
+            usegmt = True)
+
+        # Small files are kept in memory, along with a gzipped copy if it's
+        # worth having.
+        self.data = None
+        self.gzip_data = None
+        if self.size <= MAX_CACHED_FILE_SIZE:
+            with open(file_path, "rb") as f:
+                self.data = f.read()
+
+            if self.mime_type.startswith(COMPRESSIBLE_TYPES):
+                # A wbits of 16 + 15 makes zlib produce the gzip format
+                compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + 15)
+                gzip_data = compressor.compress(self.data) + compressor.flush()
+                if len(gzip_data) < len(self.data):
+                    self.gzip_data = gzip_data
+
+    def is_current(self, stat_result):
+        return (stat_result.st_mtime == self.mtime and
+            stat_result.st_size == self.size)
+
+class StaticFileCache(object):
+    """
+    Serves the static portion of the site, keeping the files in memory until
+    they are modified and answering conditional requests with 304s.
+
+    """
+
+    def __init__(self, static_dir):
+        self.static_dir = static_dir
+
+        # Maps the PATH_INFO requested to the StaticFile that was served for
+        # it.
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def lookup(self, path_info):
+        """
+        Returns the StaticFile for the given path (relative to the static
+        directory) or None if there is no such file. A ValueError is raised if
+        the path leads outside of the static directory.
+
+        """
+
+        static_file = self._files.get(path_info)
+
+        if static_file is None:
+            # Figure out the path of the file they're requesting (if they're
+            # requesting a static file). The realpath function will resolve
+            # symbolic links which is important for the security check next.
+            file_path = os.path.realpath(os.path.join(self.static_dir,
+                path_info))
+
+            # Make sure the file requested is within the static directory.
+            # This will only fail if they used any .. strings in their path or
+            # if they found any other links out of the directory.
+            if not file_path.startswith(self.static_dir):
+                raise ValueError("path is outside of the static directory")
+        else:
+            file_path = static_file.file_path
+
+        # A single stat tells us both whether the file still exists and
+        # whether our copy of it is stale.
+        try:
+            stat_result = os.stat(file_path)
+        except OSError:
+            stat_result = None
+
+        if stat_result is None or not os.path.isfile(file_path):
+            with self._lock:
+                self._files.pop(path_info, None)
+            return None
+
+        if static_file is None or not static_file.is_current(stat_result):
+            static_file = StaticFile(file_path, stat_result)
+            with self._lock:
+                self._files[path_info] = static_file
+
+        return static_file
+
+    def serve(self, static_file, environ, start_response):
+        """
+        Serves a static file as a WSGI application would.
+
+        """
+
+        use_gzip = (static_file.gzip_data is not None and
+            accepts_gzip(environ.get("HTTP_ACCEPT_ENCODING", "")))
+        etag = static_file.etag
+        if use_gzip:
+            # Each representation of a file needs its own ETag
+            etag = etag[:-1] + '-gzip"'
+
+        headers = [
+            ("Content-Type", static_file.mime_type),
+            ("ETag", etag),
+            ("Last-Modified", static_file.last_modified),
+
+            # Browsers may keep the file but must ask us whether it has
+            # changed before using it, which costs them a 304 at most.
+            ("Cache-Control", "no-cache")
+        ]
+        if static_file.gzip_data is not None:
+            headers.append(("Vary", "Accept-Encoding"))
+
+        if not_modified(environ, etag, static_file.mtime):
+            start_response("304 Not Modified", headers)
+            return []
+
+        if use_gzip:
+            data = static_file.gzip_data
+            headers.append(("Content-Encoding", "gzip"))
+        else:
+            data = static_file.data
+
+        size = len(data) if data is not None else static_file.size
+        headers.append(("Content-Length", str(size)))
+        start_response("200 OK", headers)
+
+        if environ["REQUEST_METHOD"] == "HEAD":
+            return []
+
+        if data is not None:
+            return [data]
+
+        # Large files are handed to the server to send however it does so
+        # most efficiently.
+        file_wrapper = environ.get("wsgi.file_wrapper",
+            wsgiref.util.FileWrapper)
+        return file_wrapper(open(static_file.file_path, "rb"), 64 * 1024)
+
+def accepts_gzip(accept_encoding):
+    """
+    Returns True if the value of an Accept-Encoding header allows a gzipped
+    response.
+
+    """
+
+    for i in accept_encoding.split(","):
+        coding, _, params = i.partition(";")
+        if coding.strip().lower() not in ("gzip", "x-gzip"):
+            continue
+
+        # gzip;q=0 means the client specifically does not want gzip
+        params = params.replace(" ", "")
+        if params.startswith("q="):
+            try:
+                return float(params[2:]) > 0
+            except ValueError:
+                return False
+
+        return True
+
+    return False
+
+def not_modified(environ, etag, mtime):
+    """
+    Returns True if the request's conditional headers say that the client's
+    copy of the file is still current.
+
+    """
+
+    # If-None-Match takes precedence over If-Modified-Since, see
+    # http://tools.ietf.org/html/rfc7232#section-6
+    if_none_match = environ.get("HTTP_IF_NONE_MATCH")
+    if if_none_match is not None:
+        tags = [i.strip() for i in if_none_match.split(",")]
+        return "*" in tags or etag in tags or "W/" + etag in tags
+
+    if_modified_since = environ.get("HTTP_IF_MODIFIED_SINCE")
+    if if_modified_since is not None:
+        parsed = email.utils.parsedate_tz(if_modified_since)
+        if parsed is None:
+            return False
+
+        # HTTP dates only have a resolution of seconds
+        return int(mtime) <= email.utils.mktime_tz(parsed)
+
+    return False
+
+static_files = StaticFileCache(STATIC_DIR)
+"""The cache proxy_app serves static files from."""
+
 def proxy_app(environ, start_response):
     """
     This is a WSGI application according to the
@@ -74,42 +306,73 @@ def proxy_app(environ, start_response):
     elif path_info.startswith("/"):
         path_info = path_info[1:]
 
-    # Figure out the path of the file they're requesting (if they're
-    # requesting a static file). The realpath function will resolve symbolic
-    # links which is important for the security check next.
-    file_path = os.path.realpath(os.path.join(STATIC_DIR, path_info))
-
-    # Make sure the file requested is within the static directory. This will
-    # only fail if they used any .. strings in their path or if they found any
-    # other links out of the directory.
-    if not file_path.startswith(STATIC_DIR):
+    # Find the static file they're requesting, if they are requesting one.
+    try:
+        static_file = static_files.lookup(path_info)
+    except ValueError:
         start_response("403 FORBIDDEN", [])
         return ["GO AWAY\n"]
 
-    if os.path.isfile(file_path):
-        # We have to tell the user what kind of file we're giving it (text,
-        # image, cupcakes). The simplest way to do this is to look at the
-        # extension of the file we're about to serve and guess at the data
-        # inside using that information. The mimetypes module has a function
-        # that does the guessing for us. The encoding has to do with whether
-        # or not the files are compressed or otherwise transformed, we don't
-        # use it.
-        mime_type, encoding = mimetypes.guess_type(file_path)
-
-        # Send the headers to the user that tell them we're serving them a page
-        # and that tell them the type of page we're serving.
-        start_response("200 OK", [("Content-type", mime_type)])
-
-        # Wrap the file in something that will transform it into a list-like
-        # object and then return it.
-        return wsgiref.util.FileWrapper(open(file_path, "rb"))
+    if static_file is not None:
+        return static_files.serve(static_file, environ, start_response)
     else:
         # If we're not serving a status file we want to let our application
         # code handle it, so just call our main wsgi app to deal with the
         # rest.
         return wsgi_app.main.app(environ, start_response)
 
-def serve_site(address, port, app):
+def create_listening_socket(address, port):
+    """
+    Creates a socket listening on the given address and port. This is done
+    once, in the main process, and the socket is handed to every worker
+    process. Each worker calls accept() on the same socket and the kernel
+    hands every connection to exactly one of them.
+
+    Because the socket outlives the workers, connections that arrive while
+    the workers are being restarted wait in the socket's backlog rather than
+    being refused.
+
+    """
+
+    listening_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listening_socket.bind((address, port))
+    listening_socket.listen(128)
+
+    # Every worker waiting in select() is woken up when a connection arrives
+    # but only one of them will get it. The socket must not block so that the
+    # others can go back to waiting (the SocketServer module ignores the error
+    # accept() raises in that case).
+    listening_socket.setblocking(0)
+
+    return listening_socket
+
+def make_server(listening_socket, app):
+    """
+    Does what wsgiref.simple_server.make_server() does, but using a socket
+    that is already listening rather than creating a new one.
+
+    """
+
+    httpd = wsgiref.simple_server.WSGIServer(
+        listening_socket.getsockname(),
+        wsgiref.simple_server.WSGIRequestHandler,
+        bind_and_activate = False)
+
+    # Swap the server's own (unused) socket for ours and then do what binding
+    # the server would have done for us.
+    httpd.socket.close()
+    httpd.socket = listening_socket
+    host, port = listening_socket.getsockname()[:2]
+    httpd.server_address = (host, port)
+    httpd.server_name = socket.getfqdn(host)
+    httpd.server_port = port
+    httpd.setup_environ()
+
+    httpd.set_app(app)
+    return httpd
+
+def serve_site(listening_socket, app):
     # Reload our application's code. This can be a little confusing to think
     # about but when the process starts into this function, it is a copy of
     # the main process and will therefore have all of the stale imports it had
@@ -123,56 +386,271 @@ def serve_site(address, port, app):
         "- %(message)s")
     logging.basicConfig(level = logging.DEBUG, format = log_format)
 
+    # Load the configuration and set up the database now rather than on the
+    # first request, so a broken configuration crashes the worker right away.
+    # Sending the worker a SIGHUP makes it reload the configuration file.
+    wsgi_app.main.create_app()
+    wsgi_app.main.install_reload_signal()
+
     # Serve the application until our process is killed
-    httpd = wsgiref.simple_server.make_server(address, port, app)
+    httpd = make_server(listening_socket, app)
     httpd.serve_forever()
 
-def get_state_token(dir_path):
+IGNORED_SUFFIXES = (".pyc", ".pyo", "~", ".swp", ".swx")
+"""
+Changes to files whose names end with any of these are ignored. Python writes
+.pyc files whenever the application is imported, and editors write backup and
+swap files while a file is being edited, neither of which should cause a
+restart.
+
+"""
+
+def is_ignored(name):
+    return name.endswith(IGNORED_SUFFIXES) or name == "__pycache__"
+
+class PollingWatcher(object):
     """
-    This function will iterate through the names and timestamps on every file
-    in the given directory and return a unique hash of that information.
+    Watches directories for changes by periodically checking the modification
+    time of everything in them. This works everywhere but, unlike the
+    InotifyWatcher, costs a stat() call per file every poll.
 
-    If you take a token returned by this function and compare it to a token of
-    the same directories, they will only be different if a file was added or
-    removed, a file was updated, a file was renamed, or a directory was
-    added/removed/renamed.
+    We keep a map of every file and directory to its last modification time.
+    Polling only needs to stat the paths in that map: adding, removing or
+    renaming a file changes the modification time of its directory, which is
+    when we go and look at what's in the directory again. We also remember
+    what each directory held so that ignored files coming and going don't
+    count as a change.
 
     """
 
-    hasher = hashlib.md5()
-    for root, dirs, files in os.walk(dir_path, topdown = True):
-        # Setting topdown to True above allows us to modify the directory list
-        # in dirs. The walk function will visit each item in the order in which
-        # they appear in that list. So here we sort it to make sure that the
-        # order in which they are visited is well defined.
-        dirs.sort()
+    def __init__(self, dir_paths, interval = 0.5):
+        """
+        :param dir_paths: The directories to watch (along with everything
+            within them).
+        :param interval: How many seconds to wait between polls.
+
+        """
+
+        self.interval = interval
+        self._mtimes = {}
+        self._dir_contents = {}
+        for i in dir_paths:
+            self._scan(i)
+
+    def _scan(self, dir_path):
+        for root, dirs, files in os.walk(dir_path):
+            # Modifying dirs in place stops os.walk from descending into any
+            # ignored directories.
+            dirs[:] = [i for i in dirs if not is_ignored(i)]
+
+            self._mtimes[root] = self._get_mtime(root)
+            self._dir_contents[root] = self._list_dir(root)
+            for i in files:
+                if not is_ignored(i):
+                    path = os.path.join(root, i)
+                    self._mtimes[path] = self._get_mtime(path)
+
+    def _get_mtime(self, path):
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            # The path was removed
+            return None
+
+    def _list_dir(self, dir_path):
+        try:
+            return frozenset(i for i in os.listdir(dir_path)
+                if not is_ignored(i))
+        except OSError:
+            return None
+
+    def _poll(self):
+        changed = False
+        for path, mtime in self._mtimes.items():
+            new_mtime = self._get_mtime(path)
+            if new_mtime == mtime:
+                continue
+
+            if new_mtime is None:
+                changed = True
+                del self._mtimes[path]
+                self._dir_contents.pop(path, None)
+            elif path in self._dir_contents:
+                self._mtimes[path] = new_mtime
+                if self._list_dir(path) != self._dir_contents[path]:
+                    changed = True
+                    self._scan(path)
+            else:
+                changed = True
+                self._mtimes[path] = new_mtime
+
+        return changed
+
+    def wait(self, timeout):
+        """
+        Waits up to ``timeout`` seconds for something to change. Returns True
+        if something did, False otherwise.
+
+        """
+
+        deadline = time.time() + timeout
+        while True:
+            if self._poll():
+                return True
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(self.interval, remaining))
+
+class InotifyWatcher(object):
+    """
+    Watches directories for changes using Linux's inotify API (see
+    ``man 7 inotify``), which has the kernel tell us about changes as they
+    happen. Waiting costs nothing and changes are noticed immediately.
 
-        # Create a list of the directory's absolute paths (this is a list
-        # comprehension below if you are unfamiliar with the construct).
-        absolute_dirs = [os.path.join(root, i) for i in dirs]
+    The standard library doesn't wrap inotify so we call into libc ourselves
+    using ctypes.
 
-        # Get a hash of that list (note that in Python you cannot take a hash
-        # of a list because it is mutable so we first convert the list to a
-        # tuple).
-        dirs_hash = hash(tuple(absolute_dirs))
+    """
 
-        # Add that hash into our final hash (after converting it to a string
-        # because it was an integer before).
-        hasher.update(str(dirs_hash))
+    # Constants from <sys/inotify.h>
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0x00000800
+    IN_CLOEXEC = 0x00080000
+
+    WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+        IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+    """The events we ask to hear about."""
+
+    EVENT_HEADER = struct.Struct("iIII")
+    """
+    The fixed part of a struct inotify_event: the watch descriptor, the mask,
+    a cookie and the length of the name that follows.
 
-        # Iterate through all the files in sorted order (so we always visit
-        # them in the same order between different runs of this function).
-        for i in sorted(files):
-            # Get the absolute path of the file
-            cur_file_path = os.path.join(root, i)
+    """
 
-            # Add the aboslute path of the file to the final hash
-            hasher.update(cur_file_path)
+    SETTLE_TIME = 0.05
+    """
+    How long to wait for more events after the first one. Saving a file
+    usually produces several events and we'd like to report them as one
+    change.
 
-            # Add the last modified time of the file to the final hash
-            hasher.update(str(os.stat(cur_file_path).st_mtime))
+    """
 
-    return hasher.digest()
+    def __init__(self, dir_paths):
+        libc_name = ctypes.util.find_library("c")
+        if libc_name is None:
+            raise OSError("could not find libc")
+        self._libc = ctypes.CDLL(libc_name, use_errno = True)
+
+        # This will raise an AttributeError if libc doesn't have inotify
+        self._libc.inotify_init1.argtypes = [ctypes.c_int]
+        self._libc.inotify_add_watch.argtypes = [ctypes.c_int,
+            ctypes.c_char_p, ctypes.c_uint32]
+
+        self._fd = self._libc.inotify_init1(self.IN_NONBLOCK |
+            self.IN_CLOEXEC)
+        if self._fd < 0:
+            self._raise_errno()
+
+        # Maps watch descriptors to the directory they watch
+        self._watches = {}
+
+        # inotify doesn't watch directories recursively so we must watch each
+        # directory individually.
+        for i in dir_paths:
+            self._watch_tree(i)
+
+    def _raise_errno(self):
+        error_number = ctypes.get_errno()
+        raise OSError(error_number, os.strerror(error_number))
+
+    def _watch_tree(self, dir_path):
+        for root, dirs, files in os.walk(dir_path):
+            dirs[:] = [i for i in dirs if not is_ignored(i)]
+
+            wd = self._libc.inotify_add_watch(self._fd, root, self.WATCH_MASK)
+            if wd < 0:
+                self._raise_errno()
+            self._watches[wd] = root
+
+    def _read_events(self):
+        """
+        Reads all the events that are waiting and returns True if any of them
+        are worth restarting over.
+        """
+
+        changed = False
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    return changed
+                raise
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, name_length = \
+                    self.EVENT_HEADER.unpack_from(data, offset)
+                offset += self.EVENT_HEADER.size
+
+                # The name is padded with null bytes
+                name = data[offset:offset + name_length].rstrip("\0")
+                offset += name_length
+
+                if is_ignored(name):
+                    continue
+                changed = True
+
+                # Start watching any new directories
+                if mask & self.IN_ISDIR and mask & (self.IN_CREATE |
+                        self.IN_MOVED_TO) and wd in self._watches:
+                    self._watch_tree(os.path.join(self._watches[wd], name))
+
+    def wait(self, timeout):
+        """
+        Waits up to ``timeout`` seconds for something to change. Returns True
+        if something did, False otherwise.
+
+        """
+
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+
+            readable, _, _ = select.select([self._fd], [], [], remaining)
+            if readable and self._read_events():
+                # Swallow the rest of the events from this change
+                while select.select([self._fd], [], [], self.SETTLE_TIME)[0]:
+                    self._read_events()
+                return True
+
+def create_watcher(dir_paths):
+    """
+    Returns an InotifyWatcher watching the given directories if the system
+    supports it, otherwise a PollingWatcher.
+
+    """
+
+    try:
+        return InotifyWatcher(dir_paths)
+    except (OSError, AttributeError) as e:
+        print ("Could not use inotify ({}), polling for changes "
+            "instead.".format(e))
+        return PollingWatcher(dir_paths)
 
 def main():
     # Grab all of the arguments the user gave us, ignoring the first argument
@@ -181,13 +659,24 @@ def main():
 
     # Print out the usage text if the user asked for it
     if "-h" in arguments or "--help" in arguments:
-        print "Usage: {} [PORT={}] [ADDRESS={}]".format(
-            sys.argv[0], DEFAULT_PORT, DEFAULT_ADDRESS)
+        print "Usage: {} [--workers N={}] [PORT={}] [ADDRESS={}]".format(
+            sys.argv[0], DEFAULT_WORKERS, DEFAULT_PORT, DEFAULT_ADDRESS)
         return 0
 
+    # Pull out the number of worker processes to run if it was given
+    workers = DEFAULT_WORKERS
+    if "--workers" in arguments:
+        index = arguments.index("--workers")
+        try:
+            workers = int(arguments[index + 1])
+        except (IndexError, ValueError):
+            print "--workers must be followed by a number."
+            return 1
+        del arguments[index:index + 2]
+
     # The first argument is the port number
     if len(arguments) >= 1:
-        port = arguments[0]
+        port = int(arguments[0])
     else:
         port = DEFAULT_PORT
 
@@ -197,45 +686,64 @@ def main():
     else:
         address = DEFAULT_ADDRESS
 
-    print "Serving site at http://{}:{}".format(address, port)
+    print "Serving site at http://{}:{} with {} worker(s)".format(address,
+        port, workers)
+
+    listening_socket = create_listening_socket(address, port)
 
     # Keep a counter of how many times we've killed the application, this makes
     # it easier, when looking at the output, to verify that the application
     # actually restarted.
     dead_count = 0
 
-    while True:
-        # Get a token that represents the current state of the WSGI application
-        state_token = get_state_token(WSGI_DIR)
-
-        # Create a new process that, once created, will execute the
-        # serve_site() function above.
-        p = multiprocessing.Process(target = serve_site,
-            args = (address, port, proxy_app))
-
-        # This tells the multiprocessing module that we want it to try and
-        # terminate our child process when we, ourselves, terminate.
-        p.daemon = True
+    # This will tell us whenever the application's code or the static portion
+    # of the site changes.
+    watcher = create_watcher([WSGI_DIR, STATIC_DIR])
 
-        # Actually start the process
-        p.start()
+    while True:
+        processes = []
+        for _ in range(workers):
+            # Create a new process that, once created, will execute the
+            # serve_site() function above. Each worker initializes the
+            # application (and opens its own database connections) itself.
+            p = multiprocessing.Process(target = serve_site,
+                args = (listening_socket, proxy_app))
+
+            # This tells the multiprocessing module that we want it to try and
+            # terminate our child process when we, ourselves, terminate.
+            p.daemon = True
+
+            # Actually start the process
+            p.start()
+            processes.append(p)
 
         if dead_count != 0:
             print "Started succesfully"
 
-        # Loop until the WSGI application was updated or the process crashes
-        while p.is_alive() and state_token == get_state_token(WSGI_DIR):
-            # The amount of time is in seconds
-            time.sleep(2)
-
-        # Make sure the application is dead and give the user some feedback
-        if p.is_alive():
-            print "Killing the application (count = {})".format(dead_count)
-            p.terminate()
+        # Loop until the site was updated or a worker crashes. The timeout (in
+        # seconds) only controls how quickly we notice a crash.
+        while (all(p.is_alive() for p in processes) and
+                not watcher.wait(1)):
+            pass
+
+        # Make sure every worker is dead (they are always restarted together)
+        # and give the user some feedback
+        crashed = not all(p.is_alive() for p in processes)
+        print "Killing the application (count = {})".format(dead_count)
+        for p in processes:
+            if p.is_alive():
+                p.terminate()
+        for p in processes:
             p.join()
-            print "Succesfully terminated the application."
-        else:
+        print "Succesfully terminated the application."
+
+        if crashed:
+            # Restarting right away would most likely crash again, so wait
+            # until something has been fixed.
             print "!! The application crashed !!"
+            print "Waiting for changes..."
+            while not watcher.wait(60):
+                pass
 
         dead_count += 1
 
@@ -0,0 +1,12 @@
+"""
+The tests. Run them from the root of the repository with::
+
+    python -m unittest discover
+
+"""
+
+# stdlib
+import logging
+
+# Failures the tests cause on purpose are logged, keep them out of the output
+logging.getLogger("rock").addHandler(logging.NullHandler())
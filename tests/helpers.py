@@ -0,0 +1,167 @@
+"""
+Things most of the tests need, like a members database of their own.
+
+"""
+
+# stdlib
+import io
+import os
+import sys
+import time
+import shutil
+import urllib
+import tempfile
+import unittest
+
+# internal
+from signup_server import connections, database, main
+
+class DatabaseTestCase(unittest.TestCase):
+    """
+    Gives each test a fresh, fully initialized members database in a
+    temporary directory, and a writer and a reader connected to it.
+
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix = "rock-test-")
+        self.db_file = os.path.join(self.directory, "members.db")
+        self.connection_manager = connections.ConnectionManager(self.db_file)
+        self.db = self.connection_manager.writer()
+        self.reader = self.connection_manager.reader()
+        database.initialize_schema(self.db)
+
+    def tearDown(self):
+        self.connection_manager.close()
+        shutil.rmtree(self.directory)
+
+class AppTestCase(unittest.TestCase):
+    """
+    Initializes the application with a configuration file of its own,
+    holding ``BASE_CONFIG`` and the test case's ``CONFIG``, and a fresh
+    database.
+
+    """
+
+    BASE_CONFIG = {
+        "max_joins_per_minute": "1000",
+        "max_checks_per_minute": "1000",
+        "admin_token": "admin-token",
+        "metrics_token": "metrics-token"
+    }
+
+    CONFIG = {}
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix = "rock-test-")
+        self.config_path = os.path.join(self.directory, "config.ini")
+        self.write_config()
+
+        # initialize() says which configuration file it's loading
+        stdout = sys.stdout
+        sys.stdout = io.BytesIO()
+        try:
+            main.initialize(self.config_path)
+        finally:
+            sys.stdout = stdout
+
+    def tearDown(self):
+        main.connection_manager.close()
+        main.instrumented_app = None
+        shutil.rmtree(self.directory)
+
+    def write_config(self, **options):
+        """
+        Writes the configuration file, with ``options`` added to (or, when
+        ``None``, removed from) the test case's configuration.
+
+        """
+
+        config = dict(self.BASE_CONFIG, db_file = os.path.join(
+            self.directory, "members.db"), **self.CONFIG)
+        config.update(options)
+
+        with open(self.config_path, "w") as config_file:
+            config_file.write("[rock]\n")
+            for key, value in sorted(config.items()):
+                if value is not None:
+                    config_file.write("{} = {}\n".format(key, value))
+
+    def request(self, path, fields = None, method = "POST", body = None,
+            query = "", headers = None, referer = True):
+        """
+        Sends a request through the application.
+
+        :param fields: A dictionary to send as the urlencoded body.
+        :param headers: Extra ``environ`` entries, like
+            ``HTTP_AUTHORIZATION``.
+
+        :returns: A tuple of the status code, a dictionary of the response
+            headers and the body.
+
+        """
+
+        if body is None:
+            body = urllib.urlencode(fields or {})
+
+        environ = {
+            "REQUEST_METHOD": method,
+            "PATH_INFO": path,
+            "QUERY_STRING": query,
+            "SERVER_NAME": "localhost",
+            "SERVER_PORT": "8000",
+            "HTTP_HOST": "localhost:8000",
+            "SCRIPT_NAME": "",
+            "REMOTE_ADDR": "127.0.0.1",
+            "CONTENT_TYPE": "application/x-www-form-urlencoded",
+            "CONTENT_LENGTH": str(len(body)),
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.url_scheme": "http"
+        }
+        if referer:
+            environ["HTTP_REFERER"] = "http://localhost:8000/join.htm"
+        environ.update(headers or {})
+
+        response = {}
+        def start_response(status, response_headers, exc_info = None):
+            response["status"] = int(status[:3])
+            response["headers"] = dict(response_headers)
+
+        result = main.app(environ, start_response)
+        try:
+            content = "".join(result)
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+
+        return response["status"], response["headers"], content
+
+    def admin_request(self, path, **kwargs):
+        """Sends a request with the admin token."""
+
+        kwargs.setdefault("method", "GET")
+        kwargs.setdefault("referer", False)
+        kwargs["headers"] = dict(kwargs.get("headers") or {},
+            HTTP_AUTHORIZATION = "Bearer admin-token")
+        return self.request(path, **kwargs)
+
+class FakeClock(object):
+    """
+    Stands in for ``time.time()`` while a test runs, so that tests can move
+    time along rather than wait.
+
+    """
+
+    def __init__(self, test_case, now = 1400000000.0):
+        self.now = now
+
+        original = time.time
+        time.time = self
+        test_case.addCleanup(setattr, time, "time", original)
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
@@ -0,0 +1,124 @@
+# stdlib
+import time
+import sqlite3
+import threading
+import unittest
+
+# internal
+from signup_server import admission, metrics
+
+def error_response(code, start_response, message = None, headers = None):
+    start_response(str(code), headers or [])
+    return [message]
+
+class AdmissionMiddlewareTestCase(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+        # Requests to /slow wait until release is set
+        self.release = threading.Event()
+        self.running = []
+        def app(environ, start_response):
+            self.running.append(None)
+            if environ["PATH_INFO"] == "/slow":
+                self.release.wait()
+            elif environ["PATH_INFO"] == "/locked":
+                raise sqlite3.OperationalError("database is locked")
+            start_response("200", [])
+            return ["done"]
+
+        self.middleware = admission.AdmissionMiddleware(app,
+            ["/slow", "/fast", "/locked"], error_response, self.registry,
+            max_active = 2, max_waiting = 1, timeout = 0.2, retry_after = 3)
+
+    def call(self, path, results = None):
+        response = {}
+        def start_response(status, headers):
+            response["status"] = status
+            response["headers"] = dict(headers)
+
+        body = self.middleware({"PATH_INFO": path}, start_response)
+        "".join(body)
+        if hasattr(body, "close"):
+            body.close()
+
+        if results is not None:
+            results.append(response)
+        return response
+
+    def start_slow_requests(self, count):
+        results = []
+        threads = [threading.Thread(target = self.call,
+            args = ("/slow", results)) for i in range(count)]
+        for i in threads:
+            i.start()
+
+        deadline = time.time() + 5
+        while len(self.running) < min(count, 2) and time.time() < deadline:
+            time.sleep(0.01)
+
+        return threads, results
+
+    def test_requests_are_let_in_when_idle(self):
+        self.assertEqual(self.call("/fast")["status"], "200")
+        self.assertEqual(self.middleware.stats(),
+            {"active": 0, "waiting": 0})
+
+    def test_overflow_is_turned_away(self):
+        threads, results = self.start_slow_requests(2)
+
+        # One more may wait, and times out
+        start = time.time()
+        response = self.call("/fast")
+        self.assertEqual(response["status"], "503")
+        self.assertEqual(response["headers"]["Retry-After"], "3")
+        self.assertGreaterEqual(time.time() - start, 0.2)
+
+        self.release.set()
+        for i in threads:
+            i.join()
+        self.assertEqual([i["status"] for i in results], ["200", "200"])
+        self.assertEqual(self.middleware.stats(),
+            {"active": 0, "waiting": 0})
+
+    def test_full_queue_is_turned_away_immediately(self):
+        threads, results = self.start_slow_requests(3)
+        while self.middleware.stats()["waiting"] < 1:
+            time.sleep(0.01)
+
+        start = time.time()
+        self.assertEqual(self.call("/fast")["status"], "503")
+        self.assertLess(time.time() - start, 0.1)
+
+        self.release.set()
+        for i in threads:
+            i.join()
+
+    def test_waiting_request_gets_in_once_one_finishes(self):
+        self.middleware.timeout = 5
+        threads, results = self.start_slow_requests(2)
+
+        waiting = threading.Thread(target = self.call,
+            args = ("/fast", results))
+        waiting.start()
+        while self.middleware.stats()["waiting"] < 1:
+            time.sleep(0.01)
+        self.release.set()
+
+        waiting.join()
+        for i in threads:
+            i.join()
+        self.assertEqual([i["status"] for i in results], ["200"] * 3)
+
+    def test_other_routes_are_not_limited(self):
+        threads, results = self.start_slow_requests(2)
+
+        self.assertEqual(self.call("/other")["status"], "200")
+
+        self.release.set()
+        for i in threads:
+            i.join()
+
+    def test_locked_database_is_turned_away(self):
+        self.assertEqual(self.call("/locked")["status"], "503")
+        self.assertEqual(self.middleware.stats()["active"], 0)
@@ -0,0 +1,56 @@
+"""
+Quick runs of ``benchmark.py``, to make sure it still works as the server
+changes. Like ``test-deploy.py`` it can't be imported, so it's run as a
+script.
+
+"""
+
+# stdlib
+import os
+import sys
+import json
+import unittest
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def run_benchmark(*arguments):
+    """Returns the exit status and what was written to standard output."""
+
+    process = subprocess.Popen([sys.executable,
+        os.path.join(REPO_DIR, "benchmark.py")] + list(arguments),
+        stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+    stdout, _ = process.communicate()
+    return process.returncode, stdout
+
+class BenchmarkTestCase(unittest.TestCase):
+    def test_micro(self):
+        status, stdout = run_benchmark("micro", "members", "--number", "10",
+            "--repeat", "1", "--json")
+
+        self.assertEqual(status, 0)
+        self.assertEqual(sorted(json.loads(stdout)),
+            ["member_get", "member_insert"])
+
+    def test_load(self):
+        status, stdout = run_benchmark("load", "--requests", "40",
+            "--concurrency", "4", "--seed-members", "3", "--json")
+
+        self.assertEqual(status, 0)
+        summary = json.loads(stdout)
+        self.assertEqual(summary["requests"], 40)
+        self.assertEqual(summary["server_exceptions"], {})
+        self.assertEqual(set(summary["outcomes"]) - set(["ok", "duplicate"]),
+            set())
+
+    def test_load_with_site_limit(self):
+        status, stdout = run_benchmark("load", "--requests", "20",
+            "--concurrency", "2", "--seed-members", "1", "--mix", "join=1",
+            "--config", "max_joins_per_minute=5", "--json")
+
+        self.assertEqual(status, 0)
+        self.assertIn("rate_limited", json.loads(stdout)["outcomes"])
+
+    def test_bad_arguments(self):
+        self.assertEqual(run_benchmark("micro", "nothing")[0], 2)
+        self.assertEqual(run_benchmark("load", "--mix", "join=x")[0], 2)
@@ -0,0 +1,171 @@
+# stdlib
+import io
+import json
+import datetime
+import unittest
+
+# internal
+from signup_server import bulk, database, forms, main
+from tests import helpers
+
+def make_member(email, paid_on = None):
+    return database.Member(joined = datetime.datetime(2014, 9, 30, 18),
+        email = email, name = u"Name", shirt_size = None, paid_on = paid_on)
+
+class ApplyCSVTestCase(helpers.DatabaseTestCase):
+    def apply(self, action, text, batch_size = bulk.BATCH_SIZE):
+        return bulk.apply_csv(self.db, action, text.splitlines(True),
+            batch_size = batch_size)
+
+    def get_member(self, email):
+        return database.Member.get(self.reader, email)
+
+    def test_add(self):
+        applied, errors = self.apply("add",
+            "\xef\xbb\xbfjoined,email,name,shirt_size,paid_on\r\n"
+            "2014-09-30,a@example.com,Andr\xc3\xa9,M,\r\n"
+            "2014-09-30 18:00:00,b@example.com,B,,2014-10-01\r\n"
+            "\r\n",
+            batch_size = 1)
+
+        self.assertEqual((applied, errors), (2, []))
+        self.assertEqual(self.get_member(u"a@example.com").name, u"Andr\xe9")
+        self.assertEqual(self.get_member(u"b@example.com").paid_on,
+            datetime.datetime(2014, 10, 1))
+
+    def test_add_reports_bad_rows_and_applies_the_rest(self):
+        database.insert_all(self.db, [make_member(u"taken@example.com")])
+
+        applied, errors = self.apply("add",
+            "email,joined\n"
+            "taken@example.com,2014-09-30\n"
+            "new@example.com,2014-09-30\n"
+            "new@example.com,2014-09-30\n"
+            "late@example.com,yesterday\n"
+            "nojoined@example.com,\n"
+            "short\n"
+            ",2014-09-30\n")
+
+        self.assertEqual(applied, 1)
+        self.assertEqual([(line, email) for line, email, _ in errors], [
+            (2, u"taken@example.com"),
+            (4, u"new@example.com"),
+            (5, u"late@example.com"),
+            (6, u"nojoined@example.com"),
+            (7, u"short"),
+            (8, u"")
+        ])
+        self.assertIsNotNone(self.get_member(u"new@example.com"))
+
+    def test_undecodable_row_is_reported_as_json(self):
+        applied, errors = self.apply("add",
+            "email,joined\n"
+            "\xff@example.com,2014-09-30\n"
+            "ok@example.com,2014-09-30\n")
+
+        self.assertEqual(applied, 1)
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(errors[0][1], u"\ufffd@example.com")
+        json.dumps(errors)
+
+    def test_mark_paid(self):
+        database.insert_all(self.db, [make_member(u"a@example.com"),
+            make_member(u"b@example.com")])
+
+        applied, errors = self.apply("mark-paid",
+            "email,paid_on\n"
+            "a@example.com,2014-10-01\n"
+            "b@example.com,\n"
+            "ghost@example.com,2014-10-01\n")
+
+        self.assertEqual(applied, 2)
+        self.assertEqual([(line, email) for line, email, _ in errors],
+            [(4, u"ghost@example.com")])
+        self.assertEqual(self.get_member(u"a@example.com").paid_on,
+            datetime.datetime(2014, 10, 1))
+        self.assertIsNotNone(self.get_member(u"b@example.com").paid_on)
+
+        # Doing it again changes nothing
+        self.assertEqual(self.apply("mark-paid",
+            "email,paid_on\na@example.com,2014-10-01\n")[0], 1)
+        self.assertEqual(database.MemberStatistic.find_drift(self.reader),
+            [])
+
+    def test_unusable_files(self):
+        for action, text in [("add", ""), ("add", "email\n"),
+                ("mark-paid", "name\n"), ("delete", "email\n")]:
+            with self.assertRaises(bulk.BulkError):
+                self.apply(action, text)
+
+class AdminImportTestCase(helpers.AppTestCase):
+    def upload(self, action, body, content_type = "text/csv"):
+        return self.admin_request("/admin/import", method = "POST",
+            query = "action=" + action, body = body,
+            headers = {"CONTENT_TYPE": content_type})
+
+    def test_import_then_mark_paid(self):
+        status, _, content = self.upload("add",
+            "email,joined,name\n"
+            "a@example.com,2014-09-30,A\n"
+            "b@example.com,2014-09-30,B\n"
+            "\xff@example.com,2014-09-30,C\n")
+
+        self.assertEqual(status, 200)
+        result = json.loads(content)
+        self.assertEqual(result["applied"], 2)
+        self.assertEqual(result["errors"], [{"line": 4,
+            "email": u"\ufffd@example.com",
+            "error": "the row must be encoded with UTF-8"}])
+
+        status, _, content = self.upload("mark-paid",
+            "email\na@example.com\n")
+        self.assertEqual(json.loads(content), {"applied": 1, "errors": []})
+
+        stats = json.loads(self.admin_request("/stats")[2])
+        self.assertEqual((stats["total"], stats["paid"]), (2, 1))
+
+    def test_bad_uploads(self):
+        self.assertEqual(self.upload("delete", "email\n")[0], 400)
+        self.assertEqual(self.upload("add", "name\n")[0], 400)
+        self.assertEqual(self.upload("add", "email,joined\n",
+            content_type = "application/json")[0], 415)
+        self.assertEqual(self.request("/admin/import", query = "action=add",
+            body = "email,joined\n", referer = False,
+            headers = {"CONTENT_TYPE": "text/csv"})[0], 401)
+
+        self.write_config(max_import_size = "10")
+        self.assertTrue(main.reload_config())
+        self.assertEqual(self.upload("add",
+            "email,joined\na@example.com,2014-09-30\n")[0], 413)
+
+class ReadLinesTestCase(unittest.TestCase):
+    def setUp(self):
+        # Small reads make lines straddle the chunks
+        original = forms.READ_SIZE
+        forms.READ_SIZE = 4
+        self.addCleanup(setattr, forms, "READ_SIZE", original)
+
+    def read_lines(self, body, content_length = None):
+        return forms.read_lines({
+            "CONTENT_TYPE": "text/csv; charset=utf-8",
+            "CONTENT_LENGTH": str(len(body) if content_length is None
+                else content_length),
+            "wsgi.input": io.BytesIO(body)
+        }, max_body_size = 100, content_type = "text/csv")
+
+    def test_lines(self):
+        self.assertEqual(list(self.read_lines("email\r\na@example.com\n\nb")),
+            ["email\r\n", "a@example.com\n", "\n", "b"])
+        self.assertEqual(list(self.read_lines("")), [])
+
+    def test_body_ending_early(self):
+        lines = self.read_lines("email\n", content_length = 20)
+
+        self.assertEqual(next(lines), "email\n")
+        with self.assertRaises(forms.FormError):
+            next(lines)
+
+    def test_too_large(self):
+        with self.assertRaises(forms.FormError) as context:
+            self.read_lines("a" * 101)
+        self.assertEqual(context.exception.code, 413)
@@ -0,0 +1,79 @@
+# stdlib
+import time
+import unittest
+
+# internal
+from signup_server import cache
+
+class LRUCacheTestCase(unittest.TestCase):
+    def test_get_and_put(self):
+        lru = cache.LRUCache(max_size = 10, ttl = 60)
+        self.assertIs(lru.get("a"), cache.MISSING)
+
+        lru.put("a", 1)
+        lru.put("nobody", None)
+
+        self.assertEqual(lru.get("a"), 1)
+        self.assertIsNone(lru.get("nobody"))
+        self.assertEqual(lru.stats()["hits"], 2)
+
+    def test_least_recently_used_is_evicted(self):
+        lru = cache.LRUCache(max_size = 2, ttl = 60)
+        lru.put("a", 1)
+        lru.put("b", 2)
+        lru.get("a")
+        lru.put("c", 3)
+
+        self.assertIs(lru.get("b"), cache.MISSING)
+        self.assertEqual(lru.get("a"), 1)
+        self.assertEqual(lru.get("c"), 3)
+
+    def test_entries_expire(self):
+        lru = cache.LRUCache(max_size = 2, ttl = 0.01)
+        lru.put("a", 1)
+        time.sleep(0.02)
+
+        self.assertIs(lru.get("a"), cache.MISSING)
+
+    def test_resize(self):
+        lru = cache.LRUCache(max_size = 3, ttl = 60)
+        for i in "abc":
+            lru.put(i, i)
+        lru.resize(max_size = 1, ttl = 60)
+
+        self.assertEqual(lru.stats()["size"], 1)
+        self.assertEqual(lru.get("c"), "c")
+
+    def test_fill_after_invalidation_is_skipped(self):
+        lru = cache.LRUCache(max_size = 10, ttl = 60)
+
+        # A lookup starts, then the key changes before it's stored
+        version = lru.version("a")
+        lru.invalidate("a")
+
+        self.assertFalse(lru.put("a", None, version = version))
+        self.assertIs(lru.get("a"), cache.MISSING)
+
+        version = lru.version("a")
+        self.assertTrue(lru.put("a", 1, version = version))
+        self.assertEqual(lru.get("a"), 1)
+
+class BloomFilterTestCase(unittest.TestCase):
+    def test_added_keys_are_found(self):
+        bloom = cache.BloomFilter(capacity = 1000)
+        keys = [u"member{}@example.com".format(i) for i in range(1000)]
+        for i in keys:
+            bloom.add(i)
+
+        self.assertTrue(all(i in bloom for i in keys))
+
+    def test_false_positive_rate(self):
+        bloom = cache.BloomFilter(capacity = 5000, error_rate = 0.01)
+        for i in range(5000):
+            bloom.add(u"member{}@example.com".format(i))
+
+        false_positives = sum(u"other{}@example.com".format(i) in bloom
+            for i in range(20000))
+
+        # Allow for some bad luck, but not for a broken filter
+        self.assertLess(false_positives / 20000.0, 0.02)
@@ -0,0 +1,64 @@
+# stdlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+# internal
+from signup_server import connections
+
+class ConnectionManagerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix = "rock-test-")
+        self.manager = connections.ConnectionManager(
+            os.path.join(self.directory, "members.db"))
+
+    def tearDown(self):
+        self.manager.close()
+        shutil.rmtree(self.directory)
+
+    def run_in_thread(self, function):
+        thread = threading.Thread(target = function)
+        thread.start()
+        thread.join()
+
+    def test_each_thread_gets_its_own_connections(self):
+        writer = self.manager.writer()
+        self.assertIs(self.manager.writer(), writer)
+        self.assertIsNot(self.manager.reader(), writer)
+
+        other = []
+        self.run_in_thread(lambda: other.append(self.manager.writer()))
+        self.assertIsNot(other[0], writer)
+
+    def test_reader_is_read_only(self):
+        self.manager.writer().execute("CREATE TABLE t (x);")
+        with self.assertRaises(sqlite3.OperationalError):
+            self.manager.reader().execute("INSERT INTO t VALUES (1);")
+
+    def test_connections_of_finished_threads_are_closed(self):
+        def use_database():
+            self.manager.writer().execute("SELECT 1;")
+            self.manager.reader().execute("SELECT 1;")
+
+        for i in range(50):
+            self.run_in_thread(use_database)
+
+        # A thread's connections can outlive join() by a moment, so the last
+        # thread's may not be gone yet, but nothing like all 100 are left.
+        self.assertLess(len(self.manager._all_connections), 10)
+
+    def test_reconfigure_makes_new_connections(self):
+        writer = self.manager.writer()
+        self.manager.reconfigure(busy_timeout = 100, synchronous = "full",
+            cached_statements = 10)
+
+        self.assertIsNot(self.manager.writer(), writer)
+        self.assertEqual(self.manager.writer().execute(
+            "PRAGMA synchronous;").fetchone()[0], 2)
+
+        with self.assertRaises(ValueError):
+            self.manager.reconfigure(busy_timeout = 100,
+                synchronous = "sometimes", cached_statements = 10)
@@ -0,0 +1,637 @@
+# stdlib
+import os
+import time
+import shutil
+import logging
+import sqlite3
+import datetime
+import tempfile
+import threading
+import unittest
+
+# internal
+from signup_server import connections, database
+from tests import helpers
+
+class SchemaTestCase(unittest.TestCase):
+    """
+    Sets up the schema in databases left behind by older versions of the
+    site, rather than in a brand new one like ``DatabaseTestCase`` does.
+
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix = "rock-test-")
+        self.connection_manager = connections.ConnectionManager(
+            os.path.join(self.directory, "members.db"))
+        self.db = self.connection_manager.writer()
+
+    def tearDown(self):
+        self.connection_manager.close()
+        shutil.rmtree(self.directory)
+
+    def create_old_tables(self):
+        """Creates the tables as the first version of the site did."""
+
+        self.db.execute("CREATE TABLE members (joined DATETIME , email TEXT "
+            "PRIMARY KEY, name TEXT , shirt_size TEXT , paid_on DATETIME );")
+        self.db.execute("CREATE TABLE rate_limiting (minute INTEGER PRIMARY "
+            "KEY, join_counter INTEGER , check_counter INTEGER );")
+
+        # sqlite3's own adapter stored times as text
+        self.db.executemany("INSERT INTO members VALUES (?, ?, ?, ?, ?);", [
+            ("2014-09-30 18:00:00.000000", u"a@example.com", u"A", u"M",
+                None),
+            ("2014-10-01 12:30:00.000000", u"b@example.com", u"B", None,
+                "2014-10-02 09:00:00.000000")
+        ])
+        self.db.execute("INSERT INTO rate_limiting VALUES (23333333, 5, 7);")
+
+    def get_columns(self, table_name):
+        return [i[1] for i in self.db.execute(
+            "PRAGMA table_info({});".format(table_name))]
+
+    def get_names(self, kind):
+        return set(i[0] for i in self.db.execute(
+            "SELECT name FROM sqlite_master WHERE type=?;", (kind, )))
+
+    def test_new_database_skips_migrations(self):
+        applied = []
+        original = database.MIGRATIONS[:]
+        database.MIGRATIONS[:] = [i._replace(function = lambda db, i = i:
+            applied.append(i.version)) for i in original]
+        try:
+            database.initialize_schema(self.db)
+        finally:
+            database.MIGRATIONS[:] = original
+
+        self.assertEqual(applied, [])
+        self.assertEqual(database.get_schema_version(self.db),
+            database.MIGRATIONS[-1].version)
+        for i in database.MODELS:
+            self.assertTrue(i.table_matches(self.db), i.table_name)
+
+        # The triggers are set up even though no migration made them
+        self.assertTrue(set(["member_statistics_insert",
+            "member_statistics_delete", "member_statistics_update"]) <=
+            self.get_names("trigger"))
+        self.assertIn("members_joined", self.get_names("index"))
+
+    def test_old_database_is_migrated(self):
+        self.create_old_tables()
+
+        database.initialize_schema(self.db)
+
+        self.assertEqual(database.get_schema_version(self.db),
+            database.MIGRATIONS[-1].version)
+        self.assertEqual(self.get_columns("rate_limiting"),
+            ["slot", "bucket_start", "join_counter", "check_counter"])
+        self.assertEqual(self.db.execute(
+            "SELECT COUNT(*) FROM rate_limiting;").fetchone()[0], 0)
+
+        # The members are kept, and counted
+        self.assertEqual(
+            sorted(i.email for i in database.Member.iter_all(self.db)),
+            [u"a@example.com", u"b@example.com"])
+        self.assertEqual(database.MemberStatistic.find_drift(self.db), [])
+        self.assertEqual(
+            database.MemberStatistic.get_all(self.db)["joined"],
+            {"2014-09-30": 1, "2014-10-01": 1})
+
+    def test_initialize_twice(self):
+        self.create_old_tables()
+        database.initialize_schema(self.db)
+
+        database.initialize_schema(self.db)
+
+        self.assertEqual(database.MemberStatistic.get_all(self.db)["total"],
+            2)
+
+    def test_upgrades_table_with_missing_column(self):
+        # A members table from before paid_on was added
+        self.db.execute("CREATE TABLE members (joined DATETIME , email TEXT "
+            "PRIMARY KEY, name TEXT , shirt_size TEXT );")
+        self.db.execute("INSERT INTO members VALUES (?, ?, ?, ?);",
+            (1400000000, u"a@example.com", u"A", u"M"))
+        self.db.execute("PRAGMA user_version = {:d};".format(
+            database.MIGRATIONS[-1].version))
+
+        database.initialize_schema(self.db)
+
+        self.assertTrue(database.Member.table_matches(self.db))
+        member = database.Member.get(self.db, u"a@example.com")
+        self.assertEqual(member.name, u"A")
+        self.assertIsNone(member.paid_on)
+        self.assertIn("members_paid_on", self.get_names("index"))
+
+    def test_failed_migration_is_rolled_back(self):
+        self.create_old_tables()
+        def broken(db):
+            db.execute("DELETE FROM members;")
+            raise RuntimeError("bug")
+        original = database.MIGRATIONS[:]
+        database.MIGRATIONS[:] = [database.Migration(1, "Broken", broken)]
+        try:
+            with self.assertRaises(RuntimeError):
+                database.migrate(self.db)
+        finally:
+            database.MIGRATIONS[:] = original
+
+        self.assertEqual(database.get_schema_version(self.db), 0)
+        self.assertEqual(self.db.execute(
+            "SELECT COUNT(*) FROM members;").fetchone()[0], 2)
+
+class EpochSecondsTestCase(unittest.TestCase):
+    def test_round_trip(self):
+        value = datetime.datetime(2014, 9, 30, 18, 0, 5)
+
+        stored = database.EPOCH_SECONDS.to_sql(value)
+
+        self.assertIsInstance(stored, (int, long))
+        self.assertEqual(stored, int(time.mktime(value.timetuple())))
+        self.assertEqual(database.EPOCH_SECONDS.from_sql(stored), value)
+
+    def test_drops_fractions_of_a_second(self):
+        value = datetime.datetime(2014, 9, 30, 18, 0, 5, 999999)
+
+        self.assertEqual(database.EPOCH_SECONDS.from_sql(
+            database.EPOCH_SECONDS.to_sql(value)), value.replace(
+                microsecond = 0))
+
+    def test_reads_text(self):
+        from_sql = database.EPOCH_SECONDS.from_sql
+
+        self.assertEqual(from_sql("2014-09-30 18:00:05.250000"),
+            datetime.datetime(2014, 9, 30, 18, 0, 5, 250000))
+        self.assertEqual(from_sql("2014-09-30 18:00:05"),
+            datetime.datetime(2014, 9, 30, 18, 0, 5))
+        self.assertEqual(from_sql("2014-09-30"),
+            datetime.datetime(2014, 9, 30))
+        with self.assertRaises(ValueError):
+            from_sql("yesterday")
+
+    def test_to_text(self):
+        to_text = database.EPOCH_SECONDS.to_text
+
+        self.assertEqual(to_text(datetime.datetime(2014, 9, 30)),
+            "2014-09-30")
+        self.assertEqual(to_text(datetime.datetime(2014, 9, 30, 18)),
+            "2014-09-30 18:00:00")
+
+    def test_passes_other_values_through(self):
+        self.assertIsNone(database.EPOCH_SECONDS.to_sql(None))
+        self.assertIsNone(database.EPOCH_SECONDS.from_sql(None))
+
+class ConvertRowsTestCase(helpers.DatabaseTestCase):
+    def insert_text_members(self, count):
+        self.db.execute("BEGIN")
+        self.db.executemany("INSERT INTO members VALUES (?, ?, ?, ?, ?);", [
+            ("2014-09-30 18:00:{:02d}.000000".format(i),
+                u"{}@example.com".format(i), u"Name", None,
+                "2014-10-01 09:00:00" if i % 2 else None)
+            for i in range(count)])
+        self.db.execute("COMMIT")
+
+    def get_types(self):
+        return set(self.db.execute(
+            "SELECT typeof(joined), typeof(paid_on) FROM members;"))
+
+    def test_members_are_stored_as_epoch_seconds(self):
+        joined = datetime.datetime(2014, 9, 30, 18, 0)
+        database.Member(joined = joined, email = u"a@example.com",
+            name = u"A", shirt_size = None, paid_on = None).insert(self.db)
+
+        self.assertEqual(self.get_types(), set([("integer", "null")]))
+        self.assertEqual(
+            database.Member.get(self.reader, u"a@example.com").joined, joined)
+
+    def test_converts_text_in_batches(self):
+        self.insert_text_members(5)
+
+        self.assertEqual(list(database.Member.convert_rows(self.db,
+            batch_size = 2)), [2, 2, 1])
+
+        self.assertEqual(self.get_types(),
+            set([("integer", "null"), ("integer", "integer")]))
+        member = database.Member.get(self.reader, u"1@example.com")
+        self.assertEqual(member.joined,
+            datetime.datetime(2014, 9, 30, 18, 0, 1))
+        self.assertEqual(member.paid_on, datetime.datetime(2014, 10, 1, 9))
+
+        # Nothing is left to do the second time around
+        self.assertEqual(list(database.Member.convert_rows(self.db)), [0])
+
+    def test_statistics_survive_conversion(self):
+        self.insert_text_members(3)
+        self.assertEqual(
+            database.MemberStatistic.get_all(self.reader)["joined"],
+            {"2014-09-30": 3})
+
+        list(database.Member.convert_rows(self.db))
+
+        self.assertEqual(database.MemberStatistic.find_drift(self.db), [])
+        self.assertEqual(
+            database.MemberStatistic.get_all(self.reader)["joined"],
+            {"2014-09-30": 3})
+
+    def insert_mixed_members(self):
+        """
+        Inserts five members whose join times are still text, one of them
+        just a date, and three that have been converted.
+
+        """
+
+        self.insert_text_members(4)
+        self.db.execute("INSERT INTO members VALUES (?, ?, ?, ?, ?);",
+            ("2014-09-29", u"date@example.com", u"Name", None, None))
+        database.insert_all(self.db, [database.Member(
+            joined = datetime.datetime(2014, 9, 29, 12) +
+                datetime.timedelta(days = i),
+            email = u"int{}@example.com".format(i), name = u"Name",
+            shirt_size = None, paid_on = None) for i in range(3)])
+
+    def test_search_pages_through_mixed_rows(self):
+        self.insert_mixed_members()
+
+        seen = []
+        after = None
+        for _ in range(10):
+            rows = database.Member.search(self.reader, after = after,
+                limit = 2, page_keys = True).fetchall()
+            if not rows:
+                break
+            seen.extend(member.email for member, _ in rows)
+            after = rows[-1][1]
+        else:
+            self.fail("paging never finished, got {}".format(seen))
+
+        # Converted members come first, then those still stored as text
+        self.assertEqual(seen, [u"int0@example.com", u"int1@example.com",
+            u"int2@example.com", u"date@example.com"] +
+            [u"{}@example.com".format(i) for i in range(4)])
+
+    def test_search_range_matches_mixed_rows(self):
+        self.insert_mixed_members()
+
+        def search(**kwargs):
+            return set(i.email for i in
+                database.Member.search(self.reader, **kwargs))
+
+        self.assertEqual(search(
+            joined_from = datetime.datetime(2014, 9, 30),
+            joined_until = datetime.datetime(2014, 10, 1)),
+            set([u"int1@example.com"] +
+                [u"{}@example.com".format(i) for i in range(4)]))
+        self.assertEqual(search(
+            joined_until = datetime.datetime(2014, 9, 30)),
+            set([u"int0@example.com", u"date@example.com"]))
+        self.assertEqual(search(
+            joined_from = datetime.datetime(2014, 9, 30, 18, 0, 2)),
+            set([u"int2@example.com", u"2@example.com", u"3@example.com"]))
+        self.assertEqual(len(search()), 8)
+
+def make_member(email, joined = datetime.datetime(2014, 9, 30, 18),
+        shirt_size = None, paid_on = None):
+    return database.Member(joined = joined, email = email, name = u"Name",
+        shirt_size = shirt_size, paid_on = paid_on)
+
+class MemberStatisticTestCase(helpers.DatabaseTestCase):
+    def get_all(self):
+        return database.MemberStatistic.get_all(self.reader)
+
+    def test_empty(self):
+        self.assertEqual(self.get_all(), {"total": 0, "paid": 0,
+            "unpaid": 0, "joined": {}, "shirt_size": {}})
+
+    def test_counts_follow_changes(self):
+        database.insert_all(self.db, [
+            make_member(u"a@example.com", shirt_size = u"M"),
+            make_member(u"b@example.com", shirt_size = u"M"),
+            make_member(u"c@example.com",
+                joined = datetime.datetime(2014, 10, 1, 9))
+        ])
+        database.Member.set_paid_on(self.db, u"a@example.com",
+            datetime.datetime(2014, 10, 2))
+        database.Member.update(self.db, u"b@example.com", shirt_size = u"L")
+        database.Member.delete(self.db, u"c@example.com")
+
+        self.assertEqual(self.get_all(), {
+            "total": 2,
+            "paid": 1,
+            "unpaid": 1,
+            "joined": {"2014-09-30": 2},
+            "shirt_size": {"M": 1, "L": 1}
+        })
+        self.assertEqual(database.MemberStatistic.find_drift(self.db), [])
+
+    def test_insert_or_replace_is_counted_once(self):
+        make_member(u"a@example.com", shirt_size = u"M").insert(self.db)
+
+        self.db.execute("INSERT OR REPLACE INTO members VALUES "
+            "(?, ?, ?, ?, ?);", make_member(u"a@example.com",
+                shirt_size = u"L").values())
+
+        self.assertEqual(self.get_all()["total"], 1)
+        self.assertEqual(self.get_all()["shirt_size"], {"L": 1})
+        self.assertEqual(database.MemberStatistic.find_drift(self.db), [])
+
+    def test_find_drift_and_recount(self):
+        make_member(u"a@example.com").insert(self.db)
+        self.db.execute(
+            "UPDATE member_statistics SET value=5 WHERE name='total';")
+        self.db.execute("DELETE FROM member_statistics WHERE name='unpaid';")
+
+        self.assertEqual(database.MemberStatistic.find_drift(self.db), [
+            ("total", 5, 1),
+            ("unpaid", None, 1)
+        ])
+
+        self.db.execute("BEGIN IMMEDIATE")
+        database.MemberStatistic.recount(self.db)
+        self.db.execute("COMMIT")
+
+        self.assertEqual(database.MemberStatistic.find_drift(self.db), [])
+        self.assertEqual(self.get_all()["total"], 1)
+
+    def test_cannot_insert(self):
+        with self.assertRaises(RuntimeError):
+            database.MemberStatistic(name = "total", value = 1).insert(
+                self.db)
+
+class QueryTestCase(helpers.DatabaseTestCase):
+    def setUp(self):
+        super(QueryTestCase, self).setUp()
+
+        database.insert_all(self.db, [
+            make_member(u"a@example.com", shirt_size = u"M"),
+            make_member(u"b@example.com", shirt_size = u"M"),
+            make_member(u"c@example.com", shirt_size = u"L")
+        ])
+
+        self.changes = []
+        listener = lambda model, key: self.changes.append((model, key))
+        database.add_change_listener(listener)
+        self.addCleanup(database._change_listeners.remove, listener)
+
+    def test_get(self):
+        self.assertEqual(
+            database.Member.get(self.reader, u"c@example.com").shirt_size,
+            u"L")
+        self.assertIsNone(database.Member.get(self.reader, u"d@example.com"))
+
+    def test_filter_and_count(self):
+        self.assertEqual(sorted(i.email for i in database.Member.filter(
+            self.reader, shirt_size = u"M")),
+            [u"a@example.com", u"b@example.com"])
+        self.assertEqual(database.Member.count(self.reader,
+            shirt_size = u"M"), 2)
+        self.assertEqual(database.Member.count(self.reader), 3)
+        self.assertEqual(len(database.Member.filter(self.reader)), 3)
+
+        # Times are compared as they're stored
+        self.assertEqual(database.Member.count(self.reader,
+            joined = datetime.datetime(2014, 9, 30, 18)), 3)
+
+    def test_unknown_columns_are_refused(self):
+        with self.assertRaises(ValueError):
+            database.Member.filter(self.reader, **{"1=1 OR email": u"x"})
+        with self.assertRaises(ValueError):
+            database.Member.update(self.db, u"a@example.com", admin = True)
+
+    def test_iter_all_and_keys_in_batches(self):
+        self.assertEqual(sorted(i.email for i in
+            database.Member.iter_all(self.reader, batch_size = 2)),
+            [u"a@example.com", u"b@example.com", u"c@example.com"])
+        self.assertEqual(sorted(database.Member.iter_keys(self.reader,
+            batch_size = 2)),
+            [u"a@example.com", u"b@example.com", u"c@example.com"])
+
+    def test_update(self):
+        self.assertTrue(database.Member.update(self.db, u"a@example.com",
+            name = u"New", shirt_size = u"S"))
+        self.assertFalse(database.Member.update(self.db, u"d@example.com",
+            name = u"New"))
+
+        member = database.Member.get(self.reader, u"a@example.com")
+        self.assertEqual((member.name, member.shirt_size), (u"New", u"S"))
+        self.assertIn((database.Member, u"a@example.com"), self.changes)
+
+    def test_update_all(self):
+        missing = database.Member.update_all(self.db, ("name", ), [
+            (u"a@example.com", (u"A", )),
+            (u"d@example.com", (u"D", ))
+        ])
+
+        self.assertEqual(missing, set([u"d@example.com"]))
+        self.assertEqual(database.Member.get(self.reader,
+            u"a@example.com").name, u"A")
+        self.assertEqual(self.changes, [(database.Member, u"a@example.com")])
+
+    def test_insert_many_skips_taken_keys(self):
+        skipped = database.Member.insert_many(self.db, [
+            make_member(u"a@example.com"),
+            make_member(u"d@example.com"),
+            make_member(u"d@example.com")
+        ])
+
+        self.assertEqual([(i.email, reason) for i, reason in skipped], [
+            (u"a@example.com", "email already exists"),
+            (u"d@example.com", "email already exists")
+        ])
+        self.assertEqual(database.Member.count(self.reader), 4)
+        self.assertEqual(self.changes, [(database.Member, u"d@example.com")])
+
+    def test_existing_keys(self):
+        original = database.Member.KEY_BATCH_SIZE
+        database.Member.KEY_BATCH_SIZE = 2
+        try:
+            found = database.Member.existing_keys(self.reader,
+                [u"a@example.com", u"d@example.com", u"c@example.com"])
+        finally:
+            database.Member.KEY_BATCH_SIZE = original
+
+        self.assertEqual(found, set([u"a@example.com", u"c@example.com"]))
+
+    def test_insert_all_is_all_or_nothing(self):
+        with self.assertRaises(sqlite3.IntegrityError):
+            database.insert_all(self.db, [make_member(u"d@example.com"),
+                make_member(u"a@example.com")])
+
+        self.assertIsNone(database.Member.get(self.reader, u"d@example.com"))
+
+class ModelSlotsTestCase(helpers.DatabaseTestCase):
+    def test_models_have_no_dict(self):
+        member = make_member(u"a@example.com")
+
+        self.assertFalse(hasattr(member, "__dict__"))
+        with self.assertRaises(AttributeError):
+            member.nickname = u"A"
+
+    def test_init_requires_every_column(self):
+        with self.assertRaises(ValueError):
+            database.Member(email = u"a@example.com")
+        with self.assertRaises(ValueError):
+            database.Member(nickname = u"A", **dict(zip(
+                database.Member._column_names, [None] * 5)))
+
+    def test_column_clashing_with_attribute_is_refused(self):
+        with self.assertRaises(ValueError):
+            class Broken(database.BaseModel):
+                columns = [database.Column("filter", "TEXT", "")]
+
+    def test_from_row_converts_adapted_columns(self):
+        member = database.Member.from_row((1412125200, u"a@example.com",
+            u"A", None, "2014-10-02 09:00:00"))
+
+        self.assertEqual(member.joined,
+            datetime.datetime.fromtimestamp(1412125200))
+        self.assertEqual(member.paid_on, datetime.datetime(2014, 10, 2, 9))
+        self.assertEqual(member.email, u"a@example.com")
+
+    def test_row_factory(self):
+        make_member(u"a@example.com", shirt_size = u"M").insert(self.db)
+
+        cur = self.reader.cursor()
+        cur.row_factory = database.Member.row_factory
+        cur.execute(database.Member._iter_all_sql)
+        members = cur.fetchall()
+
+        self.assertEqual([type(i) for i in members], [database.Member])
+        self.assertEqual(members[0].shirt_size, u"M")
+        self.assertEqual(members[0].joined, datetime.datetime(2014, 9, 30,
+            18))
+
+class GroupCommitterTestCase(helpers.DatabaseTestCase):
+    def insert_concurrently(self, committer, inserts):
+        """
+        Makes each of ``inserts`` (a tuple of model objects) from a thread of
+        its own, returning what each one raised (or ``None``).
+
+        """
+
+        errors = [None] * len(inserts)
+        def insert(index):
+            try:
+                committer.insert(self.connection_manager.writer(),
+                    *inserts[index])
+            except Exception as e:
+                errors[index] = e
+
+        threads = [threading.Thread(target = insert, args = (i, ))
+            for i in range(len(inserts))]
+        for i in threads:
+            i.start()
+        for i in threads:
+            i.join()
+
+        return errors
+
+    def test_full_batch_is_flushed_together(self):
+        committer = database.GroupCommitter(max_batch_size = 4,
+            max_delay = 10)
+
+        start_time = time.time()
+        errors = self.insert_concurrently(committer, [
+            (make_member(u"{}@example.com".format(i)), ) for i in range(4)])
+
+        # Filling the batch flushes it rather than waiting out the delay
+        self.assertLess(time.time() - start_time, 5)
+        self.assertEqual(errors, [None] * 4)
+        self.assertEqual(database.Member.count(self.reader), 4)
+        self.assertEqual(committer.stats()["batch_sizes"], {4: 1})
+
+    def test_lone_insert_waits_for_delay(self):
+        committer = database.GroupCommitter(max_batch_size = 4,
+            max_delay = 0.01)
+
+        committer.insert(self.db, make_member(u"a@example.com"))
+
+        self.assertEqual(database.Member.count(self.reader), 1)
+        self.assertEqual(committer.stats()["batch_sizes"], {1: 1})
+
+    def test_failure_only_reaches_its_caller(self):
+        make_member(u"taken@example.com").insert(self.db)
+        committer = database.GroupCommitter(max_batch_size = 3,
+            max_delay = 10)
+
+        errors = self.insert_concurrently(committer, [
+            (make_member(u"a@example.com"), ),
+            (make_member(u"taken@example.com"), ),
+
+            # Neither of these go in, since the second one fails
+            (make_member(u"b@example.com"),
+                make_member(u"taken@example.com"))
+        ])
+
+        self.assertIsNone(errors[0])
+        self.assertIsInstance(errors[1], sqlite3.IntegrityError)
+        self.assertIsInstance(errors[2], sqlite3.IntegrityError)
+        self.assertEqual(sorted(database.Member.iter_keys(self.reader)),
+            [u"a@example.com", u"taken@example.com"])
+        self.assertEqual(committer.stats()["fallback_count"], 1)
+
+class StatementProfilerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix = "rock-test-")
+        self.profiler = database.StatementProfiler()
+        self.connection_manager = connections.ConnectionManager(
+            os.path.join(self.directory, "members.db"),
+            profiler = self.profiler)
+        self.db = self.connection_manager.writer()
+        database.initialize_schema(self.db)
+
+    def tearDown(self):
+        self.connection_manager.close()
+        shutil.rmtree(self.directory)
+
+    def test_shape(self):
+        self.assertEqual(self.profiler.shape("""
+            -- Look someone up
+            SELECT name FROM members WHERE email='it''s'   AND joined>12.5;
+        """), "SELECT name FROM members WHERE email=? AND joined>?")
+
+        # Names containing digits are left alone
+        self.assertEqual(self.profiler.shape("SELECT c1 FROM t2 LIMIT 10;"),
+            "SELECT c1 FROM t2 LIMIT ?")
+
+    def test_statements_are_counted_by_shape(self):
+        for i in range(3):
+            database.Member.get(self.db, u"{}@example.com".format(i))
+        with self.assertRaises(sqlite3.OperationalError):
+            self.db.execute("SELECT * FROM nothing WHERE id=1;")
+
+        stats = self.profiler.stats()
+        get = stats[database.Member._get_sql.rstrip(";")]
+        self.assertEqual((get.count, get.errors), (3, 0))
+        self.assertGreaterEqual(get.seconds_total, get.seconds_max)
+        self.assertEqual(stats["SELECT * FROM nothing WHERE id=?"].errors, 1)
+
+    def test_lock_wait(self):
+        make_member(u"a@example.com").insert(self.db)
+        before = self.profiler.lock_wait()[0]
+
+        database.insert_all(self.db, [make_member(u"b@example.com")])
+
+        self.assertEqual(self.profiler.lock_wait()[0], before + 1)
+
+    def test_summary(self):
+        database.Member.count(self.db)
+
+        summary = self.profiler.format_summary()
+
+        self.assertIn("SELECT COUNT(*) FROM members", summary)
+        self.assertIn("Waited for the write lock", summary)
+
+    def test_slow_statements_are_logged(self):
+        self.profiler.slow_threshold = 0
+        messages = []
+        handler = logging.Handler()
+        handler.emit = messages.append
+        logging.getLogger("rock.database").addHandler(handler)
+        self.addCleanup(logging.getLogger("rock.database").removeHandler,
+            handler)
+
+        database.Member.count(self.db)
+
+        self.assertTrue(any("SELECT COUNT(*) FROM members" in
+            i.getMessage() for i in messages))
@@ -0,0 +1,168 @@
+"""
+Tests for ``test-deploy.py``. The script refuses to be imported, so these run
+it the way developers do and talk to it over HTTP.
+
+"""
+
+# stdlib
+import os
+import sys
+import time
+import shutil
+import signal
+import socket
+import httplib
+import tempfile
+import unittest
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def get_free_port():
+    probe = socket.socket()
+    try:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+    finally:
+        probe.close()
+
+class TestDeployTestCase(unittest.TestCase):
+    WORKERS = 1
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix = "rock-test-")
+        config_path = os.path.join(self.directory, "config.ini")
+        with open(config_path, "w") as config_file:
+            config_file.write("[rock]\ndb_file = {}\n"
+                "max_joins_per_minute = 1000\n"
+                "max_checks_per_minute = 1000\n".format(
+                    os.path.join(self.directory, "members.db")))
+
+        self.port = get_free_port()
+        self.output = open(os.path.join(self.directory, "output.log"), "w+")
+        self.process = subprocess.Popen([sys.executable, "-u",
+            os.path.join(REPO_DIR, "test-deploy.py"), "--workers",
+            str(self.WORKERS), str(self.port), "127.0.0.1"],
+            stdout = self.output, stderr = subprocess.STDOUT,
+            env = dict(os.environ, ROCK_CONFIG = config_path))
+
+        # Wait for a worker to answer
+        deadline = time.time() + 10
+        while True:
+            try:
+                self.request("GET", "/")
+                break
+            except socket.error:
+                if time.time() > deadline or self.process.poll() is not None:
+                    self.fail("test-deploy.py didn't start:\n" +
+                        self.read_output())
+                time.sleep(0.1)
+
+    def tearDown(self):
+        # The workers are daemons, so they go when the main process does
+        self.process.send_signal(signal.SIGINT)
+        self.process.wait()
+        self.output.close()
+        shutil.rmtree(self.directory)
+
+    def read_output(self):
+        self.output.seek(0)
+        return self.output.read()
+
+    def request(self, method, path, body = None, headers = None):
+        connection = httplib.HTTPConnection("127.0.0.1", self.port,
+            timeout = 10)
+        try:
+            connection.request(method, path, body, headers or {})
+            response = connection.getresponse()
+            return (response.status, dict(response.getheaders()),
+                response.read())
+        finally:
+            connection.close()
+
+    def test_static_files(self):
+        status, headers, body = self.request("GET", "/index.htm")
+        with open(os.path.join(REPO_DIR, "main_site", "index.htm"), "rb") as f:
+            self.assertEqual(body, f.read())
+        self.assertEqual(status, 200)
+        self.assertEqual(headers["content-type"], "text/html")
+        self.assertEqual(int(headers["content-length"]), len(body))
+
+        # Asking whether our copy is still good
+        status, _, body = self.request("GET", "/index.htm",
+            headers = {"If-None-Match": headers["etag"]})
+        self.assertEqual((status, body), (304, ""))
+        status, _, _ = self.request("GET", "/index.htm",
+            headers = {"If-Modified-Since": headers["last-modified"]})
+        self.assertEqual(status, 304)
+        status, _, _ = self.request("GET", "/index.htm",
+            headers = {"If-None-Match": '"stale"'})
+        self.assertEqual(status, 200)
+
+    def test_gzip(self):
+        status, headers, body = self.request("GET", "/index.htm",
+            headers = {"Accept-Encoding": "gzip"})
+
+        self.assertEqual(status, 200)
+        self.assertEqual(headers["content-encoding"], "gzip")
+        self.assertTrue(headers["etag"].endswith('-gzip"'))
+        self.assertEqual(body[:2], "\x1f\x8b")
+
+        status, headers, _ = self.request("GET", "/index.htm",
+            headers = {"Accept-Encoding": "gzip;q=0"})
+        self.assertNotIn("content-encoding", headers)
+
+    def test_paths_outside_the_site_are_refused(self):
+        status, _, _ = self.request("GET", "/../README.md")
+        self.assertEqual(status, 403)
+
+    def wait_for_output(self, text, timeout = 10):
+        deadline = time.time() + timeout
+        while text not in self.read_output():
+            if time.time() > deadline:
+                return False
+            time.sleep(0.1)
+
+        return True
+
+    def test_restarts_when_the_site_changes(self):
+        static_dir = os.path.join(REPO_DIR, "main_site")
+
+        # Editors' swap files don't count
+        swap_path = os.path.join(static_dir, ".index.htm.swp")
+        open(swap_path, "w").close()
+        os.remove(swap_path)
+        self.assertFalse(self.wait_for_output("Restarting", timeout = 2))
+
+        styles_path = os.path.join(static_dir, "styles.css")
+        stat_result = os.stat(styles_path)
+        self.addCleanup(os.utime, styles_path,
+            (stat_result.st_atime, stat_result.st_mtime))
+        os.utime(styles_path, None)
+
+        self.assertTrue(self.wait_for_output("Restarting"),
+            self.read_output())
+        self.assertTrue(self.wait_for_output("Started succesfully"))
+        self.assertEqual(self.request("GET", "/styles.css")[0], 200)
+
+class TestDeployWorkersTestCase(TestDeployTestCase):
+    """Runs the same tests with several worker processes sharing a socket."""
+
+    WORKERS = 3
+
+    def test_workers_share_the_database(self):
+        self.assertIn("with 3 worker(s)", self.read_output())
+        headers = {
+            "Content-Type": "application/x-www-form-urlencoded",
+            "Referer": "http://127.0.0.1:{}/join.htm".format(self.port)
+        }
+
+        # Whichever worker gets each request, they all see the same members
+        status, _, _ = self.request("POST", "/join",
+            "email=a%40example.com&name=A&shirt-size=M", headers)
+        self.assertEqual(status, 200)
+        for i in range(6):
+            status, _, body = self.request("POST", "/check",
+                "email=a%40example.com", headers)
+            self.assertEqual(status, 200)
+            self.assertIn("has been a member since", body)
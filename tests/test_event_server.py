@@ -0,0 +1,199 @@
+# stdlib
+import json
+import socket
+import httplib
+import unittest
+import threading
+
+# internal
+from signup_server import event_server, main
+from tests import helpers
+
+def app(environ, start_response):
+    path = environ["PATH_INFO"]
+    if path == "/error":
+        raise RuntimeError("bug")
+    elif path == "/silent":
+        # Never calls start_response
+        return ["oops"]
+
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    return ["{} {}".format(environ["REQUEST_METHOD"], path)]
+
+def upload_app(environ, start_response):
+    """Reads the body a little at a time, as the import handler does."""
+
+    remaining = int(environ["CONTENT_LENGTH"])
+    received = []
+    if environ["PATH_INFO"] == "/upload":
+        while remaining > 0:
+            chunk = environ["wsgi.input"].read(min(1000, remaining))
+            if not chunk:
+                break
+            received.append(chunk)
+            remaining -= len(chunk)
+
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    return [str(len("".join(received)))]
+
+def start_server(app, **kwargs):
+    """
+    Starts an ``EventServer`` on a thread of its own.
+
+    :returns: The port it's listening on.
+
+    """
+
+    listening_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listening_socket.bind(("127.0.0.1", 0))
+    listening_socket.listen(16)
+    listening_socket.setblocking(0)
+
+    server = event_server.EventServer(app, listening_socket, **kwargs)
+    thread = threading.Thread(target = server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return listening_socket.getsockname()[1]
+
+class EventServerTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # A single worker thread, so losing it would hang every later test
+        cls.port = start_server(app, threads = 1)
+
+    def request(self, method, path, connection = None):
+        if connection is None:
+            connection = httplib.HTTPConnection("127.0.0.1", self.port,
+                timeout = 5)
+        connection.request(method, path)
+        response = connection.getresponse()
+        return response, response.read()
+
+    def test_get(self):
+        response, body = self.request("GET", "/hello")
+
+        self.assertEqual(response.status, 200)
+        self.assertEqual(body, "GET /hello")
+
+    def test_keep_alive(self):
+        connection = httplib.HTTPConnection("127.0.0.1", self.port,
+            timeout = 5)
+        for i in range(3):
+            response, body = self.request("GET", "/again", connection)
+            self.assertEqual(body, "GET /again")
+            self.assertEqual(response.getheader("Connection"), "keep-alive")
+
+    def test_head_has_no_body(self):
+        response, body = self.request("HEAD", "/hello")
+
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader("Content-Length"), "11")
+        self.assertEqual(body, "")
+
+        # The connection is still usable afterwards
+        connection = httplib.HTTPConnection("127.0.0.1", self.port,
+            timeout = 5)
+        self.request("HEAD", "/hello", connection)
+        self.assertEqual(self.request("GET", "/hello", connection)[1],
+            "GET /hello")
+
+    def test_application_errors_are_500s(self):
+        for path in ("/error", "/silent", "/error", "/silent"):
+            response, body = self.request("GET", path)
+            self.assertEqual(response.status, 500)
+
+        # The worker thread survived
+        self.assertEqual(self.request("GET", "/hello")[0].status, 200)
+
+    def test_run_application(self):
+        self.assertEqual(event_server.run_application(app,
+            {"PATH_INFO": "/silent"}), event_server.INTERNAL_ERROR)
+        self.assertEqual(event_server.run_application(app,
+            {"PATH_INFO": "/a", "REQUEST_METHOD": "GET"})[2], "GET /a")
+
+class StreamedBodyTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.port = start_server(upload_app, threads = 1, max_body_size = 100,
+            streamed_paths = {"/upload": 500000, "/ignore": 500000})
+
+    def request(self, path, body, connection = None):
+        if connection is None:
+            connection = httplib.HTTPConnection("127.0.0.1", self.port,
+                timeout = 5)
+        connection.request("POST", path, body)
+        response = connection.getresponse()
+        return response, response.read()
+
+    def test_large_body_is_streamed(self):
+        # Several times what may wait for the application to read it
+        body = "x" * (event_server.MAX_STREAM_BUFFER * 4 + 1)
+        connection = httplib.HTTPConnection("127.0.0.1", self.port,
+            timeout = 5)
+
+        response, content = self.request("/upload", body, connection)
+        self.assertEqual(response.status, 200)
+        self.assertEqual(content, str(len(body)))
+
+        # The connection is ready for the next request
+        self.assertEqual(self.request("/upload", "abc", connection)[1], "3")
+
+    def test_limits(self):
+        self.assertEqual(self.request("/other", "x" * 101)[0].status, 413)
+
+        sock = socket.create_connection(("127.0.0.1", self.port), 5)
+        sock.sendall("POST /upload HTTP/1.1\r\nContent-Length: 500001\r\n"
+            "\r\n")
+        self.assertTrue(sock.recv(1024).startswith(
+            "HTTP/1.1 413 Request Entity Too Large"))
+        sock.close()
+
+    def test_unread_body_closes_the_connection(self):
+        # The application answers before the rest of the body is sent
+        sock = socket.create_connection(("127.0.0.1", self.port), 5)
+        sock.sendall("POST /ignore HTTP/1.1\r\nContent-Length: 1000\r\n"
+            "\r\nxxx")
+        response = ""
+        while True:
+            data = sock.recv(1024)
+            if not data:
+                break
+            response += data
+        sock.close()
+
+        self.assertIn("Connection: close\r\n", response)
+        self.assertTrue(response.endswith("\r\n\r\n0"))
+
+class EventServerImportTestCase(helpers.AppTestCase):
+    """Imports members through the event server, as ``event-server.py``
+    serves the site."""
+
+    def test_import_larger_than_max_body_size(self):
+        listening_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listening_socket.bind(("127.0.0.1", 0))
+        listening_socket.listen(16)
+        listening_socket.setblocking(0)
+        server = event_server.create_server(main.app, listening_socket,
+            main.config, streamed_paths = [path for path, route in
+                main.ROUTE_TABLE.items() if route.raw_body])
+        thread = threading.Thread(target = server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        body = "email,joined,name\n" + "".join(
+            "member{}@example.com,2014-09-30,Member\n".format(i)
+            for i in range(600))
+        self.assertGreater(len(body), server.max_body_size)
+
+        connection = httplib.HTTPConnection("127.0.0.1",
+            listening_socket.getsockname()[1], timeout = 10)
+        connection.request("POST", "/admin/import?action=add", body, {
+            "Authorization": "Bearer admin-token",
+            "Content-Type": "text/csv"
+        })
+        response = connection.getresponse()
+
+        self.assertEqual(response.status, 200)
+        self.assertEqual(json.loads(response.read()),
+            {"applied": 600, "errors": []})
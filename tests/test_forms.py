@@ -0,0 +1,80 @@
+# stdlib
+import io
+import unittest
+
+# internal
+from signup_server import forms
+
+def make_environ(body, content_type = forms.FORM_CONTENT_TYPE,
+        content_length = None, query = ""):
+    return {
+        "CONTENT_TYPE": content_type,
+        "CONTENT_LENGTH": str(len(body)) if content_length is None
+            else content_length,
+        "QUERY_STRING": query,
+        "wsgi.input": io.BytesIO(body)
+    }
+
+class ParseUrlencodedTestCase(unittest.TestCase):
+    def setUp(self):
+        # Small reads make fields straddle the chunks
+        original = forms.READ_SIZE
+        forms.READ_SIZE = 3
+        self.addCleanup(setattr, forms, "READ_SIZE", original)
+
+    def parse(self, body, max_body_size = 1000, max_fields = 10, **kwargs):
+        return forms.parse_urlencoded(make_environ(body, **kwargs),
+            max_body_size, max_fields)
+
+    def assertFormError(self, code, *args, **kwargs):
+        with self.assertRaises(forms.FormError) as context:
+            self.parse(*args, **kwargs)
+        self.assertEqual(context.exception.code, code)
+
+    def test_parses_fields(self):
+        self.assertEqual(self.parse("email=a%40example.com&name=First&&"
+            "shirt_size=&name=Caf%C3%A9+Au"), {
+                u"email": u"a@example.com",
+                u"name": u"Caf\xe9 Au",
+                u"shirt_size": u""
+            })
+
+    def test_empty_body(self):
+        self.assertEqual(self.parse(""), {})
+        self.assertEqual(self.parse("", content_length = ""), {})
+
+    def test_content_type_parameters_are_allowed(self):
+        self.assertEqual(self.parse("a=1", content_type =
+            "Application/X-WWW-Form-Urlencoded; charset=UTF-8"), {u"a": u"1"})
+
+    def test_limits(self):
+        self.assertFormError(413, "a=1", max_body_size = 2)
+        self.assertFormError(413, "a=1&b=2&c=3", max_fields = 2)
+
+    def test_invalid_bodies(self):
+        self.assertFormError(415, "{}", content_type = "application/json")
+        self.assertFormError(400, "a=1", content_length = "three")
+        self.assertFormError(400, "a=1", content_length = "-1")
+        self.assertFormError(400, "a=1", content_length = "10")
+        self.assertFormError(400, "a=%FF")
+
+    def test_never_reads_past_content_length(self):
+        environ = make_environ("a=1&b=2", content_length = "3")
+
+        self.assertEqual(forms.parse_urlencoded(environ, 1000, 10),
+            {u"a": u"1"})
+        self.assertEqual(environ["wsgi.input"].read(), "&b=2")
+
+class ParseQueryStringTestCase(unittest.TestCase):
+    def test_parses_fields(self):
+        self.assertEqual(forms.parse_query_string(make_environ("",
+            query = "paid=1&after=&&shirt_size=L"), 10), {
+                u"paid": u"1",
+                u"after": u"",
+                u"shirt_size": u"L"
+            })
+
+    def test_limits(self):
+        with self.assertRaises(forms.FormError) as context:
+            forms.parse_query_string(make_environ("", query = "a=1&b=2"), 1)
+        self.assertEqual(context.exception.code, 413)
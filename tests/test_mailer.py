@@ -0,0 +1,214 @@
+# stdlib
+import os
+import socket
+import smtpd
+import sqlite3
+import smtplib
+import asyncore
+import threading
+
+# internal
+from signup_server import database, mailer, main
+from tests import helpers
+
+class StubServer(smtpd.SMTPServer):
+    """
+    A local mail server that keeps what it's sent in ``received``, and
+    refuses messages to recipients containing ``bounce`` (permanently) or
+    ``later`` (temporarily).
+
+    """
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ("127.0.0.1", 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.received = []
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        if "bounce" in rcpttos[0]:
+            return "550 No such user"
+        if "later" in rcpttos[0]:
+            return "451 Try again later"
+
+        self.received.append((mailfrom, rcpttos, data))
+
+class MailerTestCase(helpers.DatabaseTestCase):
+    def setUp(self):
+        super(MailerTestCase, self).setUp()
+
+        # The server and the connections it accepts go into asyncore's global
+        # map, which the loop runs until it's empty.
+        self.server = StubServer()
+        self.thread = threading.Thread(target = asyncore.loop,
+            kwargs = {"timeout": 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+
+        self.mailer = mailer.Mailer(self.db,
+            lambda: smtplib.SMTP("127.0.0.1", self.server.port, timeout = 5),
+            "acm@example.com", retry_delay = 60)
+
+    def tearDown(self):
+        self.mailer.disconnect()
+        asyncore.close_all()
+        self.thread.join()
+        super(MailerTestCase, self).tearDown()
+
+    def queue(self, *recipients):
+        database.insert_all(self.db, [database.OutboxMessage.compose(i,
+            u"Subject", u"Body \u2713") for i in recipients])
+
+    def get_statuses(self):
+        return dict((i.recipient, (i.status, i.attempts)) for i in
+            database.OutboxMessage.filter(self.reader))
+
+    def test_sends_due_messages(self):
+        self.queue(u"a@example.com", u"b@example.com")
+
+        self.assertEqual(self.mailer.send_batch(), 2)
+
+        self.assertEqual(sorted(i[1][0] for i in self.server.received),
+            ["a@example.com", "b@example.com"])
+        self.assertIn("Message-ID: <rock-outbox-1@example.com>",
+            self.server.received[0][2])
+        self.assertEqual(self.get_statuses(), {
+            u"a@example.com": ("sent", 1),
+            u"b@example.com": ("sent", 1)
+        })
+
+        # Nothing is due anymore
+        self.assertEqual(self.mailer.send_batch(), 0)
+
+    def test_permanent_and_temporary_failures(self):
+        self.queue(u"bounce@example.com", u"later@example.com",
+            u"ok@example.com")
+
+        self.mailer.send_batch()
+
+        self.assertEqual(self.get_statuses(), {
+            u"bounce@example.com": ("failed", 1),
+            u"later@example.com": ("pending", 1),
+            u"ok@example.com": ("sent", 1)
+        })
+
+    def test_non_ascii_recipient_is_given_up_on(self):
+        self.queue(u"first@example.com", u"caf\xe9@example.com",
+            u"last@example.com")
+
+        self.assertEqual(self.mailer.send_batch(), 3)
+
+        self.assertEqual(self.get_statuses(), {
+            u"first@example.com": ("sent", 1),
+            u"caf\xe9@example.com": ("failed", 1),
+            u"last@example.com": ("sent", 1)
+        })
+
+    def test_unexpected_error_counts_as_attempt(self):
+        self.queue(u"first@example.com", u"second@example.com")
+        send = self.mailer._send
+        def broken_send(message):
+            if message.recipient == u"second@example.com":
+                raise RuntimeError("bug")
+            send(message)
+        self.mailer._send = broken_send
+
+        self.mailer.send_batch()
+
+        self.assertEqual(self.get_statuses(), {
+            u"first@example.com": ("sent", 1),
+            u"second@example.com": ("pending", 1)
+        })
+
+    def test_sent_messages_are_recorded_if_interrupted(self):
+        self.queue(u"first@example.com", u"second@example.com")
+        send = self.mailer._send
+        def interrupted_send(message):
+            if message.recipient == u"second@example.com":
+                raise KeyboardInterrupt()
+            send(message)
+        self.mailer._send = interrupted_send
+
+        with self.assertRaises(KeyboardInterrupt):
+            self.mailer.send_batch()
+
+        self.assertEqual(self.get_statuses()[u"first@example.com"],
+            ("sent", 1))
+
+    def test_unreachable_server_fails_rest_of_batch(self):
+        self.queue(u"a@example.com", u"b@example.com")
+        attempts = []
+        def connect():
+            attempts.append(None)
+            raise socket.error("connection refused")
+        self.mailer.connect = connect
+
+        self.mailer.send_batch()
+
+        self.assertEqual(len(attempts), 1)
+        self.assertEqual(self.get_statuses(), {
+            u"a@example.com": ("pending", 1),
+            u"b@example.com": ("pending", 1)
+        })
+
+class OutboxTestCase(helpers.DatabaseTestCase):
+    def test_claimed_messages_are_leased(self):
+        clock = helpers.FakeClock(self)
+        database.insert_all(self.db, [database.OutboxMessage.compose(
+            u"a@example.com", u"Subject", u"Body")])
+
+        self.assertEqual(len(database.OutboxMessage.claim_due(self.db, 10,
+            lease_seconds = 60)), 1)
+        self.assertEqual(database.OutboxMessage.claim_due(self.db, 10,
+            lease_seconds = 60), [])
+
+        # A worker that died holding the message gives it up eventually
+        clock.advance(61)
+        self.assertEqual(len(database.OutboxMessage.claim_due(self.db, 10,
+            lease_seconds = 60)), 1)
+
+    def test_dedup_key(self):
+        compose = lambda: database.OutboxMessage.compose(u"a@example.com",
+            u"Subject", u"Body", dedup_key = u"key")
+        database.insert_all(self.db, [compose()])
+
+        with self.assertRaises(sqlite3.IntegrityError):
+            database.insert_all(self.db, [compose()])
+
+class QueuedMailTestCase(helpers.AppTestCase):
+    CONFIG = {"send_mail": "true"}
+
+    def get_outbox(self):
+        return database.OutboxMessage.filter(
+            main.connection_manager.reader())
+
+    def test_join_queues_a_confirmation(self):
+        self.request("/join", {"email": "a@example.com", "name": "A",
+            "shirt-size": "M", "payment-type": "cash"})
+        self.request("/join", {"email": "a@example.com", "name": "A",
+            "shirt-size": "M"})
+
+        outbox = self.get_outbox()
+        self.assertEqual([i.recipient for i in outbox], [u"a@example.com"])
+        self.assertIn(mailer.CASH_INSTRUCTIONS, outbox[0].body)
+        self.assertEqual(outbox[0].status, "pending")
+
+    def test_checks_queue_one_status_email(self):
+        for i in range(3):
+            status, _, content = self.request("/check",
+                {"email": "a@example.com"})
+            self.assertEqual(status, 200)
+
+        outbox = self.get_outbox()
+        self.assertEqual(len(outbox), 1)
+        self.assertIn(content.decode("utf_8"), outbox[0].body)
+
+    def test_nothing_is_queued_unless_asked_to(self):
+        self.write_config(send_mail = None)
+        os.utime(self.config_path, (main.config_mtime + 10, ) * 2)
+        self.assertTrue(main.reload_config())
+
+        self.request("/join", {"email": "a@example.com", "name": "A",
+            "shirt-size": "M"})
+        self.request("/check", {"email": "a@example.com"})
+
+        self.assertEqual(self.get_outbox(), [])
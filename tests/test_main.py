@@ -0,0 +1,295 @@
+# stdlib
+import os
+import csv
+import json
+import urllib
+import datetime
+
+# internal
+from signup_server import database, main, metrics
+from tests import helpers
+
+class ReloadConfigTestCase(helpers.AppTestCase):
+    def rewrite_config(self, **options):
+        self.write_config(**options)
+
+        # Make sure the change is noticed however coarse the file system's
+        # timestamps are.
+        mtime = main.config_mtime + 10
+        os.utime(self.config_path, (mtime, mtime))
+
+    def test_changes_are_applied(self):
+        self.rewrite_config(max_joins_per_minute = "5",
+            member_cache_size = "7", busy_timeout_ms = "100")
+
+        self.assertTrue(main.reload_config())
+
+        self.assertEqual(main.config["max_joins_per_minute"], "5")
+        self.assertEqual(main.member_cache.max_size, 7)
+        self.assertEqual(main.connection_manager.busy_timeout, 100)
+        self.assertEqual(main.config_mtime,
+            os.stat(self.config_path).st_mtime)
+
+    def test_restart_options_are_kept(self):
+        db_file = main.config["db_file"]
+        self.rewrite_config(db_file = "/elsewhere.db")
+
+        self.assertTrue(main.reload_config())
+        self.assertEqual(main.config["db_file"], db_file)
+
+    def test_bad_values_change_nothing(self):
+        old_config = main.config
+        old_mtime = main.config_mtime
+        for options in [{"busy_timeout_ms": "soon"},
+                {"synchronous": "sometimes"}, {"cached_statements": "-1"},
+                {"member_cache_ttl": "forever"}, {"max_body_size": "big"},
+                {"max_joins_per_minute": None}]:
+            self.rewrite_config(member_cache_size = "7", **options)
+
+            self.assertFalse(main.reload_config())
+
+            self.assertIs(main.config, old_config)
+            self.assertEqual(main.config_mtime, old_mtime)
+            self.assertEqual(main.member_cache.max_size, 1024)
+            self.assertEqual(main.connection_manager.busy_timeout, 5000)
+
+        # Requests are still served with the old configuration, and the file
+        # is looked at again once it's fixed.
+        self.assertEqual(self.request("/check", {"email": "a@b.c"})[0], 200)
+        self.rewrite_config(member_cache_size = "7")
+        self.assertTrue(main.reload_config())
+        self.assertEqual(main.member_cache.max_size, 7)
+
+    def test_broken_file_changes_nothing(self):
+        old_config = main.config
+        with open(self.config_path, "w") as config_file:
+            config_file.write("this isn't a configuration file")
+
+        self.assertFalse(main.reload_config())
+        self.assertIs(main.config, old_config)
+
+class GetMemberTestCase(helpers.AppTestCase):
+    def test_join_during_lookup_is_not_hidden(self):
+        # The lookup finds nobody, and the join is committed (invalidating
+        # the cache) before the lookup stores what it found.
+        original_get = database.Member.get
+        def get(db, email):
+            member = original_get(db, email)
+            self.assertEqual(self.request("/join", {"email": email,
+                "name": "A", "shirt-size": "M"})[0], 200)
+            return member
+        database.Member.get = staticmethod(get)
+        try:
+            self.assertIsNone(main.get_member(u"a@example.com"))
+        finally:
+            database.Member.get = original_get
+
+        self.assertIsNotNone(main.get_member(u"a@example.com"))
+
+    def test_lookups_are_cached(self):
+        self.assertIsNone(main.get_member(u"a@example.com"))
+        self.assertIsNone(main.get_member(u"a@example.com"))
+        self.assertEqual(main.member_cache.stats()["hits"], 1)
+
+        self.request("/join", {"email": "a@example.com", "name": "A",
+            "shirt-size": "M"})
+        self.assertIsNotNone(main.get_member(u"a@example.com"))
+
+class AdminMembersTestCase(helpers.AppTestCase):
+    def setUp(self):
+        super(AdminMembersTestCase, self).setUp()
+
+        # Several members join at each time, so pages have to break ties by
+        # email.
+        self.emails = []
+        members = []
+        for i in range(25):
+            email = u"member{:02d}@example.com".format(i)
+            self.emails.append(email)
+            members.append(database.Member(
+                joined = datetime.datetime(2014, 9, 1 + i // 4, 18),
+                email = email, name = u"Member", shirt_size = u"M",
+                paid_on = datetime.datetime(2014, 10, 1) if i % 2 else None))
+        database.insert_all(main.connection_manager.writer(), members)
+
+    def get_page(self, query):
+        status, headers, content = self.admin_request("/admin/members",
+            query = query)
+        self.assertEqual(status, 200)
+        return json.loads(content)
+
+    def test_pages_cover_every_member_once(self):
+        seen = []
+        query = "limit=10"
+        while True:
+            page = self.get_page(query)
+            seen.extend(i["email"] for i in page["members"])
+            if page["next"] is None:
+                break
+            query = "limit=10&" + urllib.urlencode({"after": page["next"]})
+
+        self.assertEqual(seen, self.emails)
+
+    def store_as_text(self, emails):
+        """
+        Stores the join times of the given members as text, the way they are
+        until ``manage.py convert-timestamps`` has run.
+
+        """
+
+        main.connection_manager.writer().executemany("UPDATE members SET "
+            "joined=datetime(joined, 'unixepoch', 'localtime') || '.000000' "
+            "WHERE email=?;", [(i, ) for i in emails])
+
+    def test_pages_cover_mixed_rows(self):
+        text_emails = self.emails[5:10]
+        self.store_as_text(text_emails)
+
+        seen = []
+        query = "limit=2"
+        for _ in range(len(self.emails)):
+            page = self.get_page(query)
+            seen.extend(i["email"] for i in page["members"])
+            if page["next"] is None:
+                break
+            query = "limit=2&" + urllib.urlencode({"after": page["next"]})
+        else:
+            self.fail("paging never finished")
+
+        # Members still stored as text come after the rest
+        self.assertEqual(seen, [i for i in self.emails
+            if i not in text_emails] + text_emails)
+
+    def test_filters_match_mixed_rows(self):
+        self.store_as_text(self.emails[5:10])
+
+        page = self.get_page("joined_from=2014-09-02&"
+            "joined_until=2014-09-02")
+        self.assertEqual([i["email"] for i in page["members"]],
+            self.emails[4:8])
+        self.assertEqual(page["members"][1]["joined"],
+            page["members"][0]["joined"])
+
+        page = self.get_page("paid=yes&joined_from=2014-09-03")
+        self.assertEqual(len(page["members"]), 8)
+
+    def test_filters(self):
+        page = self.get_page("paid=yes&joined_from=2014-09-02&"
+            "joined_until=2014-09-02")
+        self.assertEqual([i["email"] for i in page["members"]],
+            [u"member05@example.com", u"member07@example.com"])
+
+    def test_csv_export(self):
+        status, headers, content = self.admin_request("/admin/members",
+            query = "format=csv")
+
+        self.assertEqual(status, 200)
+        rows = list(csv.reader(content.splitlines()))
+        self.assertEqual(rows[0], list(main.MEMBER_FIELDS))
+        self.assertEqual(len(rows), 26)
+
+    def test_bad_page_keys(self):
+        for key in [[[1], u"a"], [{"a": 1}, u"a"], [1, [u"a"]], [1, None],
+                [True, u"a"], [2 ** 70, u"a"], [1], u"a", None]:
+            after = main.encode_page_key(key)
+            status = self.admin_request("/admin/members",
+                query = urllib.urlencode({"after": after}))[0]
+            self.assertEqual(status, 400, key)
+
+        status = self.admin_request("/admin/members",
+            query = "after=not-base64!")[0]
+        self.assertEqual(status, 400)
+
+    def test_token_is_required(self):
+        self.assertEqual(self.request("/admin/members", method = "GET",
+            referer = False)[0], 401)
+
+def join(test_case, email, **fields):
+    return test_case.request("/join", dict({"email": email, "name": "A",
+        "shirt-size": "M"}, **fields))
+
+class MemberFilterTestCase(helpers.AppTestCase):
+    def setUp(self):
+        super(MemberFilterTestCase, self).setUp()
+
+        # Records the actions that got as far as the site-wide limit, which
+        # takes the database's write lock.
+        self.limited = []
+        try_action = main.rate_limiter.try_action
+        def recording_try_action(db, action, limit):
+            self.limited.append(action)
+            return try_action(db, action, limit)
+        main.rate_limiter.try_action = recording_try_action
+
+    def test_duplicate_is_refused_before_the_write_lock(self):
+        self.assertEqual(join(self, "a@example.com")[0], 200)
+
+        status, _, content = join(self, "a@example.com")
+
+        self.assertEqual(status, 500)
+        self.assertIn("already registered", content)
+        self.assertEqual(self.limited, ["join"])
+        self.assertTrue(main.is_registered(u"a@example.com"))
+        self.assertFalse(main.is_registered(u"b@example.com"))
+
+    def test_existing_members_are_loaded(self):
+        database.Member(joined = datetime.datetime(2014, 9, 30),
+            email = u"old@example.com", name = u"Old", shirt_size = None,
+            paid_on = None).insert(main.connection_manager.writer())
+        main.member_filter = main.create_member_filter(
+            main.connection_manager.reader())
+
+        self.assertEqual(join(self, "old@example.com")[0], 500)
+        self.assertEqual(self.limited, [])
+
+    def test_members_unknown_to_the_filter_are_still_refused(self):
+        # As if they joined through another process
+        main.connection_manager.writer().execute(
+            "INSERT INTO members VALUES (?, ?, ?, ?, ?);",
+            (1412125200, u"a@example.com", u"A", None, None))
+        self.assertFalse(main.is_registered(u"a@example.com"))
+
+        status, _, content = join(self, "a@example.com")
+
+        self.assertEqual(status, 500)
+        self.assertIn("already registered", content)
+        self.assertEqual(self.limited, ["join"])
+
+class MemberFilterOffTestCase(helpers.AppTestCase):
+    CONFIG = {"member_filter": "false"}
+
+    def test_duplicates_are_refused_by_the_database(self):
+        self.assertIsNone(main.member_filter)
+        self.assertEqual(join(self, "a@example.com")[0], 200)
+        self.assertEqual(join(self, "a@example.com")[0], 500)
+
+class RateLimitedResponseTestCase(helpers.AppTestCase):
+    CONFIG = {
+        "max_joins_per_minute": "1",
+        "max_checks_per_email_per_minute": "2"
+    }
+
+    def test_site_limit(self):
+        self.assertEqual(join(self, "a@example.com")[0], 200)
+
+        status, headers, _ = join(self, "b@example.com")
+
+        self.assertEqual(status, 429)
+        retry_after = int(headers["Retry-After"])
+        self.assertTrue(1 <= retry_after <= 60, retry_after)
+
+    def test_email_limit(self):
+        for i in range(2):
+            self.assertEqual(self.request("/check",
+                {"email": "a@example.com"})[0], 200)
+
+        # Changing the case doesn't get around it, but another email is fine
+        status, headers, _ = self.request("/check",
+            {"email": "A@Example.com"})
+        self.assertEqual(status, 429)
+        self.assertIn("Retry-After", headers)
+        self.assertEqual(self.request("/check",
+            {"email": "b@example.com"})[0], 200)
+
+        self.assertIn('rock_rate_limited_total{route="/check",'
+            'scope="email"}', metrics.registry.render())
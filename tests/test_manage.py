@@ -0,0 +1,108 @@
+"""
+Tests for the commands of ``manage.py``. The script can't be imported, so
+they're run as it would be, against a database of the test's own.
+
+"""
+
+# stdlib
+import os
+import sys
+import datetime
+import subprocess
+
+# internal
+from signup_server import database
+from tests import helpers
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class ManageTestCase(helpers.DatabaseTestCase):
+    def setUp(self):
+        super(ManageTestCase, self).setUp()
+
+        self.config_path = os.path.join(self.directory, "config.ini")
+        with open(self.config_path, "w") as config_file:
+            config_file.write("[rock]\ndb_file = {}\n"
+                "max_joins_per_minute = 1000\n"
+                "max_checks_per_minute = 1000\n".format(self.db_file))
+
+        database.insert_all(self.db, [database.Member(
+            joined = datetime.datetime(2014, 9, 30, 18),
+            email = u"{}@example.com".format(i), name = u"Name",
+            shirt_size = None, paid_on = None) for i in range(3)])
+
+    def manage(self, *arguments, **kwargs):
+        """
+        Runs ``manage.py`` with the given arguments, passing ``stdin`` along.
+
+        :returns: The exit status and what was written to standard output.
+
+        """
+
+        process = subprocess.Popen([sys.executable,
+            os.path.join(REPO_DIR, "manage.py"), "--config",
+            self.config_path] + list(arguments),
+            stdin = subprocess.PIPE, stdout = subprocess.PIPE,
+            stderr = subprocess.PIPE)
+        stdout, _ = process.communicate(kwargs.get("stdin", ""))
+        return process.returncode, stdout
+
+    def test_check_and_rebuild_stats(self):
+        status, output = self.manage("check-stats")
+        self.assertEqual(status, 0)
+        self.assertIn("The member statistics are correct.", output)
+
+        self.db.execute(
+            "UPDATE member_statistics SET value=7 WHERE name='total';")
+        status, output = self.manage("check-stats")
+        self.assertEqual(status, 1)
+        self.assertIn("total: stored 7, counted 3", output)
+
+        status, output = self.manage("rebuild-stats")
+        self.assertEqual(status, 0)
+        self.assertIn("total: stored 7, counted 3", output)
+        self.assertEqual(database.MemberStatistic.find_drift(self.reader),
+            [])
+
+    def test_convert_timestamps(self):
+        self.db.execute("UPDATE members SET paid_on='2014-10-01 09:00:00', "
+            "joined='2014-09-30 18:00:00.000000' WHERE email!=?;",
+            (u"0@example.com", ))
+
+        status, output = self.manage("convert-timestamps", "--batch-size",
+            "1", "--pause", "0")
+
+        self.assertEqual(status, 0)
+        self.assertIn("Converted 2 members, every member is up to date.",
+            output)
+        self.assertEqual(set(self.reader.execute(
+            "SELECT typeof(joined), typeof(paid_on) FROM members;")),
+            set([("integer", "integer"), ("integer", "null")]))
+        self.assertEqual(database.Member.get(self.reader,
+            u"1@example.com").paid_on, datetime.datetime(2014, 10, 1, 9))
+
+    def test_import_members(self):
+        csv_path = os.path.join(self.directory, "paid.csv")
+        with open(csv_path, "w") as csv_file:
+            csv_file.write("email,paid_on\n0@example.com,2014-10-01\n")
+
+        status, output = self.manage("import-members", "--action",
+            "mark-paid", csv_path)
+        self.assertEqual(status, 0)
+        self.assertIn("Applied 1 rows, 0 rows had errors.", output)
+        self.assertEqual(database.Member.get(self.reader,
+            u"0@example.com").paid_on, datetime.datetime(2014, 10, 1))
+
+        # Rows with errors make the command fail, after applying the rest
+        status, output = self.manage("import-members", "--action", "add",
+            "-", stdin = "email,joined\n0@example.com,2014-09-30\n"
+                "new@example.com,2014-09-30\n")
+        self.assertEqual(status, 1)
+        self.assertIn("Line 2 (0@example.com): email already exists", output)
+        self.assertIsNotNone(database.Member.get(self.reader,
+            u"new@example.com"))
+
+        status, output = self.manage("import-members", "--action", "add",
+            "-", stdin = "name\n")
+        self.assertEqual(status, 1)
+        self.assertIn("Nothing was imported", output)
@@ -0,0 +1,154 @@
+# stdlib
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+# internal
+from signup_server import metrics
+from tests import helpers
+
+class RegistryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_counters(self):
+        self.registry.describe("rock_things_total", "counter", "Things.")
+        self.registry.increment("rock_things_total", kind = "a")
+        self.registry.increment("rock_things_total", 2, kind = "a")
+        self.registry.increment("rock_things_total", kind = 'say "hi"\n')
+
+        self.assertEqual(self.registry.render(),
+            "# HELP rock_things_total Things.\n"
+            "# TYPE rock_things_total counter\n"
+            'rock_things_total{kind="a"} 3\n'
+            'rock_things_total{kind="say \\"hi\\"\\n"} 1\n')
+
+    def test_histograms_are_cumulative(self):
+        histogram = self.registry.get_histogram("rock_wait_seconds",
+            buckets = (0.1, 1.0))
+        self.assertIs(self.registry.get_histogram("rock_wait_seconds",
+            buckets = (0.1, 1.0)), histogram)
+        for i in (0.05, 0.1, 0.5, 5.0):
+            histogram.observe(i)
+
+        self.assertEqual(self.registry.render().splitlines(), [
+            "# TYPE rock_wait_seconds histogram",
+            'rock_wait_seconds_bucket{le="0.1"} 2',
+            'rock_wait_seconds_bucket{le="1.0"} 3',
+            'rock_wait_seconds_bucket{le="+Inf"} 4',
+            "rock_wait_seconds_sum 5.65",
+            "rock_wait_seconds_count 4"
+        ])
+
+    def test_collectors_are_gauges(self):
+        self.registry.add_collector(lambda: [("rock_cache_size",
+            {"cache": "members"}, 7)])
+
+        self.assertIn('rock_cache_size{cache="members"} 7\n',
+            self.registry.render())
+
+    def test_snapshots_add_up(self):
+        self.registry.increment("rock_things_total")
+        self.registry.get_histogram("rock_wait_seconds",
+            buckets = (1.0, )).observe(0.5)
+
+        # A snapshot must survive being written out as JSON
+        snapshot = json.loads(json.dumps(self.registry.snapshot()))
+        rendered = self.registry.render([snapshot, snapshot])
+
+        self.assertIn("rock_things_total 2\n", rendered)
+        self.assertIn('rock_wait_seconds_bucket{le="1.0"} 2\n', rendered)
+        self.assertIn("rock_wait_seconds_sum 1.0\n", rendered)
+
+class SnapshotDirectoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix = "rock-test-")
+        self.snapshots = metrics.SnapshotDirectory(
+            os.path.join(self.directory, "metrics"))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_write_and_read(self):
+        registry = metrics.Registry()
+        registry.increment("rock_things_total")
+
+        self.snapshots.write(registry)
+        self.snapshots.write(registry)
+
+        self.assertEqual(self.snapshots.read_all(),
+            [json.loads(json.dumps(registry.snapshot()))])
+
+    def test_snapshots_of_exited_processes_are_deleted(self):
+        process = subprocess.Popen(["true"])
+        process.wait()
+        dead_path = os.path.join(self.snapshots.path,
+            "{}.json".format(process.pid))
+        with open(dead_path, "w") as f:
+            json.dump(metrics.Registry().snapshot(), f)
+
+        self.assertEqual(self.snapshots.read_all(), [])
+        self.assertFalse(os.path.exists(dead_path))
+
+class MetricsMiddlewareTestCase(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def app(self, environ, start_response):
+        if environ["PATH_INFO"] == "/broken":
+            raise RuntimeError("bug")
+
+        start_response("404 Not Found", [])
+        return ["body"]
+
+    def request(self, middleware, path):
+        result = middleware({"PATH_INFO": path}, lambda *args: None)
+        self.assertEqual(list(result), ["body"])
+        result.close()
+
+    def test_requests_are_counted_by_route_and_status(self):
+        middleware = metrics.MetricsMiddleware(self.app, self.registry,
+            ["/join", "/broken"])
+
+        self.request(middleware, "/join")
+        self.request(middleware, "/anything")
+        with self.assertRaises(RuntimeError):
+            middleware({"PATH_INFO": "/broken"}, lambda *args: None)
+
+        rendered = self.registry.render()
+        self.assertIn('rock_requests_total{route="/join",status="404"} 1\n',
+            rendered)
+        self.assertIn('rock_requests_total{route="other",status="404"} 1\n',
+            rendered)
+        self.assertIn('rock_requests_total{route="/broken",status="500"} 1\n',
+            rendered)
+        self.assertIn('rock_request_duration_seconds_count{route="/join",'
+            'status="404"} 1\n', rendered)
+
+    def test_snapshots_are_written(self):
+        directory = tempfile.mkdtemp(prefix = "rock-test-")
+        self.addCleanup(shutil.rmtree, directory)
+        snapshots = metrics.SnapshotDirectory(directory)
+        middleware = metrics.MetricsMiddleware(self.app, self.registry,
+            ["/join"], snapshots = snapshots)
+
+        self.request(middleware, "/join")
+
+        self.assertEqual(snapshots.read_all(),
+            [json.loads(json.dumps(self.registry.snapshot()))])
+
+class MetricsEndpointTestCase(helpers.AppTestCase):
+    def test_token_is_required(self):
+        status, _, _ = self.request("/metrics", method = "GET",
+            referer = False)
+        self.assertEqual(status, 401)
+
+        status, headers, body = self.request("/metrics", method = "GET",
+            referer = False,
+            headers = {"HTTP_AUTHORIZATION": "Bearer metrics-token"})
+        self.assertEqual(status, 200)
+        self.assertTrue(headers["Content-type"].startswith("text/plain"))
+        self.assertIn("# TYPE rock_requests_total counter", body)
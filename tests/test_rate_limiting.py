@@ -0,0 +1,165 @@
+# stdlib
+import os
+import unittest
+
+# internal
+from signup_server import database, rate_limiting
+from tests import helpers
+
+class SQLiteBackendTestCase(helpers.DatabaseTestCase):
+    USE_RETURNING = database.RateLimiter.USE_RETURNING
+
+    def setUp(self):
+        super(SQLiteBackendTestCase, self).setUp()
+
+        # The statements are built for whichever way we're testing
+        self.use_returning(self.USE_RETURNING)
+        self.addCleanup(self.use_returning,
+            database.RateLimiter.USE_RETURNING)
+
+        # At the start of a bucket
+        self.clock = helpers.FakeClock(self, now = 1400000010.0)
+        self.backend = rate_limiting.SQLiteBackend(bucket_seconds = 10)
+
+    def use_returning(self, value):
+        database.RateLimiter.USE_RETURNING = value
+        database.RateLimiter._try_action_statements.clear()
+
+    def try_join(self, max_per_minute = 3):
+        return self.backend.try_action(self.db, "join", max_per_minute)
+
+    def test_limit(self):
+        for i in range(3):
+            self.assertTrue(self.try_join())
+        self.assertFalse(self.try_join())
+
+        # Each action has its own counter
+        self.assertTrue(self.backend.try_action(self.db, "check", 3))
+
+    def test_window_slides(self):
+        self.assertTrue(self.try_join())
+        self.clock.advance(30)
+        self.assertTrue(self.try_join())
+        self.assertTrue(self.try_join())
+        self.assertEqual(self.backend.retry_after(), 10)
+
+        # The first join leaves the window, the others are still in it
+        self.clock.advance(30)
+        self.assertTrue(self.try_join())
+        self.assertFalse(self.try_join())
+
+    def test_table_stays_the_same_size(self):
+        for i in range(30):
+            self.try_join(max_per_minute = 1000)
+            self.clock.advance(7)
+
+        count = self.db.execute(
+            "SELECT COUNT(*) FROM rate_limiting;").fetchone()[0]
+        self.assertLessEqual(count, 6)
+
+    def test_old_slot_is_reset_when_reused(self):
+        for i in range(3):
+            self.try_join()
+
+        # The same slot, a whole window later
+        self.clock.advance(60)
+        self.assertTrue(self.try_join(max_per_minute = 1))
+
+    def test_clock_turned_back(self):
+        for i in range(3):
+            self.try_join()
+
+        # Buckets from the future don't count against us
+        self.clock.advance(-20)
+        self.assertTrue(self.try_join(max_per_minute = 1))
+
+class SQLiteBackendWithoutReturningTestCase(SQLiteBackendTestCase):
+    """The same tests, as run against SQLite older than 3.35."""
+
+    USE_RETURNING = False
+
+class SharedMemoryBackendTestCase(helpers.DatabaseTestCase):
+    def setUp(self):
+        super(SharedMemoryBackendTestCase, self).setUp()
+        self.clock = helpers.FakeClock(self, now = 1400000020.0)
+        self.path = os.path.join(self.directory, "counters")
+        self.backend = rate_limiting.SharedMemoryBackend(self.path)
+        self.addCleanup(self.backend.close)
+
+    def test_limit_per_minute(self):
+        for i in range(3):
+            self.assertTrue(self.backend.try_action(None, "join", 3))
+        self.assertFalse(self.backend.try_action(None, "join", 3))
+
+        # Each action has its own counter
+        self.assertTrue(self.backend.try_action(None, "check", 3))
+
+        # The counters start over with the next minute
+        self.assertEqual(self.backend.retry_after(), 20)
+        self.clock.advance(20)
+        self.assertTrue(self.backend.try_action(None, "join", 3))
+
+    def test_processes_share_counters(self):
+        other = rate_limiting.SharedMemoryBackend(self.path)
+        self.addCleanup(other.close)
+
+        self.assertTrue(self.backend.try_action(None, "join", 2))
+        self.assertTrue(other.try_action(None, "join", 2))
+        self.assertFalse(self.backend.try_action(None, "join", 2))
+
+    def test_unknown_action(self):
+        with self.assertRaises(ValueError):
+            self.backend.try_action(None, "leave", 2)
+
+class CreateBackendTestCase(unittest.TestCase):
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            rate_limiting.create_backend({"rate_limiter": "carrier_pigeon",
+                "db_file": "members.db"})
+
+    def test_bucket_seconds_must_divide_the_window(self):
+        with self.assertRaises(ValueError):
+            rate_limiting.SQLiteBackend(bucket_seconds = 7)
+
+class SlidingWindowLimiterTestCase(unittest.TestCase):
+    def setUp(self):
+        # At the start of a bucket
+        self.clock = helpers.FakeClock(self, now = 1400000010.0)
+        self.limiter = rate_limiting.SlidingWindowLimiter(window = 60,
+            buckets = 6, max_keys = 3)
+
+    def test_limit_per_key(self):
+        for i in range(2):
+            self.assertTrue(self.limiter.try_action("a", 2))
+        self.assertFalse(self.limiter.try_action("a", 2))
+        self.assertTrue(self.limiter.try_action("b", 2))
+
+    def test_window_slides(self):
+        self.assertTrue(self.limiter.try_action("a", 2))
+        self.clock.advance(30)
+        self.assertTrue(self.limiter.try_action("a", 2))
+        self.assertFalse(self.limiter.try_action("a", 2))
+        self.assertEqual(self.limiter.retry_after(), 10)
+
+        # The first action leaves the window, and rejected actions were
+        # never counted.
+        self.clock.advance(30)
+        self.assertTrue(self.limiter.try_action("a", 2))
+        self.assertFalse(self.limiter.try_action("a", 2))
+
+        # Long after, everything has left the window
+        self.clock.advance(600)
+        self.assertTrue(self.limiter.try_action("a", 2))
+        self.assertTrue(self.limiter.try_action("a", 2))
+
+    def test_least_recently_seen_key_is_forgotten(self):
+        for key in ("a", "b", "c"):
+            self.assertTrue(self.limiter.try_action(key, 1))
+        self.assertFalse(self.limiter.try_action("a", 1))
+
+        # "b" is the least recently seen, so it makes room for "d"
+        self.assertTrue(self.limiter.try_action("d", 1))
+        self.assertEqual(self.limiter.stats(),
+            {"size": 3, "evictions": 1})
+        self.assertFalse(self.limiter.try_action("a", 1))
+        self.assertTrue(self.limiter.try_action("b", 1))